@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Artifact-type scoring from a declarative config.
+
+The config (ARTIFACT_SCORING, or a JSON file of the same shape passed to
+load_scoring) has three parts:
+
+- rules: labels in precedence order; the first rule whose flags all hold
+  sets inferred_artifact_type ("!flag" = flag is false),
+- scores: per artifact type a sum of terms. A term is a column name or
+  {"columns": [...], "weight": w, "per": d}: the product of its columns
+  ("!flag" = 1 - flag), times weight, divided by per. Missing values count
+  as 0. artifact_type_top is the first highest score in this order.
+- fallback_max_entropy: flows no rule labels get the top-ranked type when
+  their score entropy is below this; null = always.
+
+The pandas build (score_artifacts) evaluates everything as array operations
+on the distinct combinations of input columns -- a few per workload pair --
+and broadcasts the result to the packets. The DuckDB build uses the same
+config through scores_sql / rules_sql.
+
+Tied scores in artifact_type_ranked are listed as the original row-wise
+code listed them (pandas sort_values(ascending=False), i.e. numpy's default
+quicksort, whose tie order is not config order and may differ between
+platforms); the DuckDB build lists them in config order. Labels and
+artifact_type_top do not depend on it.
+"""
+
+import json
+
+import numpy as np
+import pandas as pd
+
+
+ARTIFACT_SCORING = {
+    'rules': [
+        {'artifact': 'baremetal', 'when': ['is_compliance_sensitive']},
+        {'artifact': 'container', 'when': ['is_stable_workload', 'is_data_intensive']},
+        {'artifact': 'load_balancer', 'when': ['is_gateway_pattern']},
+        {'artifact': 'vm', 'when': ['is_api_backend', '!is_stable_workload']},
+        {'artifact': 'serverless', 'when': ['is_fin_api_pattern_dst', 'is_stable_workload']},
+    ],
+    'scores': {
+        'serverless': ['is_fin_api_pattern_dst', 'is_stable_workload', 'is_bursty_dst'],
+        'container': ['is_possible_container_dst', 'is_data_heavy_dst'],
+        'orchestrated_container': ['is_possible_container_dst', {'columns': ['peer_count_dst'], 'per': 10}],
+        # response delay as a VM / baremetal signal
+        'vm': ['is_virtual_machine', 'is_data_intensive', {'columns': ['response_delay_dst'], 'per': 10}],
+        'mini_vm': ['is_virtual_machine', {'columns': ['is_stable_workload', '!is_data_intensive']}],
+        'baremetal': ['is_physical_machine', 'is_data_intensive', 'is_compliance_sensitive',
+                      {'columns': ['response_delay_dst'], 'per': 10}],
+    },
+    'fallback_max_entropy': None,
+}
+
+
+def load_scoring(path=None):
+    # The built-in config, or one read from a JSON file
+    if path is None:
+        return ARTIFACT_SCORING
+    with open(path, encoding='utf-8') as f:
+        scoring = json.load(f)
+    if not scoring.get('scores'):
+        raise ValueError(f"{path}: no artifact scores defined")
+    scoring.setdefault('rules', [])
+    scoring.setdefault('fallback_max_entropy', None)
+    return scoring
+
+
+def _term(term):
+    if isinstance(term, str):
+        term = {'columns': [term]}
+    return term['columns'], term.get('weight', 1), term.get('per', 1)
+
+
+def _flag(name):
+    return (name[1:], True) if name.startswith('!') else (name, False)
+
+
+def input_columns(scoring):
+    names = [col for rule in scoring['rules'] for col in rule['when']]
+    names += [col for terms in scoring['scores'].values() for term in terms for col in _term(term)[0]]
+    return list(dict.fromkeys(_flag(name)[0] for name in names))
+
+
+def _score_matrix(X, index, scoring):
+    scores = np.zeros((len(X), len(scoring['scores'])))
+    for k, terms in enumerate(scoring['scores'].values()):
+        total = np.zeros(len(X))
+        for term in terms:
+            columns, weight, per = _term(term)
+            value = None
+            for name in columns:
+                col, negated = _flag(name)
+                v = 1 - X[:, index[col]] if negated else X[:, index[col]]
+                value = v if value is None else value * v
+            if weight != 1:
+                value = value * weight
+            if per != 1:
+                value = value / per
+            total = total + value
+        scores[:, k] = total
+    return scores
+
+
+def _distinct_rows(values):
+    # Group id per row over several columns (hashing, no sort) and the first
+    # row of each group. Column codes are combined in one int64 and
+    # re-factorized before the combination could overflow.
+    codes, groups = np.zeros(len(values[0]), dtype=np.int64), 1
+    for v in values:
+        col_codes, uniques = pd.factorize(v)
+        width = len(uniques) + 1  # NaN has code -1
+        if groups * width >= 1 << 62:
+            codes, uniques = pd.factorize(codes)
+            groups = len(uniques)
+        codes = codes * width + (col_codes + 1)
+        groups *= width
+    codes, _ = pd.factorize(codes)
+    # factorize numbers groups in order of appearance
+    first = np.flatnonzero(np.r_[True, codes[1:] > np.maximum.accumulate(codes)[:-1]])
+    return codes, first
+
+
+def score_artifacts(df, scoring=None):
+    # inferred_artifact_type, artifact_type_entropy/_top/_top_score/_ranked for df's rows
+    scoring = scoring or ARTIFACT_SCORING
+    names = np.array(list(scoring['scores']), dtype=object)
+    columns = input_columns(scoring)
+    index = {col: j for j, col in enumerate(columns)}
+
+    values = [df[col].to_numpy(dtype=float, na_value=np.nan) for col in columns]
+    inverse, first = _distinct_rows(values)
+    X = np.nan_to_num(np.column_stack([v[first] for v in values]), nan=0.0)
+
+    scores = _score_matrix(X, index, scoring)
+    row_sums = scores.sum(axis=1, keepdims=True)
+    row_sums[row_sums == 0] = 1
+    safe = np.clip(scores / row_sums, 1e-12, 1.0)
+    entropy = -np.sum(safe * np.log(safe), axis=1)
+    # Ties as in Series.sort_values(ascending=False): quicksort of the
+    # reversed row, reversed back
+    last = scores.shape[1] - 1
+    order = (last - np.argsort(scores[:, ::-1], axis=1))[:, ::-1]
+    top = names[scores.argmax(axis=1)]
+    ranked = np.empty(len(X), dtype=object)
+    for i, row in enumerate(names[order].tolist()):
+        ranked[i] = row
+
+    label = np.full(len(X), None, dtype=object)
+    for rule in reversed(scoring['rules']):
+        mask = np.ones(len(X), dtype=bool)
+        for name in rule['when']:
+            col, negated = _flag(name)
+            mask &= (X[:, index[col]] == 0) if negated else (X[:, index[col]] != 0)
+        label[mask] = rule['artifact']
+    fallback = pd.isnull(label)
+    if scoring['fallback_max_entropy'] is not None:
+        fallback &= entropy < scoring['fallback_max_entropy']
+    label[fallback] = top[fallback]
+
+    return {
+        'inferred_artifact_type': label[inverse],
+        'artifact_type_entropy': entropy[inverse],
+        'artifact_type_top': top[inverse],
+        'artifact_type_top_score': scores.max(axis=1)[inverse],
+        'artifact_type_ranked': ranked[inverse],
+    }
+
+
+def _value_sql(name):
+    col, negated = _flag(name)
+    value = f"COALESCE(CAST({col} AS DOUBLE), 0)"
+    return f"(1 - {value})" if negated else value
+
+
+def scores_sql(scoring=None):
+    # [(artifact, SQL expression)] in config order
+    scoring = scoring or ARTIFACT_SCORING
+    result = []
+    for name, terms in scoring['scores'].items():
+        parts = []
+        for term in terms:
+            columns, weight, per = _term(term)
+            value = ' * '.join(_value_sql(col) for col in columns)
+            if weight != 1:
+                value = f"({value}) * {weight}"
+            if per != 1:
+                value = f"({value}) / {per}"
+            parts.append(value)
+        result.append((name, ' + '.join(parts) or '0'))
+    return result
+
+
+def rules_sql(scoring=None):
+    # CASE expression for the rule label (NULL when no rule matches)
+    scoring = scoring or ARTIFACT_SCORING
+    if not scoring['rules']:
+        return "CAST(NULL AS VARCHAR)"
+    whens = []
+    for rule in scoring['rules']:
+        conditions = []
+        for name in rule['when']:
+            col, negated = _flag(name)
+            conditions.append(f"NOT COALESCE({col}, false)" if negated else f"COALESCE({col}, false)")
+        whens.append(f"WHEN {' AND '.join(conditions)} THEN '{rule['artifact']}'")
+    return f"CASE {' '.join(whens)} END"
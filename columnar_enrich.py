@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar version of the per-packet enrichment in preprosessing_update.py
+(extract_fields + the loop in stream_process_json).
+
+Works on a batch of packets at a time, one array per raw field, and gives
+the same columns with the same values and dtypes as building a DataFrame
+from the row-wise entries. Python's own semantics are kept on purpose
+(`a or b` picks the first truthy value, string ports never equal 443,
+str(None) == 'None' inside workload keys...), so switching paths does not
+change a single label. Work that needs Python per value (IP classification,
+SHA-1, OUI lookup, formatting) is done once per distinct value and broadcast
+back.
+"""
+
+import ast
+import hashlib
+import json
+import operator
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from ingest_sinks import NESTED_SUFFIX, decoded_batch, is_parquet_input, open_parquet_dataset
+from ip_classify import IpClassifier
+
+
+# Flattened fields read by extract_fields / stream_process_json
+RAW_FIELDS = [
+    'capture_id',
+    'frame.frame.time_epoch',
+    'frame.frame.len',
+    'eth.eth.src',
+    'eth.eth.dst',
+    'ip.ip.proto',
+    'ip.ip.flags',
+    'ip.ip.src',
+    'ip.ip.dst',
+    'ip.ip.ttl',
+    'udp.udp.srcport',
+    'udp.udp.dstport',
+    'tcp.tcp.srcport',
+    'tcp.tcp.dstport',
+    'tls.record.content_type_raw',
+    'tls.record.content_type',
+    'tls.record.version',
+    'tls.tls.record.version',
+    'fix.fix.msg_type',
+    'swift.swift.field',
+    'iso8583.iso8583.field',
+    'mdns.Queries',
+    'dns.qry.name',
+    'dns.query.name',
+    'dns.questions.name',
+    'dns.resp.name',
+    'dns.answers.name',
+    'dns.a',
+    'dns.ns',
+    'mdns.dns.resp.name',
+    'dns.qry.type',
+    'dns.qry.name_raw',
+    'rtsp.rtsp.method',
+    'rtp.rtp.seq',
+    'rtcp.rtcp.ssrc',
+    'icmp.icmp.type',
+    'igmp.igmp.type',
+    'arp.arp.src.hw_mac',
+]
+
+VIRTUAL_OUIS = {
+    '00:05:69', '00:0C:29', '00:1C:14', '00:50:56',
+    '08:00:27', '00:03:FF', '52:54:00', '00:15:5D'
+}
+
+_RAW_KEYS = frozenset(RAW_FIELDS)
+
+_truthy = np.frompyfunc(bool, 1, 1)
+_is_not = np.frompyfunc(operator.is_not, 2, 1)
+_is = np.frompyfunc(operator.is_, 2, 1)
+
+
+def columns_from_rows(rows):
+    # rows: packet dicts (ijson); one object array per raw field. A row only
+    # carries a few of the fields, so walk its keys instead of probing all.
+    cols = {k: np.full(len(rows), None, dtype=object) for k in RAW_FIELDS}
+    for i, row in enumerate(rows):
+        for k in row.keys() & _RAW_KEYS:
+            cols[k][i] = row[k]
+    return cols
+
+
+def arrow_values(arr):
+    # Python values as batch.to_pylist() would give them (ints stay ints,
+    # nulls are None), without going through a dict per row
+    if pa.types.is_dictionary(arr.type):
+        arr = arr.dictionary_decode()
+    if pa.types.is_integer(arr.type) or pa.types.is_floating(arr.type) or pa.types.is_boolean(arr.type):
+        values = arr.fill_null(False if pa.types.is_boolean(arr.type) else 0).to_numpy(zero_copy_only=False).astype(object)
+        if arr.null_count:
+            values[arr.is_null().to_numpy(zero_copy_only=False)] = None
+        return values
+    if pa.types.is_string(arr.type) or pa.types.is_large_string(arr.type):
+        return arr.to_numpy(zero_copy_only=False)
+    return np.fromiter(arr.to_pylist(), dtype=object, count=len(arr))
+
+
+def columns_from_arrow(batch):
+    names = set(batch.schema.names)
+    cols = {k: arrow_values(batch.column(k)) for k in RAW_FIELDS if k in names}
+    for k in RAW_FIELDS:
+        # nested values stored as JSON text by the Parquet sink
+        if k + NESTED_SUFFIX in names:
+            texts = arrow_values(batch.column(k + NESTED_SUFFIX))
+            nested = not_none(texts)
+            if nested.any():
+                values = cols.setdefault(k, np.full(batch.num_rows, None, dtype=object))
+                values[nested] = map_distinct(json.loads, texts[nested])
+    return cols
+
+
+def truthy(values):
+    return _truthy(values).astype(bool)
+
+
+def not_none(values):
+    return _is_not(values, None).astype(bool)
+
+
+def first_truthy(*columns):
+    # Element-wise `a or b or ...`
+    out = columns[-1]
+    for col in reversed(columns[:-1]):
+        out = np.where(truthy(col), col, out)
+    return out
+
+
+def map_distinct(func, *columns):
+    # func(*values) once per distinct combination of values, broadcast back
+    key = np.zeros(len(columns[0]), dtype=np.int64)
+    for col in columns:
+        codes, uniques = pd.factorize(col)
+        key = key * (len(uniques) + 1) + (codes + 1)
+    codes, _ = pd.factorize(key)
+    first = np.unique(codes, return_index=True)[1]
+    results = np.empty(len(first), dtype=object)
+    results[:] = [func(*args) for args in zip(*(col[first] for col in columns))]
+    return results[codes]
+
+
+def _is_virtual_mac(mac):
+    return isinstance(mac, str) and mac.upper()[:8] in VIRTUAL_OUIS
+
+
+def workload_key(mac, ip, port):
+    # 64-bit workload id: first 8 bytes of SHA-1("mac|ip|port"), signed so it
+    # fits int64 columns (pandas, Parquet, DuckDB BIGINT). Deterministic, so
+    # ids agree across runs, shards and captures.
+    digest = hashlib.sha1("|".join([str(mac), str(ip), str(port)]).encode()).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def _first_query(queries):
+    try:
+        for q in queries.values():
+            if isinstance(q, dict):
+                return q.get('dns.qry.name'), q.get('dns.qry.type'), q.get('dns.qry.name_raw')
+    except Exception:
+        pass
+    return None, None, None
+
+
+@lru_cache(maxsize=65_536)
+def _parse_mdns_queries(text):
+    try:
+        return _first_query(ast.literal_eval(text))
+    except Exception:
+        return None, None, None
+
+
+def first_mdns_query(queries):
+    # (name, type, name_raw) of the first query of an mdns.Queries value.
+    # JSON input carries the dict as its repr string; mDNS repeats the same
+    # few announcements, so each distinct string is parsed once.
+    if isinstance(queries, str):
+        return _parse_mdns_queries(queries)
+    return _first_query(queries)
+
+
+def _startswith_22(value):
+    return str(value).startswith('22')
+
+
+def _as_int(values):
+    # int(v or 0) for tshark number strings / numbers
+    return np.trunc(pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').fillna(0).to_numpy(dtype=float))
+
+
+def classify_flows(src, dst):
+    src_true, dst_true = truthy(src), truthy(dst)
+    both_false = _is(src, False).astype(bool) & _is(dst, False).astype(bool)
+    return np.select(
+        [src_true & ~dst_true, ~src_true & dst_true, src_true & dst_true, both_false],
+        ['internal_to_external', 'external_to_internal', 'internal_only', 'external_only'],
+        'unknown',
+    ).astype(object)
+
+
+def enrich_columns(cols, n, classifier=None):
+    # classifier: ip_classify.IpClassifier, shared across batches for its cache
+    classifier = classifier or IpClassifier()
+    none = np.full(n, None, dtype=object)
+
+    def get(key):
+        return cols.get(key, none)
+
+    epoch = pd.to_numeric(pd.Series(get('frame.frame.time_epoch'), dtype=object), errors='coerce').to_numpy(dtype=float)
+    valid = np.isfinite(epoch)
+    epoch_minute = np.where(valid, np.floor_divide(epoch, 60), np.nan)
+    epoch_second = np.where(valid, np.trunc(epoch), np.nan)
+    if valid.all():
+        epoch_minute, epoch_second = epoch_minute.astype(np.int64), epoch_second.astype(np.int64)
+
+    content_type = get('tls.record.content_type')
+    handshake = np.zeros(n, dtype=bool)
+    present = not_none(content_type)
+    handshake[present] = np.frompyfunc(_startswith_22, 1, 1)(content_type[present]).astype(bool)
+    content_raw = get('tls.record.content_type_raw')
+    for i in np.flatnonzero(not_none(content_raw)):
+        if isinstance(content_raw[i], list):
+            handshake[i] = any(str(ct).startswith('22') for ct in content_raw[i])
+
+    mdns_name, mdns_type, mdns_raw = none, none, none
+    queries = get('mdns.Queries')
+    has_queries = np.flatnonzero(not_none(queries))
+    if len(has_queries):
+        mdns_name, mdns_type, mdns_raw = none.copy(), none.copy(), none.copy()
+        for i in has_queries:
+            mdns_name[i], mdns_type[i], mdns_raw[i] = first_mdns_query(queries[i])
+
+    name_raw = first_truthy(get('dns.qry.name_raw'), mdns_raw)
+    name_raw = np.frompyfunc(lambda v: None if v is None else str(v), 1, 1)(name_raw)
+
+    out = {
+        'capture_id': get('capture_id'),
+        'mac_src': get('eth.eth.src'),
+        'mac_dst': get('eth.eth.dst'),
+        'frame_len': get('frame.frame.len'),
+        'frame_time_epoch': get('frame.frame.time_epoch'),
+        'epoch_minute': epoch_minute,
+        'epoch_second': epoch_second,
+        'ip_proto': get('ip.ip.proto'),
+        'ip_flags': get('ip.ip.flags'),
+        'ip_src': get('ip.ip.src'),
+        'ip_dst': get('ip.ip.dst'),
+        'udp_srcport': get('udp.udp.srcport'),
+        'udp_dstport': get('udp.udp.dstport'),
+        'tcp_srcport': get('tcp.tcp.srcport'),
+        'tcp_dstport': get('tcp.tcp.dstport'),
+        'tls_is_handshake': handshake,
+        'tls_record_version': first_truthy(get('tls.record.version'), get('tls.tls.record.version')),
+        'fix_msg_type': get('fix.fix.msg_type'),
+        'swift_field': get('swift.swift.field'),
+        'iso8583_field': get('iso8583.iso8583.field'),
+        'dns_query': first_truthy(get('dns.qry.name'), get('dns.query.name'), get('dns.questions.name'), mdns_name),
+        'dns_response': first_truthy(get('dns.resp.name'), get('dns.answers.name'), get('dns.a'), get('dns.ns'),
+                                     get('mdns.dns.resp.name')),
+        'dns_query_type': first_truthy(get('dns.qry.type'), mdns_type),
+        'dns_query_name_raw': name_raw,
+        'rtsp_method': get('rtsp.rtsp.method'),
+        'rtp_seq': get('rtp.rtp.seq'),
+        'rtcp_sr': get('rtcp.rtcp.ssrc'),
+        'icmp_type': get('icmp.icmp.type'),
+        'igmp_type': get('igmp.igmp.type'),
+        'arp_src_hw_mac': get('arp.arp.src.hw_mac'),
+    }
+
+    out['src_port'] = first_truthy(out['tcp_srcport'], out['udp_srcport'])
+    out['dst_port'] = first_truthy(out['tcp_dstport'], out['udp_dstport'])
+    out['ip_ttl'] = get('ip.ip.ttl')
+    out['src_is_internal'] = classifier.classify(out['ip_src'])
+    out['dst_is_internal'] = classifier.classify(out['ip_dst'])
+    out['flow_relation'] = classify_flows(out['src_is_internal'], out['dst_is_internal'])
+    out['mac_ip_combo'] = map_distinct(lambda mac, ip: f"{mac}|{ip}", out['mac_src'], out['ip_src'])
+    out['workload_id_src'] = map_distinct(workload_key, out['mac_src'], out['ip_src'], out['src_port']).astype(np.int64)
+    out['workload_id_dst'] = map_distinct(workload_key, out['mac_dst'], out['ip_dst'], out['dst_port']).astype(np.int64)
+    out['is_virtual_machine'] = map_distinct(_is_virtual_mac, out['mac_src']).astype(bool)
+
+    frame_len = _as_int(out['frame_len'])
+    no_tls_version = ~truthy(out['tls_record_version'])
+    out['is_tls_without_http'] = handshake & (out['tcp_dstport'] != 80)
+    out['is_probably_tls_handshake'] = (
+        pd.Series(out['tcp_dstport'], dtype=object).isin([443, 8443, 9443]).to_numpy() &
+        (60 <= frame_len) & (frame_len <= 250) &
+        no_tls_version
+    )
+    out['is_large_frame'] = frame_len > 1400
+    out['is_quic'] = (out['udp_dstport'] == 443) & no_tls_version
+    out['is_dns_query'] = truthy(out['dns_query'])
+    out['is_dns_response'] = truthy(out['dns_response'])
+
+    out['has_tcp'] = not_none(out['tcp_srcport']) | not_none(out['tcp_dstport'])
+    out['has_udp'] = not_none(out['udp_srcport']) | not_none(out['udp_dstport'])
+    for flag, col in (
+        ('has_tls', 'tls_record_version'),
+        ('has_fix', 'fix_msg_type'),
+        ('has_iso8583', 'iso8583_field'),
+        ('has_swift', 'swift_field'),
+        ('has_rtsp', 'rtsp_method'),
+        ('has_rtp', 'rtp_seq'),
+        ('has_rtcp', 'rtcp_sr'),
+        ('has_icmp', 'icmp_type'),
+        ('has_igmp', 'igmp_type'),
+        ('has_arp', 'arp_src_hw_mac'),
+    ):
+        out[flag] = not_none(out[col])
+
+    # Same dtype inference as pd.DataFrame(list_of_entry_dicts)
+    return pd.DataFrame(out).infer_objects()
+
+
+def concat_frames(frames):
+    frames = list(frames)
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True).infer_objects()
+
+
+@contextmanager
+def open_packet_batches(path, batch_rows=65_536, part=None):
+    # Packets of get_data_script.py's JSON array or Parquet dataset as
+    # (columns, row count) batches; part: one part file of the dataset
+    if is_parquet_input(path):
+        batches = open_parquet_dataset(path, part).to_batches(batch_size=batch_rows)
+        yield ((columns_from_arrow(decoded_batch(batch)), batch.num_rows) for batch in batches)
+        return
+
+    import ijson
+    with open(path, 'rb') as f:
+        items = ijson.items(f, 'item')
+        chunks = iter(lambda: list(islice(items, batch_rows)), [])
+        yield ((columns_from_rows(rows), len(rows)) for rows in chunks)
+
+
+def iter_enriched_frames(path, batch_rows, classifier, part=None, dns=None):
+    # Same rows as preprosessing_update.iter_entry_chunks; dns: dns_index.DnsIndex
+    # to add the raw DNS fields of every batch to
+    with open_packet_batches(path, batch_rows, part) as batches:
+        for cols, n in batches:
+            if dns is not None:
+                dns.add(cols, n)
+            yield enrich_columns(cols, n, classifier)
+
+
+def packet_frame(entries):
+    # Packet-level scores and numeric columns, on a chunk from either path
+    # (a DataFrame, or the row-wise entry dicts)
+    df = pd.DataFrame(entries)
+    
+    df['epoch_minute'] = pd.to_numeric(df['epoch_minute'], errors='coerce')
+
+    df['financial_suspect_score'] = (
+        df['is_tls_without_http'].astype(int) * 3 +
+        df['is_large_frame'].astype(int) +
+        df['is_dns_query'].astype(int) +
+        df['is_quic'].astype(int) +
+        pd.Series(df['tcp_dstport'], dtype=object).isin([443, 8443, 8080, 5000, 9000]).astype(int) +
+        pd.Series(df['udp_dstport'], dtype=object).isin([161, 162, 830]).astype(int) +
+        df['fix_msg_type'].notnull().astype(int) * 4 +
+        df['swift_field'].notnull().astype(int) * 4 +
+        df['iso8583_field'].notnull().astype(int) * 4
+    )
+    df['is_likely_financial'] = df['financial_suspect_score'] >= 4
+
+
+    # Ensure numeric conversion
+    df['frame_time_epoch'] = pd.to_numeric(df['frame_time_epoch'], errors='coerce')
+    df['frame_len'] = pd.to_numeric(df['frame_len'], errors='coerce')
+    df['tcp_dstport'] = pd.to_numeric(df['tcp_dstport'], errors='coerce')
+    df['udp_dstport'] = pd.to_numeric(df['udp_dstport'], errors='coerce')
+    return df
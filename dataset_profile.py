@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Column profile of a Parquet output from its file metadata.
+
+profile_dataset gives, per column, the row count, null count, min, max and
+an estimate of the distinct values of a Parquet file or dataset directory,
+and reads only the footers: null counts and min/max come from the row-group
+statistics. Footers hold no distinct counts, and nested columns
+(artifact_type_ranked) only leaf-level statistics, so write_compact also
+stores a ColumnSketches summary in the file's key-value metadata: per
+column the null count and a HyperLogLog of the values (the 2**HLL_P
+registers of sketches.py, error about 1.6%). Sketches of several files
+merge register-wise.
+
+Files written by DuckDB COPY (star and partitioned layouts) carry no
+sketches; their profile has footer statistics only (distinct_estimate is
+missing, as is anything a footer lacks).
+"""
+
+import base64
+import json
+import zlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from sketches import hll_estimate, hll_registers
+from workload_report import dataset_files
+
+
+SKETCH_KEY = b'column_sketches'
+PROFILE_COLUMNS = ['column', 'rows', 'null_count', 'min', 'max', 'distinct_estimate']
+
+
+def _value_hashes(col):
+    # 64-bit hashes of the distinct non-null values (None for nested types)
+    if pa.types.is_nested(col.type):
+        return None
+    values = pc.unique(col)
+    if pa.types.is_dictionary(values.type):
+        values = values.cast(values.type.value_type)
+    values = values.drop_null()
+    return pd.util.hash_array(values.to_numpy(zero_copy_only=False), categorize=False)
+
+
+class ColumnSketches:
+    # Null count and HyperLogLog registers per column, updated batch by batch
+
+    def __init__(self):
+        self.nulls = {}
+        self.registers = {}
+
+    def update(self, batch):
+        for name, col in zip(batch.schema.names, batch.columns):
+            self.nulls[name] = self.nulls.get(name, 0) + col.null_count
+            hashes = _value_hashes(col)
+            if hashes is not None:
+                self._merge_registers(name, hll_registers(hashes))
+
+    def _merge_registers(self, name, registers):
+        known = self.registers.get(name)
+        self.registers[name] = registers if known is None else np.maximum(known, registers)
+
+    def merge(self, other):
+        for name, n in other.nulls.items():
+            self.nulls[name] = self.nulls.get(name, 0) + n
+        for name, registers in other.registers.items():
+            self._merge_registers(name, registers)
+
+    def metadata(self):
+        sketches = {name: {'nulls': n} for name, n in self.nulls.items()}
+        for name, registers in self.registers.items():
+            sketches[name]['hll'] = base64.b64encode(zlib.compress(registers.tobytes())).decode('ascii')
+        return {SKETCH_KEY: json.dumps(sketches)}
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        # None when the file was written without sketches
+        if not metadata or SKETCH_KEY not in metadata:
+            return None
+        sketches = cls()
+        for name, entry in json.loads(metadata[SKETCH_KEY]).items():
+            sketches.nulls[name] = entry['nulls']
+            if 'hll' in entry:
+                sketches.registers[name] = np.frombuffer(zlib.decompress(base64.b64decode(entry['hll'])),
+                                                         dtype=np.uint8)
+        return sketches
+
+
+def _footer_stats(md, j):
+    # (null count, min, max) of leaf column j over all row groups; None where unknown
+    nulls, lo, hi = 0, None, None
+    for i in range(md.num_row_groups):
+        stats = md.row_group(i).column(j).statistics
+        if stats is None or stats.null_count is None:
+            nulls = None
+        elif nulls is not None:
+            nulls += stats.null_count
+        if stats is not None and stats.has_min_max:
+            lo = stats.min if lo is None else min(lo, stats.min)
+            hi = stats.max if hi is None else max(hi, stats.max)
+    return nulls, lo, hi
+
+
+def profile_dataset(path):
+    # DataFrame PROFILE_COLUMNS, one row per column, from footers and sketches
+    columns = {}
+    total_rows = 0
+    for f in dataset_files(path):
+        md = pq.read_metadata(f)
+        sketches = ColumnSketches.from_metadata(md.metadata)
+        names = md.schema.to_arrow_schema().names
+        leaves = {md.schema.column(j).path: j for j in range(md.num_columns)}
+        for name in names:
+            col = columns.setdefault(name, {'rows': total_rows, 'null_count': total_rows, 'min': None,
+                                            'max': None, 'registers': None, 'sketched': True})
+            nulls = lo = hi = None
+            if name in leaves:
+                nulls, lo, hi = _footer_stats(md, leaves[name])
+            if sketches is not None and name in sketches.nulls:
+                nulls = sketches.nulls[name]
+            col['rows'] += md.num_rows
+            col['null_count'] = None if nulls is None or col['null_count'] is None else col['null_count'] + nulls
+            if lo is not None:
+                col['min'] = lo if col['min'] is None else min(col['min'], lo)
+                col['max'] = hi if col['max'] is None else max(col['max'], hi)
+            registers = None if sketches is None else sketches.registers.get(name)
+            if registers is None:
+                if nulls != md.num_rows:  # an all-null part adds no values
+                    col['sketched'] = False
+            else:
+                col['registers'] = registers if col['registers'] is None else np.maximum(col['registers'],
+                                                                                        registers)
+        for name, col in columns.items():
+            if name not in names:  # column missing from this file: all null there
+                col['rows'] += md.num_rows
+                if col['null_count'] is not None:
+                    col['null_count'] += md.num_rows
+        total_rows += md.num_rows
+
+    rows = []
+    for name, col in columns.items():
+        if col['null_count'] == col['rows']:
+            distinct = 0
+        elif col['sketched'] and col['registers'] is not None:
+            distinct = hll_estimate(col['registers'])
+        else:
+            distinct = None
+        rows.append([name, col['rows'], col['null_count'], col['min'], col['max'], distinct])
+    profile = pd.DataFrame(rows, columns=PROFILE_COLUMNS)
+    for name in ('null_count', 'distinct_estimate'):
+        profile[name] = profile[name].astype('Int64')
+    return profile
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+DNS / mDNS name side index: which names were seen for which IP address.
+
+DnsIndex is filled during ingestion from the raw DNS fields of each chunk
+(the packet table keeps only the first query/response name) and reduced to
+one row per (ip, name, role, query_type) with packets, first_seen and
+last_seen (epoch seconds). role is
+- 'answer': a DNS response resolved name to ip (dns.a),
+- 'mdns': ip announced name in an mDNS response,
+- 'query': ip asked for name and the packet carried no answer.
+Names are lower-case without the trailing dot. The index is a few rows per
+host, merges across chunks, shards and runs (sum / min / max), and is kept
+as a Parquet table next to the workload id lookup (upsert_dns_index).
+
+dns_lookup queries it by address or name; hostnames gives one row per
+address ('answer' and 'mdns' names, most seen first), and attach_hostnames /
+workload_hostnames join that onto the workload_ids table, the graph nodes of
+method_pipeline.py or any frame with an IP column, without a packet scan.
+"""
+
+import os
+
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from columnar_enrich import first_mdns_query, first_truthy, not_none, truthy
+
+
+INDEX_KEY = ['ip', 'name', 'role', 'query_type']
+INDEX_COLUMNS = INDEX_KEY + ['packets', 'first_seen', 'last_seen']
+HOSTNAME_ROLES = ('answer', 'mdns')
+
+
+def _name(value):
+    if isinstance(value, list):  # several records: tshark gives a list
+        value = value[0] if value else None
+    if value is None or value != value:
+        return None
+    name = str(value).rstrip('.').lower()
+    return name or None
+
+
+def _text(value):
+    if value is None or value != value:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def _address(value):
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return _text(value) or None
+
+
+_names = np.frompyfunc(_name, 1, 1)
+_texts = np.frompyfunc(_text, 1, 1)
+_addresses = np.frompyfunc(_address, 1, 1)
+
+
+DNS_FIELDS = ['dns.a', 'dns.qry.name', 'dns.query.name', 'dns.questions.name', 'dns.resp.name', 'dns.answers.name',
+              'mdns.Queries', 'mdns.dns.resp.name']
+
+
+def dns_observations(cols, n):
+    # INDEX_COLUMNS for one chunk of raw packet columns (columns_from_rows /
+    # columns_from_arrow); only the packets carrying a DNS field are decoded
+    rows = np.zeros(n, dtype=bool)
+    for key in DNS_FIELDS:
+        if key in cols:
+            rows |= not_none(cols[key])
+    rows = np.flatnonzero(rows)
+    if not len(rows):
+        return pd.DataFrame(columns=INDEX_COLUMNS)
+    none = np.full(len(rows), None, dtype=object)
+
+    def get(key):
+        return cols[key][rows] if key in cols else none
+
+    mdns_name, mdns_type = none, none
+    queries = get('mdns.Queries')
+    has_queries = np.flatnonzero(not_none(queries))
+    if len(has_queries):
+        mdns_name, mdns_type = none.copy(), none.copy()
+        for i in has_queries:
+            mdns_name[i], mdns_type[i], _ = first_mdns_query(queries[i])
+
+    src = _addresses(get('ip.ip.src'))
+    answer = _addresses(get('dns.a'))
+    qname = _names(first_truthy(get('dns.qry.name'), get('dns.query.name'), get('dns.questions.name'),
+                                mdns_name))
+    rname = _names(first_truthy(get('dns.resp.name'), get('dns.answers.name')))
+    mdns_resp = _names(get('mdns.dns.resp.name'))
+    qtype = _texts(first_truthy(get('dns.qry.type'), mdns_type))
+    epoch = pd.to_numeric(pd.Series(get('frame.frame.time_epoch'), dtype=object), errors='coerce').to_numpy(dtype=float)
+
+    answered = not_none(answer)
+    name = first_truthy(rname, qname)
+    parts = [
+        ('answer', answer, name, answered & not_none(name)),
+        ('mdns', src, mdns_resp, not_none(src) & not_none(mdns_resp)),
+        ('query', src, qname, not_none(src) & not_none(qname) & ~answered & ~truthy(rname)),
+    ]
+    frames = [pd.DataFrame({'ip': ip[keep], 'name': names[keep], 'role': role, 'query_type': qtype[keep],
+                            'epoch': epoch[keep]})
+              for role, ip, names, keep in parts if keep.any()]
+    if not frames:
+        return pd.DataFrame(columns=INDEX_COLUMNS)
+    obs = pd.concat(frames, ignore_index=True)
+    return (obs.groupby(INDEX_KEY, dropna=False, sort=False)['epoch']
+            .agg(packets='size', first_seen='min', last_seen='max').reset_index())
+
+
+def merge_observations(tables):
+    tables = [t for t in tables if t is not None and len(t)]
+    if not tables:
+        return pd.DataFrame(columns=INDEX_COLUMNS)
+    merged = pd.concat(tables, ignore_index=True)
+    return (merged.groupby(INDEX_KEY, dropna=False, sort=False)
+            .agg(packets=('packets', 'sum'), first_seen=('first_seen', 'min'), last_seen=('last_seen', 'max'))
+            .reset_index())
+
+
+class DnsIndex:
+    # Running dns_observations over the chunks of a build; table is a plain
+    # DataFrame, so a worker returns it and the parent merges it
+
+    def __init__(self):
+        self.table = None
+
+    def add(self, cols, n):
+        self.merge(dns_observations(cols, n))
+
+    def merge(self, table):
+        if table is not None and len(table):
+            self.table = table if self.table is None else merge_observations([self.table, table])
+
+
+def upsert_dns_index(path, table):
+    if table is None or not len(table):
+        return
+    if os.path.exists(path):
+        table = merge_observations([pd.read_parquet(path), table])
+    table = table.sort_values(['ip', 'name', 'role'], kind='stable', ignore_index=True)
+    arrow = pa.table({
+        'ip': pa.Array.from_pandas(table['ip'], type=pa.string()),
+        'name': pa.Array.from_pandas(table['name'], type=pa.string()),
+        'role': pa.Array.from_pandas(table['role'], type=pa.string()).dictionary_encode(),
+        'query_type': pa.Array.from_pandas(table['query_type'], type=pa.string()),
+        'packets': pa.Array.from_pandas(table['packets'], type=pa.int64()),
+        'first_seen': pa.Array.from_pandas(table['first_seen'], type=pa.float64()),
+        'last_seen': pa.Array.from_pandas(table['last_seen'], type=pa.float64()),
+    })
+    pq.write_table(arrow, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def dns_lookup(path, ip=None, name=None, con=None):
+    # Index rows for an address and/or a name (SQL LIKE pattern, e.g. '%.example.com'),
+    # most seen first
+    con = con or duckdb.connect()
+    where, params = [], []
+    if ip is not None:
+        where.append("ip = ?")
+        params.append(ip)
+    if name is not None:
+        where.append("name LIKE ?")
+        params.append(name.rstrip('.').lower())
+    sql = f"SELECT * FROM read_parquet('{path}')"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return con.execute(sql + " ORDER BY packets DESC, ip, name", params).df()
+
+
+HOSTNAMES_SQL = """
+    SELECT ip,
+           first(name ORDER BY packets DESC, name) AS hostname,
+           string_agg(name, ', ' ORDER BY packets DESC, name) AS hostnames,
+           MIN(first_seen) AS dns_first_seen,
+           MAX(last_seen) AS dns_last_seen
+    FROM (
+        SELECT ip, name, SUM(packets) AS packets, MIN(first_seen) AS first_seen, MAX(last_seen) AS last_seen
+        FROM read_parquet('{path}')
+        WHERE role IN ({roles})
+        GROUP BY ip, name
+    )
+    GROUP BY ip
+"""
+
+
+def hostnames(path, con=None):
+    # One row per address: hostname (most seen), hostnames, dns_first_seen, dns_last_seen
+    con = con or duckdb.connect()
+    roles = ', '.join(f"'{r}'" for r in HOSTNAME_ROLES)
+    return con.execute(HOSTNAMES_SQL.format(path=path, roles=roles)).df()
+
+
+def attach_hostnames(df, path, ip_column='ip'):
+    # df with the hostname columns of its ip_column joined on (missing when
+    # no name was seen for the address)
+    names = hostnames(path).rename(columns={'ip': ip_column})
+    return df.merge(names, on=ip_column, how='left')
+
+
+def workload_hostnames(workload_ids_path, path, con=None):
+    # The workload_ids table (workload_id, mac, ip, port) with the hostnames of its ip
+    con = con or duckdb.connect()
+    roles = ', '.join(f"'{r}'" for r in HOSTNAME_ROLES)
+    return con.execute(f"""
+        SELECT w.*, h.hostname, h.hostnames, h.dns_first_seen, h.dns_last_seen
+        FROM read_parquet('{workload_ids_path}') w
+        LEFT JOIN ({HOSTNAMES_SQL.format(path=path, roles=roles)}) h USING (ip)
+        ORDER BY w.workload_id
+    """).df()
@@ -3,14 +3,32 @@
 Created on Tue May  6 19:54:49 2025
 
 @author: baroc
+
+Every extraction_mode fills the tshark_fields columns under the same names:
+"fields" and "native" ask tshark for them, "json" takes them from the
+dissection tree, where tshark nests some of them (dns.qry.*, dns.a,
+tls.record.*) under Queries / Answers / record objects; the first occurrence
+is used, as with -E occurrence=f. "json" additionally keeps every top-level
+field of the allowed protocols as "<proto>.<field>" (nested objects as their
+string), which the other modes do not produce.
 """
 
 import subprocess
 import json
 import os
 import glob
+import io
+import queue
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm.auto import tqdm
 
+import pcap_reader
+from ingest_manifest import IngestManifest, capture_id_for, file_digest, source_signature
+from ingest_sinks import open_shard_sink, prune_parquet_parts, stitch_json_shards, upsert_capture_table
+
 
 # === CONFIG ===
 tshark_path = r"C:\\Program Files\\Wireshark\\tshark.exe"
@@ -22,15 +40,123 @@ batch_dir = "batches"
 output_json = "full_capture_bigFlows.json"
 batch_size = 1000
 
+# "json"    -> one "[ {...}, ... ]" file at output_json
+# "parquet" -> typed, dictionary-encoded Parquet dataset at output_parquet_dir
+output_format = "json"
+output_parquet_dir = "full_capture_bigFlows_parquet"
+
+# Resumable ingestion: every batch is decoded into its own shard and recorded
+# in the manifest; reruns only decode missing/changed batches.
+manifest_path = "ingest_manifest_bigFlows.json"
+shard_dir = "shards_bigFlows"  # JSON-lines shards (Parquet parts go to output_parquet_dir)
+
+# capinfos metadata is stored once per capture here (keyed by capture_id);
+# packet rows only carry the capture_id column
+capture_table = "captures.parquet"
+
+# Parallel decoding: tshark runs as a separate process, so threads are enough
+# to keep several decoders busy. max_pending_batches caps how many batches
+# may be in flight or decoded-but-unwritten at once (backpressure).
+num_workers = os.cpu_count() or 1
+max_pending_batches = 2 * num_workers
+
+# Rows are streamed from tshark's stdout to the writer in chunks; each batch
+# buffers at most max_buffered_chunks chunks, so memory stays bounded
+# regardless of batch_size.
+stream_chunk_rows = 500
+max_buffered_chunks = 4
+
+# "json"   -> full dissection tree + hex dump (-T json -x), flattened afterwards
+# "fields" -> only the columns listed in tshark_fields (-T fields -e ...)
+# "native" -> L2-L4 columns decoded by pcap_reader straight from the capture;
+#             tshark only sees the packets on deep_dissection_ports and only
+#             extracts the tshark_fields pcap_reader cannot produce
+extraction_mode = "json"
+
+# DNS, mDNS, TLS/QUIC, RTSP. Add site-specific FIX/SWIFT/ISO8583 ports here.
+deep_dissection_ports = {53, 5353, 443, 8443, 9443, 554}
+
+# "virtual" -> index the capture once and pipe byte ranges of it (virtual
+#              shards) straight from the memory map into tshark
+# "editcap" -> physically split into batch_dir with editcap -c batch_size
+sharding = "virtual"
+# Packets per virtual shard / native chunk. None: about 4 shards per worker.
+shard_packets = None
+
+# Flattened column name (as read by preprosessing_update) -> tshark field
+tshark_fields = {
+    "frame.frame.time_epoch": "frame.time_epoch",
+    "frame.frame.len": "frame.len",
+    "eth.eth.src": "eth.src",
+    "eth.eth.dst": "eth.dst",
+    "ip.ip.proto": "ip.proto",
+    "ip.ip.flags": "ip.flags",
+    "ip.ip.src": "ip.src",
+    "ip.ip.dst": "ip.dst",
+    "ip.ip.ttl": "ip.ttl",
+    "udp.udp.srcport": "udp.srcport",
+    "udp.udp.dstport": "udp.dstport",
+    "tcp.tcp.srcport": "tcp.srcport",
+    "tcp.tcp.dstport": "tcp.dstport",
+    "tls.record.content_type": "tls.record.content_type",
+    "tls.tls.record.version": "tls.record.version",
+    "fix.fix.msg_type": "fix.MsgType",
+    "swift.swift.field": "swift.field",
+    "iso8583.iso8583.field": "iso8583.field",
+    "dns.qry.name": "dns.qry.name",
+    "dns.qry.type": "dns.qry.type",
+    "dns.resp.name": "dns.resp.name",
+    "dns.a": "dns.a",
+    "dns.ns": "dns.ns",
+    "rtsp.rtsp.method": "rtsp.method",
+    "rtp.rtp.seq": "rtp.seq",
+    "rtcp.rtcp.ssrc": "rtcp.senderssrc",
+    "icmp.icmp.type": "icmp.type",
+    "igmp.igmp.type": "igmp.type",
+    "arp.arp.src.hw_mac": "arp.src.hw_mac",
+}
+
 os.makedirs(batch_dir, exist_ok=True)
+os.makedirs(shard_dir, exist_ok=True)
 
-# === Step 1: Split PCAP ===
-split_pattern = os.path.join(batch_dir, "batch_%03d.pcap")
-if not glob.glob(os.path.join(batch_dir, "*.pcap")):
-    print("Splitting PCAP...")
-    subprocess.run([editcap_path, "-c", str(batch_size), pcap_file, split_pattern])
+use_editcap = sharding == "editcap" and extraction_mode != "native"
+
+# === Step 1: Index or split PCAP ===
+if use_editcap:
+    batch_rows = batch_size
 else:
-    print("Batches already exist — skipping split.")
+    print("Indexing PCAP...")
+    capture_index = pcap_reader.build_index(pcap_file)
+    batch_rows = shard_packets or min(max(-(-capture_index['count'] // (num_workers * 4)), 1000), 200_000)
+    print(f"{capture_index['count']} packets — virtual shards of {batch_rows} packets.")
+
+capture_id = capture_id_for(pcap_file)
+capture_columns = {"capture_id": capture_id}
+
+manifest = IngestManifest(manifest_path, {
+    'capture_id': capture_id,
+    'extraction_mode': extraction_mode,
+    'output_format': output_format,
+    'tshark_fields': tshark_fields if extraction_mode != "json" else None,
+    'deep_dissection_ports': deep_dissection_ports if extraction_mode == "native" else None,
+    'sharding': "editcap" if use_editcap else "virtual",
+    'batch_rows': batch_rows,
+})
+
+source = source_signature(pcap_file)
+if use_editcap:
+    split_pattern = os.path.join(batch_dir, "batch_%03d.pcap")
+    existing_batches = glob.glob(os.path.join(batch_dir, "*.pcap"))
+    if not existing_batches or manifest.source_changed(source):
+        if existing_batches:
+            print("Capture changed since the last split — re-splitting.")
+            for old in existing_batches:
+                os.remove(old)
+        print("Splitting PCAP...")
+        subprocess.run([editcap_path, "-c", str(batch_size), pcap_file, split_pattern])
+    else:
+        print("Batches already exist — skipping split.")
+manifest.set_source(source)
 
 # === Step 2: Global metadata (excluding file_name) ===
 capinfos_result = subprocess.run(
@@ -48,8 +174,14 @@ file_metadata = {
 }
 file_metadata.pop("file_name", None)
 
+upsert_capture_table(capture_table, {
+    "capture_id": capture_id,
+    "capture_path": os.path.abspath(pcap_file),
+    **file_metadata,
+})
+
 # === Helper to flatten packets ===
-def flatten_packet(pkt, file_metadata):
+def flatten_packet(pkt, capture_columns):
     row = {}
     layers = pkt.get("_source", {}).get("layers", {})
 
@@ -96,60 +228,343 @@ def flatten_packet(pkt, file_metadata):
                 col = f"{proto}.{key}"
                 row[col] = str(value[0]) if isinstance(value, list) else str(value)
 
-    row.update(file_metadata)
+    for col, field in tshark_fields.items():
+        if col not in row:
+            value = first_nested(layers.get(field.split('.')[0]), field)
+            if value is not None:
+                row[col] = str(value)
+
+    row.update(capture_columns)
     return row
 
-# === Step 3: Process and stream-write packets ===
-batch_files = sorted(glob.glob(os.path.join(batch_dir, "*.pcap")))
-
-print("Processing batches and writing packets to JSON...")
-
-with open(output_json, "w", encoding="utf-8") as out_f:
-    out_f.write("[\n")
-    first = True
-
-    for batch_num, batch_file in enumerate(batch_files):
-        print(f"\nBatch {batch_num + 1}/{len(batch_files)}: {os.path.basename(batch_file)}")
-
-        result = subprocess.run(
-            [
-                tshark_path,
-                "-r", batch_file,
-                "-T", "json",
-                "-x",
-                "-n",
-                "-s", "0",
-                "-d", "udp.port==53,dns",
-                "-d", "udp.port==443,quic",
-                "-d", "tcp.port==443,tls",
-                "--enable-protocol", "dns",
-                "--enable-protocol", "quic",
-                "--enable-protocol", "tls"
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-
-        stdout = result.stdout.decode('utf-8', errors='replace')
-
-        if not stdout.strip():
-            print("Empty batch — skipping.")
+def first_nested(node, field):
+    # First value of field anywhere in a layer of the tshark JSON tree
+    if isinstance(node, list):
+        for item in node:
+            value = first_nested(item, field)
+            if value is not None:
+                return value
+        return None
+    if not isinstance(node, dict):
+        return None
+    if field in node:
+        value = node[field]
+        return (value[0] if value else None) if isinstance(value, list) else value
+    for value in node.values():
+        if isinstance(value, (dict, list)):
+            value = first_nested(value, field)
+            if value is not None:
+                return value
+    return None
+
+# === Step 3: Decode batches (worker pool) ===
+decode_options = [
+    "-n",
+    "-d", "udp.port==53,dns",
+    "-d", "udp.port==443,quic",
+    "-d", "tcp.port==443,tls",
+    "--enable-protocol", "dns",
+    "--enable-protocol", "quic",
+    "--enable-protocol", "tls"
+]
+
+def available_tshark_fields():
+    result = subprocess.run([tshark_path, "-G", "fields"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    fields = set()
+    for line in result.stdout.decode('utf-8', errors='replace').splitlines():
+        parts = line.split('\t')
+        if len(parts) > 2 and parts[0] == 'F':
+            fields.add(parts[2])
+    return fields
+
+def select_tshark_fields(requested):
+    # tshark aborts on unknown -e fields (e.g. dissectors missing from this build)
+    known = available_tshark_fields()
+    selected = {col: field for col, field in requested.items() if field in known}
+    for col, field in requested.items():
+        if field not in known:
+            print(f"tshark has no field '{field}' — dropping column {col}.")
+    return selected
+
+def tshark_command(batch_input, fields=None):
+    # batch_input: a batch file, or a virtual shard (path, byte_start,
+    # byte_stop) that is fed to tshark on stdin
+    source = "-" if isinstance(batch_input, tuple) else batch_input
+    if fields is None:
+        return [tshark_path, "-r", source, "-T", "json", "-x", "-s", "0"] + decode_options
+
+    cmd = [tshark_path, "-r", source, "-T", "fields",
+           "-E", "separator=/t", "-E", "occurrence=f", "-E", "quote=n", "-E", "header=n"]
+    for field in fields.values():
+        cmd += ["-e", field]
+    return cmd + decode_options
+
+def iter_json_packets(lines, stats):
+    # tshark -T json prints one packet object per "  {" ... "  }" block, so each
+    # packet can be parsed on its own and a malformed one is skipped alone.
+    chunk = None
+    for line in lines:
+        stripped = line.rstrip('\r\n')
+        if chunk is None:
+            if stripped == '  {':
+                chunk = [stripped]
             continue
+        chunk.append(stripped)
+        if stripped in ('  }', '  },'):
+            text = '\n'.join(chunk).rstrip(',')
+            chunk = None
+            try:
+                yield json.loads(text)
+            except json.JSONDecodeError:
+                stats['malformed'] += 1
+    if chunk is not None:
+        stats['malformed'] += 1  # truncated output (tshark died mid-packet)
 
-        try:
-            packets = json.loads(stdout)
-        except json.JSONDecodeError:
-            print("JSON error — skipping.")
+def iter_field_rows(lines, fields, capture_columns):
+    columns = list(fields)
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:
             continue
+        row = {col: value for col, value in zip(columns, line.split('\t')) if value != ''}
+        row.update(capture_columns)
+        yield row
+
+def feed_shard(shard, stdin):
+    path, start, stop = shard
+    try:
+        pcap_reader.stream_shard(path, start, stop, stdin)
+    except OSError:
+        pass  # tshark went away (killed or crashed); reported by the reader
+    finally:
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+def iter_batch_rows(batch_input, fields, stats):
+    # A non-zero tshark exit after its output ends (crash, truncated or bad
+    # batch) sets stats['error'], so the manifest records the batch as failed
+    shard = batch_input if isinstance(batch_input, tuple) else None
+    stderr = tempfile.TemporaryFile()
+    proc = subprocess.Popen(
+        tshark_command(batch_input, fields),
+        stdin=subprocess.PIPE if shard else None,
+        stdout=subprocess.PIPE,
+        stderr=stderr
+    )
+    if shard:
+        threading.Thread(target=feed_shard, args=(shard, proc.stdin), daemon=True).start()
+    lines = io.TextIOWrapper(proc.stdout, encoding='utf-8', errors='replace')
+    finished = False
+    try:
+        if fields is not None:
+            yield from iter_field_rows(lines, fields, capture_columns)
+        else:
+            for pkt in iter_json_packets(lines, stats):
+                yield flatten_packet(pkt, capture_columns)
+        finished = True
+    finally:
+        lines.close()
+        if not finished and proc.poll() is None:
+            proc.kill()  # aborted early: the rows are not wanted
+        returncode = proc.wait()
+        if finished and returncode != 0:
+            stderr.seek(0)
+            tail = stderr.read().decode('utf-8', errors='replace').strip()[-500:]
+            stats['error'] = f"tshark exited {returncode}" + (f": {tail}" if tail else "")
+        stderr.close()
+
+_BATCH_DONE = object()
+
+def put_or_cancel(q, item, cancel):
+    while not cancel.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def decode_batch(batch_file, fields, q, cancel):
+    # Runs on a worker thread: streams rows into q in chunks, then a sentinel.
+    stats = {'rows': 0, 'malformed': 0, 'error': None}
+    chunk = []
+    try:
+        for row in iter_batch_rows(batch_file, fields, stats):
+            chunk.append(row)
+            stats['rows'] += 1
+            if len(chunk) >= stream_chunk_rows:
+                if not put_or_cancel(q, chunk, cancel):
+                    return
+                chunk = []
+        if chunk:
+            put_or_cancel(q, chunk, cancel)
+    except Exception as e:
+        stats['error'] = repr(e)
+    finally:
+        put_or_cancel(q, (_BATCH_DONE, stats), cancel)
+
+
+def iter_queue(q, stats_out):
+    while True:
+        item = q.get()
+        if isinstance(item, tuple) and item and item[0] is _BATCH_DONE:
+            stats_out.update(item[1])
+            return
+        yield from item
+
+
+def decode_batches_in_order(batch_files, workers, max_pending, fields=None):
+    # Yields (batch_file, rows, stats) in the original batch order, where rows
+    # is an iterator fed by the worker while the writer consumes it. A new
+    # decode is only submitted when the writer moves on to the next batch, so
+    # at most max_pending batches are in flight, each holding no more than
+    # max_buffered_chunks chunks, no matter how slow the writer is. stats is
+    # filled in once rows is exhausted.
+    max_pending = max(max_pending, 1)
+    files = iter(batch_files)
+    pending = deque()
+    cancel = threading.Event()
+
+    def submit(pool, batch_file):
+        q = queue.Queue(maxsize=max_buffered_chunks)
+        pool.submit(decode_batch, batch_file, fields, q, cancel)
+        pending.append((batch_file, q))
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        try:
+            for batch_file in files:
+                submit(pool, batch_file)
+                if len(pending) >= max_pending:
+                    break
+
+            while pending:
+                batch_file, q = pending.popleft()
+                next_file = next(files, None)
+                if next_file is not None:
+                    submit(pool, next_file)
+                stats = {}
+                yield batch_file, iter_queue(q, stats), stats
+        finally:
+            cancel.set()
+
+
+def decode_native_chunk(chunk, deep_fields, subset_path):
+    # L2-L4 rows from pcap_reader, then the deep-dissection columns from tshark
+    # for just the packets that need them (matched back via frame.number).
+    stats = {'rows': 0, 'malformed': 0, 'error': None, 'deep': 0}
+    rows = list(pcap_reader.iter_rows(chunk, capture_columns))
+    stats['rows'] = len(rows)
+
+    deep = pcap_reader.select_deep_frames(chunk, deep_dissection_ports)
+    if not deep or not deep_fields:
+        return rows, stats
+
+    position = {chunk['record_offset'][i]: i for i in deep}
+    written = pcap_reader.write_pcap_subset(pcap_file, list(position), subset_path)
+    fields = {'frame.frame.number': 'frame.number', **deep_fields}
+    try:
+        for deep_row in iter_batch_rows(subset_path, fields, stats):
+            frame_number = int(deep_row.pop('frame.frame.number', 0))
+            if 0 < frame_number <= len(written):
+                rows[position[written[frame_number - 1]]].update(deep_row)
+                stats['deep'] += 1
+    finally:
+        os.remove(subset_path)
+    return rows, stats
 
-        for pkt in tqdm(packets, desc=f"Batch {batch_num + 1}", unit="pkt"):
-            row = flatten_packet(pkt, file_metadata)
-            if not first:
-                out_f.write(",\n")
-            else:
-                first = False
-            json.dump(row, out_f)
 
-    out_f.write("\n]\n")
+def decode_native_in_order(deep_fields, batches):
+    subset_path = os.path.join(batch_dir, "deep_subset.pcap")
+    for batch in batches:
+        start, stop = batch['byte_range']
+        count = batch['packet_range'][1] - batch['packet_range'][0]
+        for chunk in pcap_reader.iter_column_chunks(pcap_file, max(count, 1), start, stop):
+            rows, stats = decode_native_chunk(chunk, deep_fields, subset_path)
+            yield batch['input'], iter(rows), stats
+
+
+# === Step 4: Plan batches against the manifest ===
+def plan_tshark_batches(batch_files):
+    batches = []
+    first = 0
+    for i, batch_file in enumerate(batch_files):
+        count = pcap_reader.count_records(batch_file)
+        batches.append({
+            'batch_id': f"batch_{i:05d}",
+            'source': pcap_file,
+            'input': batch_file,
+            'packet_range': [first, first + count],
+            'byte_range': [0, os.path.getsize(batch_file)],
+            'digest': file_digest(batch_file),
+        })
+        first += count
+    return batches
+
+def plan_virtual_batches():
+    return [
+        {
+            'batch_id': f"batch_{i:05d}",
+            'source': pcap_file,
+            'input': (pcap_file, start, stop),
+            'packet_range': [first, first + count],
+            'byte_range': [start, stop],
+            'digest': file_digest(pcap_file, start, stop),
+        }
+        for i, (first, count, start, stop) in enumerate(pcap_reader.shard_ranges(capture_index, batch_rows))
+    ]
+
+if use_editcap:
+    plan = plan_tshark_batches(sorted(glob.glob(os.path.join(batch_dir, "*.pcap"))))
+else:
+    plan = plan_virtual_batches()
+
+todo = [batch for batch in plan if not manifest.is_current(batch)]
+print(f"{len(plan) - len(todo)}/{len(plan)} batches up to date — decoding {len(todo)}.")
+
+if extraction_mode == "native":
+    deep_fields = {col: field for col, field in select_tshark_fields(tshark_fields).items()
+                   if col not in pcap_reader.NATIVE_COLUMNS}
+    decoded = decode_native_in_order(deep_fields, todo)
+else:
+    fields = select_tshark_fields(tshark_fields) if extraction_mode == "fields" else None
+    decoded = decode_batches_in_order([batch['input'] for batch in todo], num_workers, max_pending_batches, fields)
+
+# === Step 5: Decode pending batches into shards ===
+output_path = output_parquet_dir if output_format == "parquet" else output_json
+shard_out = output_parquet_dir if output_format == "parquet" else shard_dir
+print(f"Processing batches ({extraction_mode} mode) and writing packets to {output_format}...")
+
+try:
+    for batch_num, (batch, (_, rows, stats)) in enumerate(zip(todo, decoded)):
+        print("\nBatch {}/{}: {} (packets {}-{})".format(batch_num + 1, len(todo), batch['batch_id'], *batch['packet_range']))
+
+        manifest.start(batch)
+        sink = open_shard_sink(output_format, shard_out, batch['batch_id'], {"pcap.capture_id": capture_id})
+        written = 0
+        for row in tqdm(rows, desc=f"Batch {batch_num + 1}", unit="pkt"):
+            sink.write(row)
+            written += 1
+        sink.close()
+        stats['rows'] = written
+        if stats.get('error'):
+            print(f"tshark error — batch truncated, will be decoded again on the next run: {stats['error']}")
+        manifest.complete(batch['batch_id'], sink.outputs, stats)
+
+        if stats.get('malformed'):
+            print(f"{stats['malformed']} malformed packets skipped.")
+        if not written:
+            print("Empty batch — skipping.")
+finally:
+    manifest.retain([batch['batch_id'] for batch in plan])
+    manifest.save()
+
+# === Step 6: Stitch shards into the output ===
+outputs = list(manifest.outputs(batch['batch_id'] for batch in plan))
+if output_format == "parquet":
+    prune_parquet_parts(output_parquet_dir, outputs)
+else:
+    stitch_json_shards(outputs, output_json)
 
-print(f"\n JSON saved to: {output_json}")
+print(f"\n Output saved to: {output_path}")
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Ingestion manifest for get_data_script.py.
+
+Records, per batch, where it comes from (source capture, packet and byte
+range), a content hash, the shard it was decoded into and whether that
+shard is complete. A rerun only decodes batches that are missing, failed
+or whose content changed, then re-stitches the output from the shards.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+
+def file_digest(path, start=0, stop=None, block_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = None if stop is None else stop - start
+        while remaining is None or remaining > 0:
+            block = f.read(block_size if remaining is None else min(block_size, remaining))
+            if not block:
+                break
+            h.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return h.hexdigest()
+
+
+def capture_id_for(path):
+    # Stable id for a capture: size + hash of its first MiB. Survives copies
+    # and renames, so shards and tables from different runs still join.
+    size = os.path.getsize(path)
+    return hashlib.sha1(f"{size}|{file_digest(path, 0, 1 << 20)}".encode()).hexdigest()[:16]
+
+
+def source_signature(path):
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+
+class IngestManifest:
+    # settings: anything that changes the decoded rows (extraction mode,
+    # field list, output format...). If they differ from the stored ones,
+    # every batch is treated as stale.
+
+    def __init__(self, path, settings, save_interval=5.0):
+        self.path = path
+        self.settings = json.loads(json.dumps(settings, sort_keys=True, default=sorted))
+        self.save_interval = save_interval
+        self.source = None
+        self.batches = {}
+        self._last_save = 0.0
+
+        if os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    stored = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                stored = {}
+            self.source = stored.get('source')
+            if stored.get('settings') == self.settings:
+                self.batches = stored.get('batches', {})
+
+    def source_changed(self, signature):
+        return self.source != signature
+
+    def set_source(self, signature):
+        self.source = signature
+
+    def is_current(self, batch):
+        entry = self.batches.get(batch['batch_id'])
+        return (
+            entry is not None
+            and entry.get('status') == 'done'
+            and entry.get('digest') == batch['digest']
+            and entry.get('packet_range') == batch['packet_range']
+            and entry.get('byte_range') == batch['byte_range']
+            and all(os.path.exists(p) for p in entry.get('outputs', []))
+        )
+
+    def start(self, batch):
+        self.batches[batch['batch_id']] = {
+            'source': batch['source'],
+            'input': batch.get('input'),
+            'packet_range': batch['packet_range'],
+            'byte_range': batch['byte_range'],
+            'digest': batch['digest'],
+            'status': 'running',
+            'outputs': [],
+        }
+
+    def complete(self, batch_id, outputs, stats):
+        # A batch whose decode failed (stats['error']) is recorded as failed:
+        # its shard holds the rows decoded so far and is decoded again next run
+        entry = self.batches[batch_id]
+        entry.update(
+            status='failed' if stats.get('error') else 'done',
+            outputs=list(outputs),
+            rows=stats.get('rows', 0),
+            malformed=stats.get('malformed', 0),
+            error=stats.get('error'),
+            finished=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        )
+        if time.monotonic() - self._last_save >= self.save_interval:
+            self.save()
+
+    def retain(self, batch_ids):
+        # Drop batches that are no longer part of the plan (e.g. fewer splits)
+        keep = set(batch_ids)
+        for batch_id in list(self.batches):
+            if batch_id not in keep:
+                del self.batches[batch_id]
+
+    def outputs(self, batch_ids):
+        # Shard files of finished batches in batch order, including the
+        # truncated shards of failed ones
+        for batch_id in batch_ids:
+            entry = self.batches.get(batch_id)
+            if entry and entry.get('status') in ('done', 'failed'):
+                yield from entry.get('outputs', [])
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'settings': self.settings, 'source': self.source, 'batches': self.batches}, f, indent=1)
+        os.replace(tmp, self.path)
+        self._last_save = time.monotonic()
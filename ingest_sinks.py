@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Output sinks for get_data_script.py.
+
+Every ingestion batch is written to its own shard. JSON output uses one
+JSON-lines shard per batch, stitched into the original "[ {...}, ... ]"
+file at the end. Parquet output writes the batch's rows as part files of
+the Parquet dataset directory (part-<batch>-00000.parquet, ...) in
+bounded record batches, with typed numeric columns and dictionary-encoded
+strings, so preprocessing can read it without a JSON parse. Shards only
+get their final name once complete, so a crash never leaves a half shard.
+
+The types are for storage only: preprocessing reads a batch back as the
+values the JSON output holds, so both inputs give the same labels.
+decoded_batch turns integer columns back into strings (tshark prints every
+field as a string), floats are parsed with pandas as preprocessing parses
+the JSON strings, and nested values (lists of repeated fields, mdns.Queries)
+are kept as JSON text in a "<field>#json" column next to the field's own,
+restored by restore_nested_row / columnar_enrich.columns_from_arrow.
+"""
+
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+# Flattened column -> Arrow type. Everything else is a dictionary string.
+PARQUET_TYPES = {
+    'frame.frame.time_epoch': pa.float64(),
+    'frame.frame.len': pa.uint32(),
+    'ip.ip.ttl': pa.uint8(),
+    'ip.ip.proto': pa.uint8(),
+    'ipv6.ipv6.hlim': pa.uint8(),
+    'ipv6.ipv6.nxt': pa.uint8(),
+    'tcp.tcp.srcport': pa.uint16(),
+    'tcp.tcp.dstport': pa.uint16(),
+    'udp.udp.srcport': pa.uint16(),
+    'udp.udp.dstport': pa.uint16(),
+    'icmp.icmp.type': pa.uint8(),
+    'igmp.igmp.type': pa.uint8(),
+    'rtp.rtp.seq': pa.uint16(),
+}
+STRING_TYPE = pa.dictionary(pa.int32(), pa.string())
+NESTED_SUFFIX = '#json'
+
+
+def _to_number(value, cast):
+    if value is None:
+        return None
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_nested(value):
+    return isinstance(value, (list, dict))
+
+
+def rows_to_record_batch(rows, columns, nested=()):
+    # nested: string columns that get a NESTED_SUFFIX column even if this
+    # batch has no nested value in them (keeps the schema of a part stable)
+    arrays = []
+    fields = []
+    for col in columns:
+        values = [row.get(col) for row in rows]
+        typ = PARQUET_TYPES.get(col)
+        if typ is None:
+            if col in nested or any(_is_nested(v) for v in values):
+                texts = [json.dumps(v, default=str) if _is_nested(v) else None for v in values]
+                arrays.append(pa.array(texts, type=pa.string()))
+                fields.append(pa.field(col + NESTED_SUFFIX, pa.string()))
+                values = [None if _is_nested(v) else v for v in values]
+            values = [None if v is None else str(v) for v in values]
+            arr = pa.array(values, type=pa.string()).dictionary_encode()
+            typ = STRING_TYPE
+        elif pa.types.is_floating(typ):
+            # pd.to_numeric, not float(): the two differ in the last bit
+            values = [v if isinstance(v, (str, int, float)) else None for v in values]
+            arr = pa.array(pd.to_numeric(pd.Series(values, dtype=object), errors='coerce'), type=typ,
+                           from_pandas=True)
+        else:
+            arr = pa.array([_to_number(v, int) for v in values], type=typ)
+        arrays.append(arr)
+        fields.append(pa.field(col, typ))
+    return pa.RecordBatch.from_arrays(arrays, schema=pa.schema(fields))
+
+
+class JsonLinesSink:
+    def __init__(self, path):
+        self.path = path
+        self.outputs = []
+        self._f = open(path + '.tmp', "w", encoding="utf-8")
+
+    def write(self, row):
+        self._f.write(json.dumps(row))
+        self._f.write("\n")
+
+    def close(self):
+        self._f.close()
+        os.replace(self.path + '.tmp', self.path)
+        self.outputs = [self.path]
+
+
+class ParquetSink:
+    # Rows are buffered batch_rows at a time. A part file keeps its schema;
+    # when a batch brings new columns (json mode exposes whatever tshark
+    # dissected) the part is closed and a new one started. Readers unify the
+    # part schemas (see open_parquet_dataset).
+
+    def __init__(self, out_dir, prefix='part', batch_rows=65_536, compression='zstd', metadata=None):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.metadata = metadata
+        self.batch_rows = batch_rows
+        self.compression = compression
+        self.outputs = []
+        os.makedirs(out_dir, exist_ok=True)
+        for name in os.listdir(out_dir):
+            if name.startswith(prefix + '-') and '.parquet' in name:
+                os.remove(os.path.join(out_dir, name))
+        self._pending = []
+        self._rows = []
+        self._columns = []
+        self._nested = set()
+        self._names = None
+        self._writer = None
+        self._part = 0
+
+    def write(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        seen = dict.fromkeys(self._columns)
+        for row in self._rows:
+            for col in row:
+                if col not in seen:
+                    seen[col] = None
+        self._columns = list(seen)
+
+        batch = rows_to_record_batch(self._rows, self._columns, self._nested)
+        self._nested.update(name[:-len(NESTED_SUFFIX)] for name in batch.schema.names
+                            if name.endswith(NESTED_SUFFIX))
+        if self._writer is not None and batch.schema.names != self._names:
+            self._writer.close()
+            self._writer = None
+        if self._writer is None:
+            path = os.path.join(self.out_dir, f"{self.prefix}-{self._part:05d}.parquet")
+            schema = batch.schema.with_metadata(self.metadata) if self.metadata else batch.schema
+            self._writer = pq.ParquetWriter(path + '.tmp', schema, compression=self.compression)
+            self._names = batch.schema.names
+            self._pending.append(path)
+            self._part += 1
+        self._writer.write_batch(batch)
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        for path in self._pending:
+            os.replace(path + '.tmp', path)
+        self.outputs = self._pending
+        self._pending = []
+
+
+def open_shard_sink(output_format, out_dir, batch_id, metadata=None):
+    # metadata: Parquet key-value metadata (ignored for JSON shards)
+    if output_format == "parquet":
+        return ParquetSink(out_dir, prefix=f"part-{batch_id}", metadata=metadata)
+    return JsonLinesSink(os.path.join(out_dir, f"{batch_id}.jsonl"))
+
+
+def stitch_json_shards(shard_paths, output_json):
+    # Concatenate JSON-lines shards (in batch order) into one JSON array.
+    tmp = output_json + '.tmp'
+    with open(tmp, "w", encoding="utf-8") as out_f:
+        out_f.write("[\n")
+        first = True
+        for shard in shard_paths:
+            with open(shard, encoding="utf-8") as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    if not line:
+                        continue
+                    if not first:
+                        out_f.write(",\n")
+                    else:
+                        first = False
+                    out_f.write(line)
+        out_f.write("\n]\n")
+    os.replace(tmp, output_json)
+
+
+def prune_parquet_parts(out_dir, keep):
+    # Remove part files that are not listed in keep (stale or unfinished)
+    keep = {os.path.abspath(p) for p in keep}
+    for name in os.listdir(out_dir):
+        path = os.path.abspath(os.path.join(out_dir, name))
+        if name.startswith('part-') and '.parquet' in name and path not in keep:
+            os.remove(path)
+
+
+def is_parquet_input(path):
+    return os.path.isdir(path) or path.endswith('.parquet')
+
+
+def parquet_parts(path):
+    # Part files of a Parquet dataset directory in packet order (or the file itself)
+    return sorted(
+        os.path.join(path, name) for name in os.listdir(path) if name.endswith('.parquet')
+    ) if os.path.isdir(path) else [path]
+
+
+def open_parquet_dataset(path, part=None):
+    # Part files may carry different column sets; read them under one schema.
+    # part: only that part file, still under the dataset's schema.
+    files = parquet_parts(path)
+    schema = pa.unify_schemas([pq.read_schema(f) for f in files])
+    return ds.dataset([part] if part else files, schema=schema, format='parquet')
+
+
+def decoded_batch(batch):
+    # A record batch of the Parquet input with its integer columns as the
+    # strings of the JSON output; preprocessing compares ports and types with
+    # Python semantics ('443' != 443) and must see the same values from both
+    columns = [pc.cast(col, pa.string()) if pa.types.is_integer(col.type) else col for col in batch.columns]
+    return pa.RecordBatch.from_arrays(columns, names=batch.schema.names)
+
+
+def restore_nested_row(row):
+    # A row of decoded_batch(...).to_pylist() with its nested values back in
+    # place of the NESTED_SUFFIX columns
+    for name in [k for k in row if k.endswith(NESTED_SUFFIX)]:
+        text = row.pop(name)
+        if text is not None:
+            row[name[:-len(NESTED_SUFFIX)]] = json.loads(text)
+    return row
+
+
+def upsert_capture_table(path, record):
+    # One row per capture (capinfos metadata), keyed by capture_id
+    rows = []
+    if os.path.exists(path):
+        rows = [r for r in pq.read_table(path).to_pylist() if r.get('capture_id') != record['capture_id']]
+    rows.append({k: None if v is None else str(v) for k, v in record.items()})
+    columns = dict.fromkeys(col for row in rows for col in row)
+    table = pa.table({col: pa.array([row.get(col) for row in rows], type=pa.string()) for col in columns})
+    pq.write_table(table, path + '.tmp')
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Internal/external classification of IP addresses for preprocessing.
+
+A capture has a few thousand distinct addresses and many millions of
+packets, so every distinct address is parsed once and cached. Internal
+ranges are kept as sorted, merged integer intervals per IP version and
+looked up by binary search.
+
+By default "internal" is Python's ipaddress is_private (what
+preprocessing always used). Pass internal_cidrs to define it from an
+explicit list instead, e.g. RFC1918 plus the site's own public ranges;
+extra_cidrs are added to either definition.
+"""
+
+import bisect
+import ipaddress
+
+import numpy as np
+import pandas as pd
+
+
+RFC1918 = ['10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16']
+
+
+def cidr_ranges(cidrs):
+    # {version: (starts, ends)} of merged inclusive integer intervals
+    spans = {4: [], 6: []}
+    for cidr in cidrs:
+        net = ipaddress.ip_network(cidr, strict=False)
+        spans[net.version].append((int(net.network_address), int(net.broadcast_address)))
+    ranges = {}
+    for version, items in spans.items():
+        merged = []
+        for start, end in sorted(items):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        ranges[version] = ([s for s, _ in merged], [e for _, e in merged])
+    return ranges
+
+
+class IpClassifier:
+
+    def __init__(self, internal_cidrs=None, extra_cidrs=()):
+        self.use_is_private = internal_cidrs is None
+        self.ranges = cidr_ranges(list(internal_cidrs or []) + list(extra_cidrs))
+        self.invalid = set()
+        self._cache = {}
+
+    def _in_ranges(self, addr):
+        starts, ends = self.ranges[addr.version]
+        value = int(addr)
+        i = bisect.bisect_right(starts, value) - 1
+        return i >= 0 and value <= ends[i]
+
+    def _classify(self, ip):
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            if ip is not None:
+                self.invalid.add(str(ip))
+            return None
+        return (self.use_is_private and addr.is_private) or self._in_ranges(addr)
+
+    def is_internal(self, ip):
+        # True / False, or None when ip is missing or not an address
+        try:
+            return self._cache[ip]
+        except KeyError:
+            result = self._cache[ip] = self._classify(ip)
+            return result
+        except TypeError:
+            return self._classify(ip)
+
+    def classify(self, values):
+        # Element-wise is_internal over an array, one parse per distinct value
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        results = np.empty(len(uniques) + 1, dtype=object)
+        results[:-1] = [self.is_internal(ip) for ip in uniques]
+        results[-1] = None  # missing (code -1)
+        return results[codes]
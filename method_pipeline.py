@@ -10,55 +10,70 @@ import networkx as nx
 from sklearn.decomposition import NMF
 from networkx.algorithms.community import louvain_communities
 import pickle
+import os
+
+from dns_index import attach_hostnames
+from output_schema import read_compact
+from star_schema import graph_flows
 
 np.random.seed(42)
 
-# === Load Data ===
-df = pd.read_parquet("C:/Users/baroc/Downloads/all_workloads_CICIDS.parquet")
-df = df.dropna(subset=['mac_src', 'ip_src', 'src_port', 'mac_dst', 'ip_dst', 'dst_port'])
+GRAPH_COLUMNS = ['workload_id_src', 'workload_id_dst', 'mac_src', 'ip_src', 'src_port', 'mac_dst', 'ip_dst', 'dst_port',
+                 'bytes_sent', 'bytes_received', 'frame_time_epoch', 'session_volatility_src', 'ttl_variability',
+                 'dst_role', 'is_possible_switch', 'is_broadcast', 'is_forward_only_mac']
 
-for col in ['bytes_sent', 'bytes_received', 'response_delay_src', 'response_delay_dst', 'session_length_src',
-            'session_length_dst', 'ttl_variability', 'frame_time_epoch']:
-    if col in df.columns:
-        df[col] = pd.to_numeric(df[col], downcast='float', errors='coerce')
-df['flows'] = 1
+# === Load Data ===
+star_dir = "C:/Users/baroc/Downloads/all_workloads_CICIDS_star"
+dns_index_table = "C:/Users/baroc/Downloads/dns_index.parquet"  # written by preprosessing_update.py
+if os.path.isdir(star_dir):
+    # star layout: one row per flow, bytes and attributes already summed over its packets
+    df = graph_flows(star_dir)
+else:
+    df = read_compact("C:/Users/baroc/Downloads/all_workloads_CICIDS.parquet", columns=GRAPH_COLUMNS)
+    df = df.dropna(subset=['mac_src', 'ip_src', 'src_port', 'mac_dst', 'ip_dst', 'dst_port'])
+
+    df['flows'] = 1
+    df['start_time'] = df['end_time'] = (df['frame_time_epoch'] - pd.Timestamp(0)).dt.total_seconds()
+    df['device_role'] = np.where(df['dst_role'].isin(['internal_router', 'external_router']),
+                                 df['dst_role'],
+                                 np.where(df['is_possible_switch'], 'switch',
+                                          np.where(df['is_broadcast'] | df['is_forward_only_mac'], 'network_core', 'client')))
 
 # === Graph Building ===
-df['device_role'] = np.where(df['dst_role'].isin(['internal_router', 'external_router']),
-                             df['dst_role'],
-                             np.where(df['is_possible_switch'], 'switch',
-                                      np.where(df['is_broadcast'] | df['is_forward_only_mac'], 'network_core', 'client')))
 device_roles = dict(zip(df['workload_id_src'], df['device_role']))
 
-pairs = df[['workload_id_src', 'workload_id_dst']].apply(tuple, axis=1).values
-pairs_unique, idx = np.unique(pairs, return_inverse=True)
+# workload ids are int64 keys: unique (src, dst) rows without Python tuples
+pairs = df[['workload_id_src', 'workload_id_dst']].to_numpy(dtype=np.int64)
+pairs_unique, idx = np.unique(pairs, axis=0, return_inverse=True)
+idx = idx.reshape(-1)
 flows = np.bincount(idx, weights=df['flows'].values)
 bytes_sent = np.bincount(idx, weights=df['bytes_sent'].values)
 bytes_received = np.bincount(idx, weights=df['bytes_received'].values)
 
 start_time = np.full(len(pairs_unique), np.inf)
 end_time = np.full(len(pairs_unique), -np.inf)
-np.minimum.at(start_time, idx, df['frame_time_epoch'].values)
-np.maximum.at(end_time, idx, df['frame_time_epoch'].values)
+np.minimum.at(start_time, idx, df['start_time'].values)
+np.maximum.at(end_time, idx, df['end_time'].values)
 
 G = nx.Graph()
-for (src, dst), f, bs, br, st, et in zip(pairs_unique, flows, bytes_sent, bytes_received, start_time, end_time):
+for (src, dst), f, bs, br, st, et in zip(pairs_unique.tolist(), flows, bytes_sent, bytes_received, start_time, end_time):
     G.add_edge(src, dst, flows=f, weight=bs + br, start_time=st, end_time=et, duration=et - st)
 nx.set_node_attributes(G, device_roles, 'device_role')
 
 # === Node Attributes ===
-nodes = np.array(list(G.nodes()))
-node_idx = {n: i for i, n in enumerate(nodes)}
+nodes = np.array(list(G.nodes()), dtype=np.int64)
+node_index = pd.Index(nodes)
 
 def aggregate_attr(attr):
     vals = df[attr].values
+    weights = df['flows'].values
     agg = np.zeros(len(nodes))
     counts = np.zeros(len(nodes))
     for col in ['workload_id_src', 'workload_id_dst']:
-        idxs = np.vectorize(node_idx.get)(df[col].values, -1)
+        idxs = node_index.get_indexer(df[col].values)
         mask = idxs >= 0
         np.add.at(agg, idxs[mask], vals[mask])
-        np.add.at(counts, idxs[mask], 1)
+        np.add.at(counts, idxs[mask], weights[mask])
     return agg / np.maximum(counts, 1)
 
 for attr in ['session_volatility_src', 'ttl_variability']:
@@ -177,6 +192,9 @@ top_features = {
 }
 df_node_final['primary_role'] = primary_role
 df_node_final['role_description'] = df_node_final['primary_role'].map(top_features)
+if os.path.exists(dns_index_table):
+    # hostname labels for the nodes from the DNS/mDNS side index
+    df_node_final = attach_hostnames(df_node_final, dns_index_table)
 
 df_node_final.to_csv("final_workload_node_dataset_3.csv", index=False)
 print(df_node_final.head())
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Compact Arrow schema for the all_workloads output.
+
+Every writer (in-memory, out of core, DuckDB, incremental state) passes its
+record batches through compact_batch before they reach Parquet:
+
+- ports and rtp_seq uint16, TTL / protocol / ICMP / IGMP type uint8,
+  frame_len uint32 (offloaded captures have frames > 65535 bytes),
+  epoch_minute / epoch_second uint32;
+  values that are not an integer in range become null,
+- frame_time_epoch a timestamp[ns] (naive, UTC),
+- is_* / has_* flags bool,
+- every other string column dictionary-encoded (a pandas categorical on read),
+- artifact_type_ranked a fixed-width list of dictionary strings.
+
+Computation upstream keeps its own dtypes (ports stay the strings that went
+into the workload ids); only what is stored changes. read_compact reads the
+file back without widening: nullable small ints and bools instead of
+float64 / object, the rank array Arrow-backed instead of one list per row.
+"""
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from dataset_profile import ColumnSketches
+
+
+STRING_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+COMPACT_TYPES = {
+    'frame_len': pa.uint32(),
+    'frame_time_epoch': pa.timestamp('ns'),
+    'epoch_minute': pa.uint32(),
+    'epoch_second': pa.uint32(),
+    'ip_proto': pa.uint8(),
+    'ip_ttl': pa.uint8(),
+    'icmp_type': pa.uint8(),
+    'igmp_type': pa.uint8(),
+    'src_port': pa.uint16(),
+    'dst_port': pa.uint16(),
+    'tcp_srcport': pa.uint16(),
+    'tcp_dstport': pa.uint16(),
+    'udp_srcport': pa.uint16(),
+    'udp_dstport': pa.uint16(),
+    'rtp_seq': pa.uint16(),
+}
+PANDAS_TYPES = {
+    pa.uint8(): pd.UInt8Dtype(),
+    pa.uint16(): pd.UInt16Dtype(),
+    pa.uint32(): pd.UInt32Dtype(),
+    pa.bool_(): pd.BooleanDtype(),
+}
+BOOL_COLUMNS = ('src_is_internal', 'dst_is_internal', 'tls_is_handshake')
+RANKED_COLUMN = 'artifact_type_ranked'
+
+
+def _is_text(typ):
+    return pa.types.is_null(typ) or pa.types.is_string(typ) or pa.types.is_large_string(typ) \
+        or pa.types.is_dictionary(typ)
+
+
+def _numbers(col):
+    if pa.types.is_dictionary(col.type):
+        col = col.cast(pa.string())
+    return pd.to_numeric(col.to_pandas(), errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+
+
+def _to_unsigned(col, typ):
+    values = _numbers(col)
+    valid = (values >= 0) & (values <= np.iinfo(typ.to_pandas_dtype()).max) & (values == np.floor(values))
+    return pa.array(np.where(valid, values, 0).astype(typ.to_pandas_dtype()), mask=~valid, type=typ)
+
+
+def _to_timestamp(col):
+    # Whole seconds and fraction separately: float seconds * 1e9 would round to 256 ns
+    if pa.types.is_timestamp(col.type):
+        return col.cast(pa.timestamp('ns'))
+    values = _numbers(col)
+    valid = ~np.isnan(values)
+    seconds = np.floor(np.where(valid, values, 0))
+    ns = seconds.astype(np.int64) * 1_000_000_000 + np.round((np.where(valid, values, 0) - seconds) * 1e9).astype(np.int64)
+    return pa.array(ns, mask=~valid, type=pa.int64()).cast(pa.timestamp('ns'))
+
+
+def _to_dictionary(col):
+    if pa.types.is_dictionary(col.type):
+        return col
+    return pc.dictionary_encode(col.cast(pa.string()))
+
+
+def _to_ranked(col):
+    # list<string> -> fixed_size_list<dictionary>; every row ranks the same artifact types
+    if pa.types.is_fixed_size_list(col.type):
+        return col
+    if isinstance(col, pa.ChunkedArray):
+        col = col.combine_chunks()
+    lengths = pc.list_value_length(col).drop_null()
+    width = pc.max(lengths).as_py() or 0
+    if pc.min(lengths).as_py() not in (None, width):
+        raise ValueError(f"{RANKED_COLUMN}: rows rank different numbers of artifact types")
+    return pc.list_slice(col, 0, width, return_fixed_size_list=True).cast(pa.list_(STRING_TYPE, width))
+
+
+def compact_column(name, col):
+    if name in COMPACT_TYPES:
+        typ = COMPACT_TYPES[name]
+        return _to_timestamp(col) if pa.types.is_timestamp(typ) else _to_unsigned(col, typ)
+    if name.startswith(('is_', 'has_')) or name in BOOL_COLUMNS:
+        return col.cast(pa.bool_())
+    if name == RANKED_COLUMN:
+        return _to_ranked(col)
+    if _is_text(col.type):
+        return _to_dictionary(col)
+    return col
+
+
+def compact_batch(batch):
+    # RecordBatch or Table with the compact column types
+    columns = [compact_column(name, col) for name, col in zip(batch.schema.names, batch.columns)]
+    if isinstance(batch, pa.Table):
+        return pa.Table.from_arrays(columns, names=batch.schema.names)
+    return pa.RecordBatch.from_arrays(columns, names=batch.schema.names)
+
+
+def write_compact(batches, out_parquet, schema=None):
+    # Write record batches / tables (e.g. a DuckDB reader) as compact Parquet,
+    # with column sketches for dataset_profile.py in the footer;
+    # schema: written as an empty file when there are no batches
+    writer = None
+    sketches = ColumnSketches()
+    try:
+        for batch in batches:
+            batch = compact_batch(batch)
+            if writer is None:
+                writer = pq.ParquetWriter(out_parquet, batch.schema, compression='zstd')
+            writer.write(batch)
+            sketches.update(batch)
+        if writer is not None:
+            writer.add_key_value_metadata(sketches.metadata())
+        elif schema is not None:
+            pq.write_table(compact_batch(schema.empty_table()), out_parquet, compression='zstd')
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _pandas_type(typ):
+    if pa.types.is_fixed_size_list(typ):
+        return pd.ArrowDtype(typ)
+    return PANDAS_TYPES.get(typ)
+
+
+def compact_pandas(table):
+    # table: pyarrow Table or RecordBatchReader (DuckDB's .arrow())
+    if not isinstance(table, pa.Table):
+        table = table.read_all()
+    return table.to_pandas(types_mapper=_pandas_type)
+
+
+def read_compact(path, columns=None):
+    return compact_pandas(pq.read_table(path, columns=columns))
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Map phase of the parallel build (stream_process_json(workers=...)).
+
+The input is split into shards: every input file, and every part file of a
+Parquet dataset directory, in packet order. A pool of worker processes
+(worker_pool.py) runs the columnar enrichment of one shard each and writes
+it to an Arrow IPC file, typed with the spill schema a serial run takes
+from its first chunk. The parent appends the shards to the packet spill in
+shard order, so the spill holds the rows of a serial run in the same order,
+and workload ids, being hashes of (mac, ip, port), agree across shards.
+
+The reduce phase is the aggregate SQL of the builders over that spill,
+which DuckDB runs on all cores as per-thread partial aggregates merged per
+key. Exact medians, standard deviations and distinct counts do not merge
+from fixed-size partials without changing results, so shards are not
+pre-aggregated; approximate=True aggregates through the mergeable sketches
+of sketches.py instead. The last pass, feature derivation per packet, is
+split across the same pool by spill row groups (write_features(workers=...)).
+"""
+
+import os
+
+import pandas as pd
+import pyarrow as pa
+
+from columnar_enrich import iter_enriched_frames, packet_frame
+from dns_index import DnsIndex
+from ingest_sinks import parquet_parts
+from worker_pool import run_tasks
+from workload_features import frame_to_batch, spill_schema, workload_lookup
+
+
+def capture_shards(inputs):
+    # [(path, part file or None)] in packet order
+    shards = []
+    for path in inputs:
+        if os.path.isdir(path):
+            shards += [(path, part) for part in parquet_parts(path)]
+        else:
+            shards.append((path, None))
+    return shards
+
+
+def first_chunk_schema(shards, chunk_rows, classifier):
+    for path, part in shards:
+        for frame in iter_enriched_frames(path, chunk_rows, classifier, part):
+            return spill_schema(packet_frame(frame))
+    return None
+
+
+def enrich_shard(shard, schema, out_path, chunk_rows, classifier, lookup, dns=False):
+    # Worker: a shard's prepared packets into out_path; returns the
+    # unparseable IPs, with lookup the shard's workload lookup and with dns
+    # its DNS side index table
+    path, part = shard
+    ids = None
+    index = DnsIndex() if dns else None
+    with pa.OSFile(out_path, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+        for frame in iter_enriched_frames(path, chunk_rows, classifier, part, index):
+            frame = packet_frame(frame)
+            writer.write_batch(frame_to_batch(frame, schema))
+            if lookup:
+                ids = workload_lookup(frame, ids)
+    return classifier.invalid, ids, None if index is None else index.table
+
+
+def spill_shards(inputs, spill, chunk_rows, classifier, workers, lookup=False, dns=None):
+    # Fill spill with the prepared packets of all inputs; returns the merged
+    # workload lookup with lookup=True, else None. dns: DnsIndex to merge the
+    # shards' DNS side index into
+    shards = capture_shards(inputs)
+    schema = first_chunk_schema(shards, chunk_rows, classifier)
+    if schema is None:
+        return None
+    spill.open(schema)
+    paths = [os.path.join(spill.dir, f'shard-{i:05d}.arrow') for i in range(len(shards))]
+    tasks = [(enrich_shard, (shard, schema, path, chunk_rows, classifier, lookup, dns is not None))
+             for shard, path in zip(shards, paths)]
+    ids = None
+    for path, (invalid, shard_ids, shard_dns) in zip(paths, run_tasks(tasks, workers, spill.dir)):
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                spill.write_batch(reader.get_batch(i))
+        os.remove(path)
+        classifier.invalid |= invalid
+        if dns is not None:
+            dns.merge(shard_dns)
+        if shard_ids is not None:
+            ids = shard_ids if ids is None else pd.concat([ids, shard_ids], ignore_index=True).drop_duplicates('workload_id')
+    return ids
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+Pure-Python pcap / pcapng reader for the L2-L4 fields used by preprocessing.
+
+The capture is memory-mapped and only the Ethernet, IPv4/IPv6, TCP/UDP,
+ICMP/IGMP and ARP headers are decoded, straight into per-column lists.
+Column names follow the flattened tshark naming of get_data_script.py
+("ip.ip.src", "tcp.tcp.dstport", ...) so the rest of the pipeline cannot
+tell the difference. Everything that needs real dissection (DNS, TLS, FIX,
+...) is left to tshark, see select_deep_frames / write_pcap_subset.
+"""
+
+import mmap
+import socket
+import struct
+from array import array
+
+
+# === File formats ===
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1000),      # little endian, microseconds
+    b'\xa1\xb2\xc3\xd4': ('>', 1000),      # big endian, microseconds
+    b'\x4d\x3c\xb2\xa1': ('<', 1),         # little endian, nanoseconds
+    b'\xa1\xb2\x3c\x4d': ('>', 1),         # big endian, nanoseconds
+}
+PCAPNG_SHB = b'\x0a\x0d\x0d\x0a'
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL = 113
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_ARP = 0x0806
+ETHERTYPE_VLAN = {0x8100, 0x88A8, 0x9100}
+
+# Columns produced natively (flattened tshark names)
+NATIVE_COLUMNS = [
+    'frame.frame.time_epoch', 'frame.frame.len',
+    'eth.eth.src', 'eth.eth.dst',
+    'ip.ip.src', 'ip.ip.dst', 'ip.ip.ttl', 'ip.ip.proto', 'ip.ip.flags',
+    'ipv6.ipv6.src', 'ipv6.ipv6.dst', 'ipv6.ipv6.hlim', 'ipv6.ipv6.nxt',
+    'tcp.tcp.srcport', 'tcp.tcp.dstport',
+    'udp.udp.srcport', 'udp.udp.dstport',
+    'icmp.icmp.type', 'igmp.igmp.type',
+    'arp.arp.src.hw_mac',
+]
+
+
+def _mac(buf, off):
+    return buf[off:off + 6].hex(':')
+
+
+class Capture:
+    """Memory-mapped capture; iter_records() walks the packet records."""
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'rb')
+        self.mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._section = None
+        head = self.mm[:4]
+        if head in PCAP_MAGIC:
+            self.format = 'pcap'
+        elif head == PCAPNG_SHB:
+            self.format = 'pcapng'
+        else:
+            self.close()
+            raise ValueError(f"{path}: not a pcap/pcapng file")
+
+    def close(self):
+        if getattr(self, 'mm', None) is not None:
+            self.mm.close()
+            self.mm = None
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def iter_records(self, start=None, stop=None):
+        # Yields (ts_sec, ts_nsec, caplen, origlen, linktype, data_offset,
+        # record_offset, record_end). start/stop are byte offsets of the first
+        # record and the end of the range (used for virtual shards).
+        if self.format == 'pcap':
+            return self._iter_pcap(start, stop)
+        return self._iter_pcapng(start, stop)
+
+    def record_at(self, offset):
+        # Record at a byte offset (None: the first record)
+        return next(self.iter_records(offset), None)
+
+    def _iter_pcap(self, start, stop):
+        mm = self.mm
+        endian, ns_per_unit = PCAP_MAGIC[mm[:4]]
+        linktype = struct.unpack_from(endian + 'I', mm, 20)[0] & 0x0FFFFFFF
+        rec = struct.Struct(endian + 'IIII')
+        pos = 24 if start is None else start
+        end = len(mm) if stop is None else min(stop, len(mm))
+        while pos + 16 <= end:
+            ts_sec, ts_frac, caplen, origlen = rec.unpack_from(mm, pos)
+            data = pos + 16
+            if data + caplen > len(mm):
+                break  # truncated last record
+            yield ts_sec, ts_frac * ns_per_unit, caplen, origlen, linktype, data, pos, data + caplen
+            pos = data + caplen
+
+    def _iter_pcapng(self, start, stop):
+        mm = self.mm
+        size = len(mm)
+        end = size if stop is None else min(stop, size)
+        endian = '<'
+        interfaces = []  # (linktype, ticks_per_second)
+        pos = 0
+        if start is not None:
+            # Interface descriptions live before the first packet block, so
+            # always read the section header/interface blocks from the top.
+            if self._section is None:
+                self._section = self._pcapng_section(0)
+            endian, interfaces, _ = self._section
+            pos = start
+
+        while pos + 12 <= end:
+            btype, blen = struct.unpack_from(endian + 'II', mm, pos)
+            if btype == 0x0A0D0D0A:
+                endian, interfaces, blen = self._pcapng_section(pos)
+            if blen < 12 or pos + blen > size:
+                break
+            body = pos + 8
+            if btype == 6:  # enhanced packet block
+                if_id, ts_hi, ts_lo, caplen, origlen = struct.unpack_from(endian + 'IIIII', mm, body)
+                linktype, tps = interfaces[if_id] if if_id < len(interfaces) else (LINKTYPE_ETHERNET, 10 ** 6)
+                ts = (ts_hi << 32) | ts_lo
+                yield ts // tps, (ts % tps) * 10 ** 9 // tps, caplen, origlen, linktype, body + 20, pos, pos + blen
+            elif btype == 3:  # simple packet block (no timestamp)
+                origlen = struct.unpack_from(endian + 'I', mm, body)[0]
+                caplen = min(origlen, blen - 16)
+                linktype = interfaces[0][0] if interfaces else LINKTYPE_ETHERNET
+                yield 0, 0, caplen, origlen, linktype, body + 4, pos, pos + blen
+            pos += blen
+
+    def _pcapng_section(self, pos):
+        # Parse a section header and the interface blocks that follow it.
+        mm = self.mm
+        endian = '<' if mm[pos + 8:pos + 12] == b'\x4d\x3c\x2b\x1a' else '>'
+        shb_len = struct.unpack_from(endian + 'I', mm, pos + 4)[0]
+        interfaces = []
+        p = pos + shb_len
+        while p + 12 <= len(mm):
+            btype, blen = struct.unpack_from(endian + 'II', mm, p)
+            if btype in (6, 3, 2, 0x0A0D0D0A) or blen < 12:
+                break
+            if btype == 1:
+                linktype = struct.unpack_from(endian + 'H', mm, p + 8)[0]
+                interfaces.append((linktype, self._if_tsresol(p + 16, p + blen - 4, endian)))
+            p += blen
+        return endian, interfaces, shb_len
+
+    def _if_tsresol(self, opt, end, endian):
+        mm = self.mm
+        while opt + 4 <= end:
+            code, length = struct.unpack_from(endian + 'HH', mm, opt)
+            if code == 0:
+                break
+            if code == 9 and length >= 1:
+                v = mm[opt + 4]
+                return 2 ** (v & 0x7F) if v & 0x80 else 10 ** v
+            opt += 4 + ((length + 3) & ~3)
+        return 10 ** 6
+
+
+# === Header decoding ===
+def decode_packet(buf, off, caplen, linktype, out):
+    # Fills the L2-L4 entries of out (a dict of NATIVE_COLUMNS -> value) for
+    # one packet. Missing layers stay None, like absent tshark fields.
+    end = off + caplen
+    ethertype = None
+
+    if linktype == LINKTYPE_ETHERNET:
+        if caplen < 14:
+            return
+        out['eth.eth.dst'] = _mac(buf, off)
+        out['eth.eth.src'] = _mac(buf, off + 6)
+        ethertype = (buf[off + 12] << 8) | buf[off + 13]
+        p = off + 14
+        while ethertype in ETHERTYPE_VLAN and p + 4 <= end:
+            ethertype = (buf[p + 2] << 8) | buf[p + 3]
+            p += 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if caplen < 16:
+            return
+        ethertype = (buf[off + 14] << 8) | buf[off + 15]
+        p = off + 16
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6, 12, 14):
+        p = off
+        if caplen:
+            ethertype = ETHERTYPE_IPV6 if buf[p] >> 4 == 6 else ETHERTYPE_IPV4
+    else:
+        return
+
+    proto = None
+    if ethertype == ETHERTYPE_IPV4:
+        if p + 20 > end:
+            return
+        ihl = (buf[p] & 0x0F) * 4
+        out['ip.ip.flags'] = f"0x{buf[p + 6] & 0xE0:02x}"
+        out['ip.ip.ttl'] = buf[p + 8]
+        proto = buf[p + 9]
+        out['ip.ip.proto'] = proto
+        out['ip.ip.src'] = socket.inet_ntoa(buf[p + 12:p + 16])
+        out['ip.ip.dst'] = socket.inet_ntoa(buf[p + 16:p + 20])
+        if (buf[p + 6] & 0x1F) or buf[p + 7]:
+            return  # non-first fragment: no L4 header here
+        p += ihl
+    elif ethertype == ETHERTYPE_IPV6:
+        if p + 40 > end:
+            return
+        proto = buf[p + 6]
+        out['ipv6.ipv6.nxt'] = proto
+        out['ipv6.ipv6.hlim'] = buf[p + 7]
+        out['ipv6.ipv6.src'] = socket.inet_ntop(socket.AF_INET6, buf[p + 8:p + 24])
+        out['ipv6.ipv6.dst'] = socket.inet_ntop(socket.AF_INET6, buf[p + 24:p + 40])
+        p += 40
+        # hop-by-hop, routing, destination options
+        while proto in (0, 43, 60) and p + 8 <= end:
+            proto = buf[p]
+            p += (buf[p + 1] + 1) * 8
+    elif ethertype == ETHERTYPE_ARP:
+        if p + 14 <= end:
+            out['arp.arp.src.hw_mac'] = _mac(buf, p + 8)
+        return
+    else:
+        return
+
+    if proto == 6 and p + 4 <= end:
+        out['tcp.tcp.srcport'] = (buf[p] << 8) | buf[p + 1]
+        out['tcp.tcp.dstport'] = (buf[p + 2] << 8) | buf[p + 3]
+    elif proto == 17 and p + 4 <= end:
+        out['udp.udp.srcport'] = (buf[p] << 8) | buf[p + 1]
+        out['udp.udp.dstport'] = (buf[p + 2] << 8) | buf[p + 3]
+    elif proto == 1 and p < end:
+        out['icmp.icmp.type'] = buf[p]
+    elif proto == 2 and p < end:
+        out['igmp.igmp.type'] = buf[p]
+
+
+def iter_column_chunks(path, chunk_rows=100_000, start=None, stop=None):
+    # Decodes the capture (or the byte range start..stop of it) into column
+    # chunks: {column: list} with NATIVE_COLUMNS plus 'frame_index' (0-based
+    # position within the range) and 'record_offset' (byte offset of the
+    # record, used to copy packets out for tshark).
+    with Capture(path) as cap:
+        buf = cap.mm
+        chunk = _empty_chunk()
+        index = 0
+        for ts_sec, ts_nsec, caplen, origlen, linktype, data, rec_off, _ in cap.iter_records(start, stop):
+            out = dict.fromkeys(NATIVE_COLUMNS)
+            out['frame.frame.time_epoch'] = f"{ts_sec}.{ts_nsec:09d}"
+            out['frame.frame.len'] = origlen
+            decode_packet(buf, data, caplen, linktype, out)
+            for col, value in out.items():
+                chunk[col].append(value)
+            chunk['frame_index'].append(index)
+            chunk['record_offset'].append(rec_off)
+            index += 1
+            if len(chunk['frame_index']) >= chunk_rows:
+                yield chunk
+                chunk = _empty_chunk()
+        if chunk['frame_index']:
+            yield chunk
+
+
+def count_records(path):
+    with Capture(path) as cap:
+        return sum(1 for _ in cap.iter_records())
+
+
+# === Virtual shards ===
+def build_index(path, step=1000):
+    # One walk over the record headers. Keeps the byte offset of every
+    # step-th packet (8 bytes per step packets), the packet count and the end
+    # of the last record; enough to cut the capture into shards without
+    # copying it.
+    offsets = array('Q')
+    count = 0
+    end = None
+    with Capture(path) as cap:
+        for *_, rec_off, rec_end in cap.iter_records():
+            if count % step == 0:
+                offsets.append(rec_off)
+            count += 1
+            end = rec_end
+    return {'path': path, 'step': step, 'count': count, 'offsets': offsets, 'end': end}
+
+
+def shard_ranges(index, shard_packets):
+    # [(first_packet, packet_count, byte_start, byte_stop)] for consecutive
+    # shards of shard_packets packets (rounded up to a multiple of the index
+    # step).
+    step = index['step']
+    per_shard = max(1, -(-shard_packets // step))
+    offsets = index['offsets']
+    ranges = []
+    for i in range(0, len(offsets), per_shard):
+        first = i * step
+        count = min(per_shard * step, index['count'] - first)
+        stop = offsets[i + per_shard] if i + per_shard < len(offsets) else index['end']
+        ranges.append((first, count, offsets[i], stop))
+    return ranges
+
+
+def capture_header(cap):
+    # Everything before the first packet record: the pcap global header, or
+    # the pcapng section header + interface blocks. Prepended to a byte range
+    # of records it makes a valid stand-alone capture.
+    first = cap.record_at(None)
+    return cap.mm[:first[6]] if first else cap.mm[:]
+
+
+def stream_shard(path, start, stop, out, block_size=1 << 20):
+    # Writes header + records[start:stop] to out (e.g. tshark's stdin) straight
+    # from the memory map, block by block.
+    with Capture(path) as cap:
+        out.write(capture_header(cap))
+        with memoryview(cap.mm) as view:
+            for pos in range(start, stop, block_size):
+                out.write(view[pos:min(pos + block_size, stop)])
+
+
+def _empty_chunk():
+    chunk = {col: [] for col in NATIVE_COLUMNS}
+    chunk['frame_index'] = []
+    chunk['record_offset'] = []
+    return chunk
+
+
+def iter_rows(chunk, extra=None):
+    # Row view of a column chunk, with values rendered as strings like the
+    # flattened tshark output (absent fields are left out).
+    n = len(chunk['frame_index'])
+    columns = [(col, chunk[col]) for col in NATIVE_COLUMNS]
+    for i in range(n):
+        row = {col: str(values[i]) for col, values in columns if values[i] is not None}
+        if extra:
+            row.update(extra)
+        yield row
+
+
+# === Deep dissection hand-off ===
+def select_deep_frames(chunk, ports):
+    # Positions (within the chunk) of packets whose TCP/UDP ports suggest a
+    # protocol that only tshark can dissect (DNS, TLS, QUIC, FIX, ...).
+    ports = set(ports)
+    cols = [chunk['tcp.tcp.srcport'], chunk['tcp.tcp.dstport'],
+            chunk['udp.udp.srcport'], chunk['udp.udp.dstport']]
+    return [i for i, values in enumerate(zip(*cols)) if any(v in ports for v in values)]
+
+
+def write_pcap_subset(path, record_offsets, out_path):
+    # Copies the given packet records into a classic (nanosecond) pcap so
+    # tshark only has to dissect those packets. Returns the record offsets
+    # actually written: frame n of the subset is written[n - 1]. Packets whose
+    # link type differs from the first one are not copied.
+    rec = struct.Struct('<IIII')
+    written = []
+    linktype = None
+    with Capture(path) as cap, open(out_path, 'wb') as out:
+        for rec_off in record_offsets:
+            record = cap.record_at(rec_off)
+            if record is None:
+                continue
+            ts_sec, ts_nsec, caplen, origlen, lt, data, _, _ = record
+            if linktype is None:
+                linktype = lt
+                out.write(struct.pack('<IHHiIII', 0xA1B23C4D, 2, 4, 0, 0, 262144, linktype))
+            if lt != linktype:
+                continue
+            out.write(rec.pack(ts_sec, ts_nsec, caplen, origlen))
+            out.write(cap.mm[data:data + caplen])
+            written.append(rec_off)
+    return written
@@ -5,10 +5,8 @@ Created on Sat May 10 14:50:49 2025
 @author: baroc
 """
 
-import hashlib
-import ipaddress
+from contextlib import contextmanager
 import pyarrow as pa
-import pyarrow.parquet as pq
 import os
 import pandas as pd
 import duckdb
@@ -16,6 +14,24 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
 
+from artifact_scoring import load_scoring
+from dataset_profile import profile_dataset
+from columnar_enrich import (columns_from_rows, concat_frames, first_mdns_query, iter_enriched_frames, packet_frame,
+                             workload_key)
+from dns_index import DnsIndex, upsert_dns_index
+from ingest_sinks import decoded_batch, is_parquet_input, open_parquet_dataset, restore_nested_row
+from ip_classify import IpClassifier
+from output_schema import write_compact
+from parallel_ingest import spill_shards
+from star_schema import star_views, write_star
+from time_partitions import partition_view, write_partitioned
+from workload_eda import histogram, reservoir_sample
+from workload_report import null_counts, report_metrics, report_sections
+from workload_sql import build_in_duckdb
+from workload_state import approximation_report, build_approximate, ingest_capture
+from workload_features import (PacketSpill, apply_workload_features, build_out_of_core, chunk_rows_for_budget,
+                               compute_thresholds, upsert_workload_ids, workload_aggregates, workload_lookup)
+
 
 def extract_fields(row):
     try:
@@ -31,18 +47,8 @@ def extract_fields(row):
     mdns_query_type = None
     mdns_query_name_raw = None
 
-    try:
-        if 'mdns.Queries' in row:
-            import ast
-            queries = ast.literal_eval(row['mdns.Queries']) if isinstance(row['mdns.Queries'], str) else row['mdns.Queries']
-            for q in queries.values():
-                if isinstance(q, dict):
-                    mdns_query_name = q.get('dns.qry.name')
-                    mdns_query_type = q.get('dns.qry.type')
-                    mdns_query_name_raw = q.get('dns.qry.name_raw')
-                    break
-    except Exception:
-        pass
+    if 'mdns.Queries' in row:
+        mdns_query_name, mdns_query_type, mdns_query_name_raw = first_mdns_query(row['mdns.Queries'])
 
     dns_query = (
         row.get('dns.qry.name') or
@@ -63,6 +69,7 @@ def extract_fields(row):
     dns_query_name_raw = row.get('dns.qry.name_raw') or mdns_query_name_raw
 
     return {
+        'capture_id': row.get('capture_id'),
         'mac_src': row.get('eth.eth.src'),
         'mac_dst': row.get('eth.eth.dst'),
         'frame_len': row.get('frame.frame.len'),
@@ -97,12 +104,6 @@ def extract_fields(row):
         'arp_src_hw_mac': row.get('arp.arp.src.hw_mac'),
     }
 
-def ip_is_internal(ip):
-    try:
-        return ipaddress.ip_address(ip).is_private
-    except:
-        return None
-
 def classify_flow(src, dst):
     if src and not dst:
         return 'internal_to_external'
@@ -121,7 +122,7 @@ def build_workload_id_src(e):
         str(e.get("ip_src", "")),
         str(e.get("src_port", ""))
     ]
-    return hashlib.sha1("|".join(parts).encode()).hexdigest()
+    return workload_key(*parts)
 
 def build_workload_id_dst(e):
     parts = [
@@ -129,7 +130,7 @@ def build_workload_id_dst(e):
         str(e.get("ip_dst", "")),
         str(e.get("dst_port", ""))
     ]
-    return hashlib.sha1("|".join(parts).encode()).hexdigest()
+    return workload_key(*parts)
 
 def is_virtual_mac(mac):
     if not isinstance(mac, str): return False
@@ -138,20 +139,37 @@ def is_virtual_mac(mac):
         '08:00:27', '00:03:FF', '52:54:00', '00:15:5D'
     }
 
-def stream_process_json(json_path, out_parquet):
+@contextmanager
+def open_packet_rows(path, batch_rows=65_536):
+    # Packets from get_data_script.py: either the JSON array (ijson) or the
+    # Parquet dataset written with output_format = "parquet".
+    if is_parquet_input(path):
+        batches = open_parquet_dataset(path).to_batches(batch_size=batch_rows)
+        yield (restore_nested_row(row) for batch in batches for row in decoded_batch(batch).to_pylist())
+        return
+
     import ijson
+    with open(path, 'rb') as f:
+        yield ijson.items(f, 'item')
 
+def attach_capture_metadata(df, capture_table, columns=None):
+    # Capture-level (capinfos) metadata lives in its own table; join it onto
+    # packet/workload rows only when it is actually needed.
+    captures = pd.read_parquet(capture_table, columns=None if columns is None else ['capture_id'] + list(columns))
+    return df.merge(captures, on='capture_id', how='left')
+
+def iter_entry_chunks(json_path, chunk_rows, classifier, dns=None):
     buffer = []
+    rows = []
 
-    with open(json_path, 'rb') as f:
-        parser = ijson.items(f, 'item')
+    with open_packet_rows(json_path) as parser:
         for row in parser:
             entry = extract_fields(row)
             entry['src_port'] = entry['tcp_srcport'] or entry['udp_srcport']
             entry['dst_port'] = entry['tcp_dstport'] or entry['udp_dstport']
             entry['ip_ttl'] = row.get('ip.ip.ttl')
-            entry['src_is_internal'] = ip_is_internal(entry['ip_src'])
-            entry['dst_is_internal'] = ip_is_internal(entry['ip_dst'])
+            entry['src_is_internal'] = classifier.is_internal(entry['ip_src'])
+            entry['dst_is_internal'] = classifier.is_internal(entry['ip_dst'])
             entry['flow_relation'] = classify_flow(entry['src_is_internal'], entry['dst_is_internal'])
             entry['mac_ip_combo'] = f"{entry['mac_src']}|{entry['ip_src']}"
             entry['workload_id_src'] = build_workload_id_src(entry)
@@ -187,328 +205,172 @@ def stream_process_json(json_path, out_parquet):
             #     continue
 
             buffer.append(entry)
-
-    df = pd.DataFrame(buffer)
-    
-    df['epoch_minute'] = pd.to_numeric(df['epoch_minute'], errors='coerce')
-
-    df['financial_suspect_score'] = (
-        df['is_tls_without_http'].astype(int) * 3 +
-        df['is_large_frame'].astype(int) +
-        df['is_dns_query'].astype(int) +
-        df['is_quic'].astype(int) +
-        df['tcp_dstport'].apply(lambda p: int(p in [443, 8443, 8080, 5000, 9000]) if pd.notnull(p) else 0) +
-        df['udp_dstport'].apply(lambda p: int(p in [161, 162, 830]) if pd.notnull(p) else 0) +
-        df['fix_msg_type'].notnull().astype(int) * 4 +
-        df['swift_field'].notnull().astype(int) * 4 +
-        df['iso8583_field'].notnull().astype(int) * 4
-    )
-    df['is_likely_financial'] = df['financial_suspect_score'] >= 4
-
-
-    # Ensure numeric conversion
-    df['frame_time_epoch'] = pd.to_numeric(df['frame_time_epoch'], errors='coerce')
-    df['frame_len'] = pd.to_numeric(df['frame_len'], errors='coerce')
-    df['tcp_dstport'] = pd.to_numeric(df['tcp_dstport'], errors='coerce')
-    df['udp_dstport'] = pd.to_numeric(df['udp_dstport'], errors='coerce')
-
-    # === Source workload logic ===
-    session_len_src = df['frame_time_epoch'].groupby(df['workload_id_src']).agg(lambda x: x.max() - x.min())
-    df['session_length_src'] = df['workload_id_src'].map(session_len_src)
-    df['session_length_src'] = df.groupby('workload_id_src')['frame_time_epoch'].transform(lambda x: x.max() - x.min())
-    avg_payload_src = df['frame_len'].groupby(df['workload_id_src']).mean()
-    df['avg_payload_size_src'] = df['workload_id_src'].map(avg_payload_src)
-    df['is_data_heavy_src'] = df['avg_payload_size_src'] > 800
-    df['is_fin_api_pattern_src'] = df['is_tls_without_http'] & df['is_data_heavy_src']
-
-    # === Destination workload logic ===
-    session_len_dst = df['frame_time_epoch'].groupby(df['workload_id_dst']).agg(lambda x: x.max() - x.min())
-    df['session_length_dst'] = df['workload_id_dst'].map(session_len_dst)
-    df['session_length_dst'] = df.groupby('workload_id_dst')['frame_time_epoch'].transform(lambda x: x.max() - x.min())
-    avg_payload_dst = df['frame_len'].groupby(df['workload_id_dst']).mean()
-    df['avg_payload_size_dst'] = df['workload_id_dst'].map(avg_payload_dst)
-
-    # === Traffic patterns ===
-    df['is_data_heavy_dst'] = df['avg_payload_size_dst'] > 800
-    df['is_fin_api_pattern_dst'] = df['is_tls_without_http'] & df['is_data_heavy_dst']
-
-    data_vol = df.groupby('mac_ip_combo')['frame_len'].sum()
-    df['data_volume'] = df['mac_ip_combo'].map(data_vol)
-    df['is_data_intensive'] = df['data_volume'] > df['data_volume'].quantile(0.60)  # lower quantile
-
-    # Updated session volatility using session_length_src
-    session_volatility_src = df.groupby('mac_ip_combo')['session_length_src'].std()
-    df['session_volatility'] = df['mac_ip_combo'].map(session_volatility_src)
-    df['is_stable_workload'] = df['session_volatility'] < df['session_volatility'].median()
-
-    # Compliance check using session_length_src
-    df['is_compliance_sensitive'] = (df['flow_relation'] == 'internal_only') & (
-        df['session_length_src'] > df['session_length_src'].median())
-
-    # Classify backend/gateway logic using dst-side API patterns
-    df['is_api_backend'] = df['is_fin_api_pattern_dst'] & df['is_data_heavy_dst']
-    df['is_gateway_pattern'] = df['is_fin_api_pattern_dst'] & ~df['is_data_heavy_dst']
-    
-    
-    def infer_artifact(row):
-        # Serverless: stable session, low overhead, TLS, bursty, often stateless
-        if row['is_fin_api_pattern_dst'] and row['is_stable_workload'] and row['is_bursty_dst']:
-            return 'serverless'
-    
-        # Orchestrated Container: container-like, but fan-out/fan-in + orchestration signs
-        elif row['is_possible_container_dst'] and row['peer_count_dst'] >= 5 and row['is_bursty_dst']:
-            return 'orchestrated_container'
-    
-        # Mini-VM: signs of virtualization, stable and lower overhead than full VM
-        elif row['is_virtual_machine'] and row['is_stable_workload'] and not row['is_data_intensive']:
-            return 'mini_vm'
-    
-        # Full VM: virtualized, longer sessions, heavier load
-        elif row['is_virtual_machine'] and (row['is_data_intensive'] or not row['is_stable_workload']):
-            return 'vm'
-    
-        # Container: stateless-ish, volatile, frequent port reuse
-        elif row['is_possible_container_dst']:
-            return 'container'
-    
-        # Baremetal: stable, high data volume, physical, often long sessions
-        elif row['is_physical_machine'] and row['is_data_intensive'] and row['is_compliance_sensitive']:
-            return 'baremetal'
-    
-        return 'unknown'
-    
-    df.loc[df['is_fin_api_pattern_dst'] & df['is_stable_workload'], 'inferred_artifact_type'] = 'serverless'
-    df.loc[df['is_api_backend'] & ~df['is_stable_workload'], 'inferred_artifact_type'] = 'vm'
-    df.loc[df['is_gateway_pattern'], 'inferred_artifact_type'] = 'load_balancer'
-    df.loc[df['is_stable_workload'] & df['is_data_intensive'], 'inferred_artifact_type'] = 'container'
-    df.loc[df['is_compliance_sensitive'], 'inferred_artifact_type'] = 'baremetal'
-    
-    # === INFRASTRUCTURE HEURISTICS ===
-    ip_mac_df = df.groupby('ip_src')['mac_src'].nunique()
-    switch_ips = set(ip_mac_df[ip_mac_df > 3].index)
-    df['is_possible_switch'] = df['ip_src'].isin(switch_ips)
-
-    macs_as_src = set(df['mac_src'])
-    macs_as_dst = set(df['mac_dst'])
-    df['is_forward_only_mac'] = df['mac_src'].isin(macs_as_src - macs_as_dst)
-    df['is_broadcast'] = df['mac_dst'] == 'ff:ff:ff:ff:ff:ff'
-    df['is_possible_switch'] |= df['is_forward_only_mac'] | df['is_broadcast']
-
-    def classify_router(row):
-        if row['flow_relation'] in ['external_to_internal', 'internal_to_external', 'external_only']:
-            return 'external_router'
-        elif row['flow_relation'] == 'internal_only' and row['src_is_internal'] and row['dst_is_internal']:
-            return 'internal_router'
-        return 'client'
-
-    df['dst_role'] = 'client'
-    df.loc[df['flow_relation'].isin(['external_to_internal', 'internal_to_external', 'external_only']),'dst_role'] = 'external_router'
-    df.loc[(df['flow_relation'] == 'internal_only') & df['src_is_internal'] & df['dst_is_internal'],'dst_role'] = 'internal_router'
-
-    ip_mac_count = df.groupby('ip_src')['mac_src'].nunique()
-    ip_reuse_threshold = ip_mac_count.median()
-    df['is_possible_vm_by_ip_reuse'] = df['ip_src'].map(ip_mac_count) > ip_reuse_threshold
-
-    # Session volatility (container heuristic) per workload_id_src and dst
-    session_counts_src = df.groupby('mac_ip_combo')['workload_id_src'].nunique()
-    df['session_volatility_src'] = df['mac_ip_combo'].map(session_counts_src)
-    df['is_possible_container_src'] = df['session_volatility_src'] > df['session_volatility_src'].quantile(0.65)
-
-    session_counts_dst = df.groupby('mac_ip_combo')['workload_id_dst'].nunique()
-    df['session_volatility_dst'] = df['mac_ip_combo'].map(session_counts_dst)
-    df['is_possible_container_dst'] = df['session_volatility_dst'] > df['session_volatility_dst'].quantile(0.65)
-
-    ttl_std = df.groupby('mac_ip_combo')['ip_ttl'].std()
-    df['ttl_variability'] = df['mac_ip_combo'].map(ttl_std)
-    df['is_ttl_unstable'] = df['ttl_variability'] > (ttl_std.median() + ttl_std.std())
-
-    virtual_flags = (
-        df['is_virtual_machine'] |
-        df['is_possible_vm_by_ip_reuse'] |
-        df['is_possible_container_src'] |
-        df['is_possible_container_dst'] |
-        df['is_ttl_unstable']
-    )
-    df['is_physical_machine'] = ~virtual_flags
-    
-    
-    def score_serverless(row):
-        return 1.0 * row['is_fin_api_pattern_dst'] + \
-               1.0 * row['is_stable_workload'] + \
-               1.0 * row['is_bursty_dst']
-
-    def score_container(row):
-        return 1.0 * row['is_possible_container_dst'] + \
-               1.0 * row['is_data_heavy_dst']
-    
-    def score_orch_container(row):
-        return 1.0 * row['is_possible_container_dst'] + \
-               (row['peer_count_dst'] / 10 if pd.notnull(row['peer_count_dst']) else 0)
-    
-    def score_vm(row):
-        return 1.0 * row['is_virtual_machine'] + \
-               1.0 * row['is_data_intensive']
-    
-    def score_minivm(row):
-        return 1.0 * row['is_virtual_machine'] + \
-               1.0 * row['is_stable_workload'] * (1.0 - row['is_data_intensive'])
-    
-    def score_baremetal(row):
-        return 1.0 * row['is_physical_machine'] + \
-               1.0 * row['is_data_intensive'] + \
-               1.0 * row['is_compliance_sensitive']
-    
-    # Apply score and ranking
-    def rank_artifact_types(row):
-        scores = {
-            'serverless': score_serverless(row),
-            'container': score_container(row),
-            'orchestrated_container': score_orch_container(row),
-            'vm': score_vm(row),
-            'mini_vm': score_minivm(row),
-            'baremetal': score_baremetal(row)
-        }
-        ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-        row['artifact_type_ranked'] = [t[0] for t in ranked]
-        row['artifact_type_top'] = ranked[0][0]
-        row['artifact_type_top_score'] = ranked[0][1]
-        return row
-  
-
-    # --- Additional fallback: assign VM if virtual indicators ---
-    df.loc[(df['inferred_artifact_type'] == 'unknown') &
-           (df['is_virtual_machine'] | df['is_possible_vm_by_ip_reuse']),
-           'inferred_artifact_type'] = 'vm'
-    
-    # --- Fallback: assign Container if container-like volatility ---
-    df.loc[(df['inferred_artifact_type'] == 'unknown') &
-           (df['is_possible_container_dst'] | df['is_possible_container_src']),
-           'inferred_artifact_type'] = 'container'
-    
-    # --- Fallback: assign based on router/switch roles ---
-    df.loc[(df['inferred_artifact_type'] == 'unknown') &
-           (df['dst_role'].str.contains('router')), 'inferred_artifact_type'] = 'vm'
-    
-    df.loc[(df['inferred_artifact_type'] == 'unknown') &
-           (df['is_possible_switch']), 'inferred_artifact_type'] = 'baremetal'
-    
-    # --- Fallback: assign container if stable + heavy ---
-    df.loc[(df['inferred_artifact_type'] == 'unknown') &
-           (df['is_data_heavy_dst'] & df['is_stable_workload']),
-           'inferred_artifact_type'] = 'container'
-    
-# === COMMUNICATION PATTERNS ===
-
-    # Persistence per src and dst workload
-    active_sec_src = df.groupby('workload_id_src')['frame_time_epoch'].agg(lambda x: x.max() - x.min())
-    df['active_seconds_src'] = df['workload_id_src'].map(active_sec_src)
-    active_sec_dst = df.groupby('workload_id_dst')['frame_time_epoch'].agg(lambda x: x.max() - x.min())
-    df['active_seconds_dst'] = df['workload_id_dst'].map(active_sec_dst)
-    conn_count_src = df.groupby('workload_id_src')['frame_time_epoch'].count()
-    df['connection_count_src'] = df['workload_id_src'].map(conn_count_src)
-    conn_count_dst = df.groupby('workload_id_dst')['frame_time_epoch'].count()
-    df['connection_count_dst'] = df['workload_id_dst'].map(conn_count_dst)
-
-    # Symmetry / Delay
-    df['bytes_sent'] = df.groupby(['mac_src', 'ip_src'])['frame_len'].transform('sum')
-    df['bytes_received'] = df.groupby(['mac_dst', 'ip_dst'])['frame_len'].transform('sum')
-
-    df['response_delay_src'] = df.groupby('workload_id_src')['frame_time_epoch'].transform(
-    lambda x: np.median(np.diff(np.sort(x))) if len(x) > 1 else 0)
-    df['response_delay_dst'] = df.groupby('workload_id_dst')['frame_time_epoch'].transform(
-    lambda x: np.median(np.diff(np.sort(x))) if len(x) > 1 else 0)
-
-    # Fanout / Fanin
-    peer_src = df.groupby(['mac_src', 'ip_src'])['ip_dst'].nunique()
-    peer_dst = df.groupby(['mac_dst', 'ip_dst'])['ip_src'].nunique()
-    df['peer_count_src'] = df.set_index(['mac_src', 'ip_src']).index.map(peer_src)
-    df['peer_count_dst'] = df.set_index(['mac_dst', 'ip_dst']).index.map(peer_dst)
-
-    # Rhythmic behavior
-    minute_count_src = df.groupby('workload_id_src')['epoch_minute'].nunique()
-    df['active_minute_count_src'] = df['workload_id_src'].map(minute_count_src)
-    burstiness_ratio = df['active_minute_count_src'] / (df['active_seconds_src'] / 60).clip(lower=1)
-    df['is_bursty_src'] = burstiness_ratio < burstiness_ratio.median()
-
-    minute_count_dst = df.groupby('workload_id_dst')['epoch_minute'].nunique()
-    df['active_minute_count_dst'] = df['workload_id_dst'].map(minute_count_dst)
-    burstiness_ratio = df['active_minute_count_dst'] / (df['active_seconds_dst'] / 60).clip(lower=1)
-    df['is_bursty_dst'] = burstiness_ratio < burstiness_ratio.median()
-    
-    
-    scores = pd.DataFrame({
-        'serverless': df['is_fin_api_pattern_dst'].astype(int)
-                     + df['is_stable_workload'].astype(int)
-                     + df['is_bursty_dst'].astype(int),
-        
-        'container': df['is_possible_container_dst'].astype(int)
-                     + df['is_data_heavy_dst'].astype(int),
-        
-        'orchestrated_container': df['is_possible_container_dst'].astype(int)
-                     + (df['peer_count_dst'] / 10.0).fillna(0),
-        
-        'vm': df['is_virtual_machine'].astype(int)
-              + df['is_data_intensive'].astype(int)
-              + (df['response_delay_dst'].fillna(0) / 10),  # Add delay signal for VM
-        
-        'mini_vm': df['is_virtual_machine'].astype(int)
-                   + df['is_stable_workload'].astype(int) * (1 - df['is_data_intensive'].astype(int)),
-        
-        'baremetal': df['is_physical_machine'].astype(int)
-               + df['is_data_intensive'].astype(int)
-               + df['is_compliance_sensitive'].astype(int)
-               + (df['response_delay_dst'].fillna(0) / 10),  # Add delay signal for baremetal
-    })
-    
-    # Normalize scores safely
-    score_values = scores.values
-    row_sums = score_values.sum(axis=1, keepdims=True)
-    row_sums[row_sums == 0] = 1  # prevent division by 0
-    
-    normalized_scores = score_values / row_sums
-    
-    # Avoid log(0) by using a safe clipped version
-    safe_scores = np.clip(normalized_scores, 1e-12, 1.0)
-    
-    df['artifact_type_entropy'] = -np.sum(safe_scores * np.log(safe_scores), axis=1)
-            
-    df['artifact_type_top'] = scores.idxmax(axis=1)
-    df['artifact_type_top_score'] = scores.max(axis=1)
-    df['artifact_type_ranked'] = scores.apply(lambda row: list(row.sort_values(ascending=False).index), axis=1)
-    
-    # Fallback: assign top artifact when entropy is low and no label exists
-    low_entropy_thresh = 0.75
-    df.loc[df['inferred_artifact_type'].isnull() & (df['artifact_type_entropy'] < low_entropy_thresh),
-       'inferred_artifact_type'] = df['artifact_type_top']
-
-    # Absolute fallback: if any labels are still missing, use the top-ranked one
-    df.loc[df['inferred_artifact_type'].isnull() & df['artifact_type_top'].notnull(),
-       'inferred_artifact_type'] = df['artifact_type_top']
-    
-    # Fallback: assign top artifact when entropy is low and no label exists
-    low_entropy_thresh = 0.75  # Tunable
-    df.loc[df['inferred_artifact_type'].isnull() & (df['artifact_type_entropy'] < low_entropy_thresh),
-       'inferred_artifact_type'] = df['artifact_type_top']
-    
-    # Save to Parquet
-    table = pa.Table.from_pandas(df)
-    pq.write_table(table, out_parquet)
+            if dns is not None:
+                rows.append(row)
+            if chunk_rows and len(buffer) >= chunk_rows:
+                if dns is not None:
+                    dns.add(columns_from_rows(rows), len(rows))
+                    rows = []
+                yield buffer
+                buffer = []
+
+    if buffer:
+        if dns is not None:
+            dns.add(columns_from_rows(rows), len(rows))
+        yield buffer
+
+def report_invalid_ips(classifier):
+    if classifier.invalid:
+        sample = ', '.join(sorted(classifier.invalid)[:5])
+        print(f"Warning: {len(classifier.invalid)} unparseable IP address value(s), classified as unknown: {sample}")
+
+def stream_process_json(json_path, out_parquet, memory_budget_mb=None, chunk_rows=None, spill_dir=None,
+                        columnar=False, workload_ids=None, ip_classifier=None, backend='pandas', state_dir=None,
+                        layout='wide', scoring=None, approximate=False, compare_sample_rows=None, workers=None,
+                        dns_index=None):
+    # json_path: one capture, or a list of shards (files / Parquet dataset directories) in packet order
+    # memory_budget_mb / chunk_rows: build out of core (see workload_features.py)
+    # backend='duckdb': all feature engineering as DuckDB SQL (see workload_sql.py)
+    # state_dir: merge into persisted aggregate state; features cover all captures so far (see workload_state.py)
+    # workload_ids: Parquet lookup table workload_id -> (mac, ip, port) as hashed (missing parts 'None'),
+    #   merged across runs
+    # ip_classifier: ip_classify.IpClassifier defining "internal" (default: is_private)
+    # scoring: artifact scoring rules and weights (see artifact_scoring.py; default: built-in)
+    # layout='star': out_parquet is a directory of workloads/flows/packets tables (see star_schema.py)
+    # layout='partitioned': out_parquet is a day/hour partitioned, sorted dataset (see time_partitions.py)
+    # approximate: distinct counts and quantiles from mergeable sketches, always out of core (see sketches.py)
+    # compare_sample_rows: print exact vs approximate results on a sample of that many packets
+    # workers: enrich shards and derive features in that many processes, always out of core and
+    #   columnar (see parallel_ingest.py); same output as one process
+    # dns_index: Parquet side index ip -> DNS/mDNS names, merged across runs (see dns_index.py)
+    if layout != 'wide':
+        wide = out_parquet.rstrip('/\\') + '.tmp.parquet'
+        try:
+            stream_process_json(json_path, wide, memory_budget_mb, chunk_rows, spill_dir, columnar,
+                                workload_ids, ip_classifier, backend, state_dir, scoring=scoring,
+                                approximate=approximate, compare_sample_rows=compare_sample_rows,
+                                workers=workers, dns_index=dns_index)
+            if layout == 'star':
+                write_star(wide, out_parquet, memory_budget_mb)
+            else:
+                write_partitioned(wide, out_parquet, memory_budget_mb)
+        finally:
+            if os.path.exists(wide):
+                os.remove(wide)
+        return
+    parallel = workers is not None and workers > 1
+    if (memory_budget_mb or backend == 'duckdb' or state_dir or approximate or compare_sample_rows
+            or parallel) and not chunk_rows:
+        chunk_rows = chunk_rows_for_budget(memory_budget_mb) if memory_budget_mb else 65_536
+    inputs = [json_path] if isinstance(json_path, str) else list(json_path)
+    classifier = ip_classifier or IpClassifier()
+    dns = DnsIndex() if dns_index else None
+    if columnar:
+        chunks = (frame for path in inputs
+                  for frame in iter_enriched_frames(path, chunk_rows or 65_536, classifier, dns=dns))
+    else:
+        chunks = (entries for path in inputs for entries in iter_entry_chunks(path, chunk_rows, classifier, dns))
+
+    if chunk_rows:
+        spill = PacketSpill(spill_dir, near=out_parquet)
+        ids = None
+        try:
+            if parallel:
+                ids = spill_shards(inputs, spill, chunk_rows, classifier, workers, lookup=bool(workload_ids),
+                                   dns=dns)
+            else:
+                for entries in chunks:
+                    frame = packet_frame(entries)
+                    spill.write(frame)
+                    if workload_ids:
+                        ids = workload_lookup(frame, ids)
+            report_invalid_ips(classifier)
+            if compare_sample_rows:
+                print("\n==== APPROXIMATE vs EXACT (sample) ====")
+                print(approximation_report(spill, compare_sample_rows, memory_budget_mb).to_string(index=False))
+            if state_dir:
+                ingest_capture(spill, state_dir, out_parquet, memory_budget_mb, chunk_rows, backend, scoring,
+                               approximate, workers)
+            elif approximate:
+                build_approximate(spill, out_parquet, memory_budget_mb, chunk_rows, backend, scoring, workers)
+            elif backend == 'duckdb':
+                build_in_duckdb(spill, out_parquet, memory_budget_mb, scoring=scoring)
+            else:
+                build_out_of_core(spill, out_parquet, memory_budget_mb, chunk_rows, scoring, workers)
+        finally:
+            spill.remove()
+        if ids is not None:
+            upsert_workload_ids(workload_ids, ids)
+        if dns is not None:
+            upsert_dns_index(dns_index, dns.table)
+        return
+
+    if columnar:
+        df = packet_frame(concat_frames(chunks))
+    else:
+        df = packet_frame([entry for entries in chunks for entry in entries])
+    report_invalid_ips(classifier)
+
+    # Per-workload and per-host statistics in one pass, broadcast onto the packets
+    aggs = workload_aggregates(df)
+    df = apply_workload_features(df, aggs, compute_thresholds(aggs), scoring)
+
+    if workload_ids:
+        upsert_workload_ids(workload_ids, workload_lookup(df))
+    if dns is not None:
+        upsert_dns_index(dns_index, dns.table)
+
+    # Save to Parquet (compact column types, see output_schema.py)
+    write_compact([pa.Table.from_pandas(df, preserve_index=False)], out_parquet)
 
 
 # ---------------- Entry Point ----------------
 json_file = "C:/Users/baroc/Downloads/full_capture_CICIDS.json"
 parquet_file = "C:/Users/baroc/Downloads/all_workloads_CICIDS.parquet"
-
-if os.path.exists(parquet_file):
+star_dir = "C:/Users/baroc/Downloads/all_workloads_CICIDS_star"
+partitioned_dir = "C:/Users/baroc/Downloads/all_workloads_CICIDS_by_hour"
+capture_table = "C:/Users/baroc/Downloads/captures.parquet"
+workload_ids_table = "C:/Users/baroc/Downloads/workload_ids.parquet"
+dns_index_table = "C:/Users/baroc/Downloads/dns_index.parquet"  # ip -> DNS/mDNS names (see dns_index.py)
+# "Internal" address space: None = Python's is_private; or an explicit list,
+# e.g. ip_classify.RFC1918 + site ranges. site_cidrs are added either way.
+internal_cidrs = None
+site_cidrs = []
+memory_budget_mb = None  # e.g. 8192: spill to disk and build out of core
+columnar = True  # vectorized enrichment; False = original per-row loop
+backend = 'pandas'  # 'duckdb': feature engineering in DuckDB, for captures larger than RAM
+state_dir = None  # e.g. "C:/Users/baroc/Downloads/workload_state": merge each new capture into it
+layout = 'wide'  # 'star': workload dimension + flow and packet tables in star_dir instead of one wide file
+# 'partitioned': day/hour partitions in partitioned_dir, sorted for row-group skipping
+outputs = {'wide': parquet_file, 'star': star_dir, 'partitioned': partitioned_dir}
+scoring_file = None  # e.g. "C:/Users/baroc/Downloads/artifact_scoring.json": tuned rules/weights (see artifact_scoring.py)
+approximate = False  # True: sketches for distinct counts / quantiles, bounded memory (see sketches.py)
+compare_sample_rows = None  # e.g. 100_000: print approximate vs exact results on a sample first
+workers = None  # e.g. os.cpu_count(): enrich capture shards and derive features in parallel processes
+
+if layout == 'wide' and os.path.exists(parquet_file):
     os.remove(parquet_file)
 
-stream_process_json(json_file, parquet_file)
+stream_process_json(json_file, outputs[layout], memory_budget_mb=memory_budget_mb, columnar=columnar,
+                    workload_ids=workload_ids_table, ip_classifier=IpClassifier(internal_cidrs, site_cidrs),
+                    backend=backend, state_dir=state_dir, layout=layout, scoring=load_scoring(scoring_file),
+                    approximate=approximate, compare_sample_rows=compare_sample_rows, workers=workers,
+                    dns_index=dns_index_table)
 
 
 # ---------------DUCKDB: VIEW DATA & SAVE --------
 # Load the Parquet file
 parquet_file = "C:/Users/baroc/Downloads/all_workloads_CICIDS.parquet"
 con = duckdb.connect()
+if layout == 'star':
+    # all_workloads: the wide table rebuilt by joining the star tables
+    star_views(con, star_dir)
+    workloads_source = "all_workloads"
+elif layout == 'partitioned':
+    partition_view(con, partitioned_dir)
+    workloads_source = "all_workloads"
+else:
+    workloads_source = f"parquet_scan('{parquet_file}')"
 
 # Helper function for labeled output
 def show(title, query):
@@ -517,228 +379,41 @@ def show(title, query):
 
 # Preview
 show("Sample Preview (20 rows)", f"""
-    SELECT * FROM parquet_scan('{parquet_file}') LIMIT 20
+    SELECT * FROM {workloads_source} LIMIT 20
 """)
 
-# === MISSING VALUES CHECK ===
-columns = [row[0] for row in con.execute(f"DESCRIBE SELECT * FROM parquet_scan('{parquet_file}')").fetchall()]
-query = f"""
-    SELECT {', '.join([f"SUM(CASE WHEN {col} IS NULL THEN 1 ELSE 0 END) AS {col}_missing" for col in columns])}
-    FROM parquet_scan('{parquet_file}')
-"""
-
-# Flatten and reshape the output to match show() format
-missing_df = con.execute(query).df().T.reset_index()
-missing_df.columns = ['Column', 'Missing Count']
-missing_df = missing_df.sort_values(by='Missing Count', ascending=False).reset_index(drop=True)
-
-print("\n==== MISSING VALUES SUMMARY ====")
-print(missing_df)
-
-# workloads (initiators vs responders)
-show("WORKLOADS: Count of Source and Destination Workloads", f"""
-    SELECT
-        COUNT(workload_id_src) AS src_workloads,
-        COUNT(workload_id_dst) AS dst_workloads
-    FROM parquet_scan('{parquet_file}')
-""")
-
-
-# Unique workloads (initiators vs responders)
-show("WORKLOADS: Count of Unique Source and Destination Workloads", f"""
-    SELECT
-        COUNT(DISTINCT workload_id_src) AS unique_src_workloads,
-        COUNT(DISTINCT workload_id_dst) AS unique_dst_workloads
-    FROM parquet_scan('{parquet_file}')
-""")
-
-# --------- TRAFFIC PATTERN ANALYSIS ----------------
-
-''' packet characteristics, volume, protocols, and infrastructure '''
-
-# Frame and TTL stats
-show("TRAFFIC: Frame Size and TTL Distribution", f"""
-    SELECT
-        AVG(CAST(frame_len AS DOUBLE)) AS avg_frame_len,
-        MAX(CAST(frame_len AS DOUBLE)) AS max_frame_len,
-        MIN(CAST(frame_len AS DOUBLE)) AS min_frame_len,
-        AVG(CAST(ip_ttl AS DOUBLE)) AS avg_ttl,
-        MAX(CAST(ip_ttl AS DOUBLE)) AS max_ttl,
-        MIN(CAST(ip_ttl AS DOUBLE)) AS min_ttl
-    FROM parquet_scan('{parquet_file}')
-""")
-
-# Add Workload Counts by Protocol Involvement
-show("WORKLOADS: Count of Protocol Usage by Unique Workloads", f"""
-    SELECT
-        COUNT(DISTINCT workload_id_src) FILTER (WHERE has_tls) AS tls_src,
-        COUNT(DISTINCT workload_id_dst) FILTER (WHERE has_tls) AS tls_dst,
-        COUNT(DISTINCT workload_id_src) FILTER (WHERE has_fix) AS fix_src,
-        COUNT(DISTINCT workload_id_dst) FILTER (WHERE has_fix) AS fix_dst,
-        COUNT(DISTINCT workload_id_src) FILTER (WHERE has_iso8583) AS iso8583_src,
-        COUNT(DISTINCT workload_id_dst) FILTER (WHERE has_iso8583) AS iso8583_dst
-    FROM parquet_scan('{parquet_file}')
-""")
-
-# Protocol usage summary
-show("TRAFFIC: Protocol Presence", f"""
-    SELECT
-        SUM(has_tcp::INT) AS tcp,
-        SUM(has_udp::INT) AS udp,
-        SUM(has_tls::INT) AS tls,
-        SUM(has_fix::INT) AS fix,
-        SUM(has_iso8583::INT) AS iso8583,
-        SUM(has_swift::INT) AS swift,
-        SUM(has_rtsp::INT) AS rtsp,
-        SUM(has_rtp::INT) AS rtp,
-        SUM(has_rtcp::INT) AS rtcp,
-        SUM(has_icmp::INT) AS icmp,
-        SUM(has_arp::INT) AS arp,
-        SUM(has_igmp::INT) AS igmp
-    FROM parquet_scan('{parquet_file}')
-""")
-
-# TLS/QUIC/DNS
-show("TRAFFIC: DNS & QUIC/TLS Detection", f"""
-    SELECT
-        SUM(is_dns_query::INT) AS dns_queries,
-        SUM(is_dns_response::INT) AS dns_responses,
-        SUM(is_quic::INT) AS quic_suspected,
-        SUM(is_tls_without_http::INT) AS tls_wo_http
-    FROM parquet_scan('{parquet_file}')
-""")
-
-
-
-# Financial flags
-show("TRAFFIC: Financial Protocol Activity", f"""
-    SELECT
-        SUM(is_likely_financial::INT) AS likely_financial_flows,
-        AVG(financial_suspect_score) AS avg_score,
-        MAX(financial_suspect_score) AS max_score
-    FROM parquet_scan('{parquet_file}')
-""")
-
-# Switches, Routers, Machines
-show("TRAFFIC: Switch Detection", f"""
-    SELECT COUNT(*) AS possible_switches
-    FROM parquet_scan('{parquet_file}')
-    WHERE is_possible_switch
-""")
-
-show("TRAFFIC: Router Roles", f"""
-    SELECT dst_role, COUNT(*) AS count
-    FROM parquet_scan('{parquet_file}')
-    GROUP BY dst_role
-""")
-
-show("TRAFFIC: Virtual/Physical Host Summary", f"""
-    SELECT
-        SUM(is_virtual_machine::INT) AS vm_oui,
-        SUM(is_possible_vm_by_ip_reuse::INT) AS vm_by_ip_reuse,
-        SUM(is_possible_container_src::INT + is_possible_container_dst::INT) AS containers,
-        SUM(is_ttl_unstable::INT) AS ttl_unstable,
-        SUM(is_physical_machine::INT) AS physical_hosts
-    FROM parquet_scan('{parquet_file}')
-""")
-
-
-# -------- COMMUNICATION PATTERN ANALYSIS ---------
-
-'''behavior over time, interaction, and flow characteristics'''
-
-# Communication Persistence (source & destination)
-show("COMM: Persistence by Workload Source", f"""
-    SELECT
-        ROUND(AVG(active_seconds_src), 2) AS avg_active_seconds_src,
-        ROUND(MAX(active_seconds_src), 2) AS max_active_seconds_src,
-        ROUND(AVG(connection_count_src), 2) AS avg_connection_count_src,
-        COUNT(*) FILTER (WHERE active_seconds_src > 60) AS sessions_over_1_minute_src
-    FROM parquet_scan('{parquet_file}')
-""")
-
-show("COMM: Persistence by Workload Destination", f"""
-    SELECT
-        ROUND(AVG(active_seconds_dst), 2) AS avg_active_seconds_dst,
-        ROUND(MAX(active_seconds_dst), 2) AS max_active_seconds_dst,
-        ROUND(AVG(connection_count_dst), 2) AS avg_connection_count_dst,
-        COUNT(*) FILTER (WHERE active_seconds_dst > 60) AS sessions_over_1_minute_dst
-    FROM parquet_scan('{parquet_file}')
-""")
-
-# Symmetry & Delay
-show("COMM: Traffic Symmetry & Delay", f"""
-    SELECT
-        ROUND(AVG(bytes_sent), 2) AS avg_bytes_sent,
-        ROUND(AVG(bytes_received), 2) AS avg_bytes_received,
-        ROUND(AVG(response_delay_src), 2) AS avg_response_delay_src,
-        ROUND(AVG(response_delay_dst), 2) AS avg_response_delay_dst,
-        MAX(response_delay_src) AS max_response_delay_src,
-        MAX(response_delay_dst) AS max_response_delay_dst
-    FROM parquet_scan('{parquet_file}')
-""")
-
-# Fan-in / Fan-out
-show("COMM: Fan-in and Fan-out", f"""
-    SELECT
-        ROUND(AVG(peer_count_src), 2) AS avg_fanout,
-        ROUND(MAX(peer_count_src), 2) AS max_fanout,
-        ROUND(AVG(peer_count_dst), 2) AS avg_fanin,
-        ROUND(MAX(peer_count_dst), 2) AS max_fanin
-    FROM parquet_scan('{parquet_file}')
-""")
-
-# Rhythmicity
-show("COMM: Bursty vs Rhythmic Behavior", f"""
-    SELECT
-        COUNT(*) FILTER (WHERE is_bursty_src) AS bursty_src,
-        COUNT(*) FILTER (WHERE NOT is_bursty_src) AS rhythmic_src,
-        COUNT(*) FILTER (WHERE is_bursty_dst) AS bursty_dst,
-        COUNT(*) FILTER (WHERE NOT is_bursty_dst) AS rhythmic_dst
-    FROM parquet_scan('{parquet_file}')
-""")
-
-# Suitable deployment artifact
-show("Suitable Deployment Artifact Types", f"""
-    SELECT
-        inferred_artifact_type,
-        COUNT(*) AS count
-    FROM parquet_scan('{parquet_file}')
-    GROUP BY inferred_artifact_type
-    ORDER BY count DESC
-""")
-
-show("Fallback Probabilities for None-Labeled Artifacts", f"""
-    SELECT
-        artifact_type_top,
-        COUNT(*) AS count
-    FROM parquet_scan('{parquet_file}')
-    WHERE inferred_artifact_type IS NULL
-    GROUP BY artifact_type_top
-    ORDER BY count DESC
-""")
+# All report sections in one scan of the output, cached per dataset
+# fingerprint next to it (see workload_report.py); null counts from the
+# Parquet footers (see dataset_profile.py; the star view is a join, its
+# files don't profile the wide table); capture metadata (capinfos) joined
+# on capture_id
+profile = profile_dataset(outputs[layout]) if layout != 'star' else None
+captures = pd.read_parquet(capture_table) if os.path.exists(capture_table) else None
+report = report_metrics(con, workloads_source, outputs[layout], profile=profile)
+for title, section in report_sections(report, captures):
+    print(f"\n==== {title} ====")
+    print(section)
 
 example_path = "C:/Users/baroc/Downloads/example_head20.csv"
-df_head = con.execute(f"SELECT * FROM parquet_scan('{parquet_file}') LIMIT 20").df()
+df_head = con.execute(f"SELECT * FROM {workloads_source} LIMIT 20").df()
 df_head.to_csv(example_path, index=False)
 print(f"Saved: {example_path}")
 
 
 
-# === Load Data ===
-df = pd.read_parquet("C:/Users/baroc/Downloads/all_workloads_CICIDS.parquet")
- 
-# === Check for Missing Data ===
+# === Check for Missing Data === (from the report's null counts, no scan)
+id_nulls = null_counts(report)[['workload_id_src', 'workload_id_dst', 'mac_src', 'ip_src', 'src_port', 'mac_dst', 'ip_dst', 'dst_port']]
 print("\n=== Missing Data Summary ===")
-print(df[['workload_id_src', 'workload_id_dst', 'mac_src', 'ip_src', 'src_port', 'mac_dst', 'ip_dst', 'dst_port']].isna().sum())
+print(id_nulls)
 print("\n=== Non-NaN Counts ===")
-print(df[['workload_id_src', 'workload_id_dst', 'mac_src', 'ip_src', 'src_port', 'mac_dst', 'ip_dst', 'dst_port']].notna().sum())
+print(report['values']['total_rows'] - id_nulls)
 
-# === EDA ===
+# === EDA === (bins and samples computed in DuckDB, see workload_eda.py)
 
 # === Frame Size Distribution ===
+counts, edges = histogram(con, workloads_source, 'frame_len', bins=100)
 plt.figure(figsize=(8,5))
-plt.hist(df['frame_len'].dropna(), bins=100, density=True, alpha=0.7)
+plt.hist(edges[:-1], bins=edges, weights=counts, density=True, alpha=0.7)
 plt.title("Frame Size Distribution")
 plt.xlabel("Frame Size (bytes)")
 plt.ylabel("Density")
@@ -748,9 +423,9 @@ plt.show()
 
 
 # === TTL Values Distribution ===
+counts, edges = histogram(con, workloads_source, 'ip_ttl', bins=range(0, 256, 1))
 plt.figure(figsize=(8,5))
-ttl_data = df['ip_ttl'].dropna()
-plt.hist(ttl_data, bins=range(0, 256, 1), density=True, alpha=0.7, color='orange')
+plt.hist(edges[:-1], bins=edges, weights=counts, density=True, alpha=0.7, color='orange')
 plt.title("TTL Values Distribution")
 plt.xlabel("TTL (Hops)")
 plt.ylabel("Density")
@@ -761,7 +436,7 @@ plt.tight_layout()
 plt.show()
 
 # === Fan-In vs Fan-Out (Sample 1000 Flows) ===
-sample_df = df[['peer_count_src', 'peer_count_dst']].dropna().sample(n=1000, random_state=42)
+sample_df = reservoir_sample(con, workloads_source, ['peer_count_src', 'peer_count_dst'], n=1000, seed=42)
 plt.figure(figsize=(8,5))
 plt.scatter(sample_df['peer_count_src'], sample_df['peer_count_dst'], alpha=0.6)
 plt.title("Fan-In vs Fan-Out (Sample of 1000 Flows)")
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable sketches for the approximate build (stream_process_json(approximate=True)).
+
+- Distinct counts: HyperLogLog with 2**HLL_P registers, kept as sparse
+  (key..., reg, rank) rows. Two sketches merge with MAX(rank) per register,
+  so they fit the state tables of workload_state.py, and a key never holds
+  more than 2**HLL_P rows however many distinct members it has. Standard
+  error 1.04 / sqrt(2**HLL_P) (1.6%); below 2.5 * 2**HLL_P distinct members
+  linear counting is used, which is exact up to register collisions.
+- Quantiles: values rounded to log buckets (gamma ** (b - 1), gamma ** b].
+  A threshold tested with ">" takes its bucket's upper edge, one tested
+  with "<" the lower edge, so a key whose value is the exact quantile keeps
+  its flag and only values sharing the quantile's bucket can flip. Rounding
+  is monotone, so the threshold is within a relative error of gamma - 1 of
+  the exact quantile, and the sketch is a histogram of at most
+  log(max / min) / log(gamma) buckets, merged by adding counts. Values <= 0
+  share one bucket with edge 0. While buckets are narrower than 1 (values
+  below 1 / (gamma - 1)) each holds at most one integer, so flags on small
+  counts come out as in exact mode.
+  The inter-arrival gap medians of workload_state.py use the same buckets,
+  represented by 2 * gamma ** b / (gamma + 1) (relative error
+  (gamma - 1) / (gamma + 1)).
+
+Both are plain SQL over DuckDB's 64-bit hash(), so pandas and DuckDB builds
+read the same estimates. hll_registers / hll_estimate are the same
+HyperLogLog over numpy hashes, for the column sketches of dataset_profile.py.
+"""
+
+import math
+
+import numpy as np
+
+
+HLL_P = 12
+HLL_REGISTERS = 1 << HLL_P
+QUANTILE_GAMMA = 1.01
+ZERO_BUCKET = -(1 << 30)  # bucket of values <= 0
+
+
+def hll_error():
+    # Standard error of a HyperLogLog estimate
+    return 1.04 / math.sqrt(HLL_REGISTERS)
+
+
+def log_bucket_error(gamma):
+    # Bound on the relative error of a value read off its bucket's midpoint
+    return (gamma - 1) / (gamma + 1)
+
+
+def bucket_edge_error(gamma=QUANTILE_GAMMA):
+    # Bound on the relative error of a threshold read off a bucket edge
+    return gamma - 1
+
+
+def hll_registers_sql(source, keys, member):
+    # Partial HyperLogLog of the non-null members per keys: (keys..., reg, rank)
+    keys = ', '.join(keys)
+    return f"""
+        SELECT {keys}, CAST(h & {HLL_REGISTERS - 1} AS INTEGER) AS reg,
+               MAX(CASE WHEN w = 0 THEN {64 - HLL_P + 1}
+                        ELSE CAST(LOG2(GREATEST(w & -w, 1)) AS INTEGER) + 1 END) AS rank
+        FROM (
+            SELECT {keys}, h, CAST(h >> {HLL_P} AS BIGINT) AS w
+            FROM (SELECT {keys}, hash({member}) AS h FROM {source} WHERE {member} IS NOT NULL)
+        )
+        GROUP BY ALL
+    """
+
+
+def hll_count_sql(table, keys, name):
+    # Estimated distinct count per keys of a (keys..., reg, rank) table
+    keys = ', '.join(keys)
+    m = HLL_REGISTERS
+    alpha = 0.7213 / (1 + 1.079 / m)
+    return f"""
+        SELECT {keys},
+               CAST(ROUND(CASE WHEN raw <= {2.5 * m} AND filled < {m} THEN {m} * LN({m} / ({m} - filled))
+                               ELSE raw END) AS BIGINT) AS {name}
+        FROM (
+            SELECT {keys}, COUNT(*) AS filled,
+                   {alpha * m * m!r} / (SUM(POW(2.0, -rank)) + {m} - COUNT(*)) AS raw
+            FROM {table} GROUP BY ALL
+        )
+    """
+
+
+def hll_registers(hashes, p=HLL_P):
+    # Dense HyperLogLog registers (uint8[2**p]) of uint64 hashes
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    registers = np.zeros(1 << p, dtype=np.uint8)
+    w = hashes >> np.uint64(p)
+    low = (w & (~w + np.uint64(1))).astype(np.float64)  # lowest set bit, exact as a power of two
+    rank = np.where(w == 0, 64 - p + 1, np.log2(np.maximum(low, 1)).astype(np.int64) + 1)
+    np.maximum.at(registers, (hashes & np.uint64((1 << p) - 1)).astype(np.int64), rank.astype(np.uint8))
+    return registers
+
+
+def hll_estimate(registers):
+    # hll_count_sql for dense registers
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / np.sum(np.power(2.0, -registers.astype(np.float64)))
+    empty = int(np.count_nonzero(registers == 0))
+    if raw <= 2.5 * m and empty:
+        return round(m * math.log(m / empty))
+    return round(raw)
+
+
+def log_bucket_sql(value, gamma=QUANTILE_GAMMA):
+    return (f"CASE WHEN {value} <= 0 THEN {ZERO_BUCKET} "
+            f"ELSE CAST(CEIL(LN({value}) / {math.log(gamma)!r}) AS INTEGER) END")
+
+
+def bucket_value_sql(bucket, gamma):
+    return f"CASE WHEN {bucket} = {ZERO_BUCKET} THEN 0 ELSE 2 * POW({gamma!r}, {bucket}) / {gamma + 1!r} END"
+
+
+def bucket_edge_sql(value, upper, gamma=QUANTILE_GAMMA):
+    # value replaced by its bucket's upper / lower edge (NULL stays NULL)
+    bucket = log_bucket_sql(value, gamma)
+    edge = f"POW({gamma!r}, {bucket})" if upper else f"POW({gamma!r}, {bucket} - 1)"
+    return f"CASE WHEN {value} IS NULL THEN NULL WHEN {value} <= 0 THEN 0 ELSE {edge} END"
+
+
+def bucket_edge(values, upper, gamma=QUANTILE_GAMMA):
+    # bucket_edge_sql for a numpy array
+    values = np.asarray(values, dtype='float64')
+    positive = values > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        buckets = np.ceil(np.log(np.where(positive, values, 1)) / math.log(gamma))
+        edges = np.power(gamma, buckets if upper else buckets - 1)
+    return np.where(np.isnan(values), np.nan, np.where(positive, edges, 0.0))
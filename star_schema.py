@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Star-schema output for stream_process_json(layout='star').
+
+Every derived column of the wide all_workloads table is a function of the
+packet's source workload, its destination workload, or the pair plus the
+packet's is_tls_without_http flag. The wide table is split accordingly into
+a directory with
+
+- workloads.parquet: one row per workload_id (mac, ip, port, its features
+  as a source and as a destination, and those of its host),
+- flows.parquet: one row per (workload_id_src, workload_id_dst,
+  is_tls_without_http) with the pair-level labels, scores and ranking, plus
+  packet count, first/last timestamp and the last packet's row number,
+- packets.parquet: the per-packet columns only, in the original order.
+
+star_views rebuilds the wide table as a DuckDB view, and graph_flows gives
+method_pipeline.py one row per flow without reading the packet table.
+"""
+
+import os
+
+from workload_features import connect_duckdb
+from workload_sql import FEATURE_COLUMNS
+
+
+FLOW_KEY = ['workload_id_src', 'workload_id_dst', 'is_tls_without_http']
+
+SRC_COLUMNS = [
+    'session_length_src', 'avg_payload_size_src', 'is_data_heavy_src',
+    'data_volume', 'is_data_intensive', 'session_volatility', 'is_stable_workload',
+    'is_forward_only_mac', 'is_possible_vm_by_ip_reuse',
+    'session_volatility_src', 'is_possible_container_src', 'session_volatility_dst', 'is_possible_container_dst',
+    'ttl_variability', 'is_ttl_unstable', 'active_seconds_src', 'connection_count_src', 'bytes_sent',
+    'response_delay_src', 'peer_count_src', 'active_minute_count_src', 'is_bursty_src',
+]
+DST_COLUMNS = [
+    'session_length_dst', 'avg_payload_size_dst', 'is_data_heavy_dst', 'is_broadcast',
+    'active_seconds_dst', 'connection_count_dst', 'bytes_received', 'response_delay_dst', 'peer_count_dst',
+    'active_minute_count_dst', 'is_bursty_dst',
+]
+FLOW_COLUMNS = [c for c in FEATURE_COLUMNS if c not in SRC_COLUMNS and c not in DST_COLUMNS]
+
+TABLES = ('packets', 'flows', 'workloads')
+
+_SIDE_SQL = """
+    SELECT workload_id_{side} AS workload_id, ANY_VALUE(mac_{side}) AS mac, ANY_VALUE(ip_{side}) AS ip,
+           ANY_VALUE({side}_port) AS port, {columns}
+    FROM wide GROUP BY workload_id_{side}
+"""
+
+
+def write_star(wide_parquet, star_dir, memory_budget_mb=None):
+    os.makedirs(star_dir, exist_ok=True)
+    con = connect_duckdb(memory_budget_mb, temp_dir=os.path.join(star_dir, 'duckdb.tmp'))
+    try:
+        con.execute(f"CREATE VIEW wide AS SELECT * FROM read_parquet('{wide_parquet}', file_row_number = true)")
+        columns = [name for name, *_ in con.execute("DESCRIBE SELECT * FROM wide").fetchall()]
+        packet_columns = [c for c in columns if c not in FEATURE_COLUMNS and c != 'file_row_number']
+
+        con.execute(f"""COPY (SELECT {', '.join(f'"{c}"' for c in packet_columns)} FROM wide ORDER BY file_row_number)
+                        TO '{os.path.join(star_dir, 'packets.parquet')}' (FORMAT parquet)""")
+        con.execute(f"""COPY (
+            SELECT {', '.join(FLOW_KEY)}, COUNT(*) AS packets,
+                   MIN(frame_time_epoch) AS first_seen, MAX(frame_time_epoch) AS last_seen,
+                   COUNT(frame_time_epoch) AS timed_packets, MAX(file_row_number) AS last_packet,
+                   {', '.join(f'ANY_VALUE({c}) AS {c}' for c in FLOW_COLUMNS)}
+            FROM wide GROUP BY ALL ORDER BY last_packet
+        ) TO '{os.path.join(star_dir, 'flows.parquet')}' (FORMAT parquet)""")
+        src = _SIDE_SQL.format(side='src', columns=', '.join(f'ANY_VALUE({c}) AS {c}' for c in SRC_COLUMNS))
+        dst = _SIDE_SQL.format(side='dst', columns=', '.join(f'ANY_VALUE({c}) AS {c}' for c in DST_COLUMNS))
+        con.execute(f"""COPY (
+            SELECT COALESCE(s.workload_id, d.workload_id) AS workload_id,
+                   COALESCE(s.mac, d.mac) AS mac, COALESCE(s.ip, d.ip) AS ip, COALESCE(s.port, d.port) AS port,
+                   {', '.join(f's.{c}' for c in SRC_COLUMNS)}, {', '.join(f'd.{c}' for c in DST_COLUMNS)}
+            FROM ({src}) s FULL OUTER JOIN ({dst}) d ON s.workload_id = d.workload_id
+            ORDER BY workload_id
+        ) TO '{os.path.join(star_dir, 'workloads.parquet')}' (FORMAT parquet)""")
+    finally:
+        con.close()
+
+
+def star_views(con, star_dir):
+    # Views packets, flows, workloads and the wide all_workloads on con
+    for name in TABLES:
+        con.execute(f"CREATE OR REPLACE VIEW {name} AS "
+                    f"SELECT * FROM read_parquet('{os.path.join(star_dir, name + '.parquet')}')")
+    packet_columns = [name for name, *_ in con.execute("DESCRIBE SELECT * FROM packets").fetchall()]
+    alias = {**{c: 'f' for c in FLOW_COLUMNS}, **{c: 's' for c in SRC_COLUMNS}, **{c: 'd' for c in DST_COLUMNS}}
+    columns = [f'p."{c}"' for c in packet_columns] + [f'{alias[c]}.{c}' for c in FEATURE_COLUMNS]
+    con.execute(f"""
+        CREATE OR REPLACE VIEW all_workloads AS
+        SELECT {', '.join(columns)}
+        FROM read_parquet('{os.path.join(star_dir, 'packets.parquet')}', file_row_number = true) p
+        JOIN flows f ON f.workload_id_src = p.workload_id_src AND f.workload_id_dst = p.workload_id_dst
+                    AND f.is_tls_without_http IS NOT DISTINCT FROM p.is_tls_without_http
+        LEFT JOIN workloads s ON s.workload_id = p.workload_id_src
+        LEFT JOIN workloads d ON d.workload_id = p.workload_id_dst
+        ORDER BY p.file_row_number
+    """)
+
+
+# One row per flow with complete src/dst workloads (what method_pipeline keeps
+# after dropna), packet-weighted sums of the per-packet values it aggregates,
+# ordered by last packet so "last row per source wins" still holds.
+GRAPH_FLOWS_SQL = """
+    SELECT f.workload_id_src, f.workload_id_dst, f.packets AS flows,
+           f.packets * s.bytes_sent AS bytes_sent, f.packets * d.bytes_received AS bytes_received,
+           CASE WHEN f.timed_packets = f.packets THEN epoch(f.first_seen) END AS start_time,
+           CASE WHEN f.timed_packets = f.packets THEN epoch(f.last_seen) END AS end_time,
+           f.packets * s.session_volatility_src AS session_volatility_src,
+           f.packets * s.ttl_variability AS ttl_variability,
+           CASE WHEN f.dst_role IN ('internal_router', 'external_router') THEN f.dst_role
+                WHEN f.is_possible_switch THEN 'switch'
+                WHEN d.is_broadcast OR s.is_forward_only_mac THEN 'network_core'
+                ELSE 'client' END AS device_role,
+           s.mac AS mac_src, s.ip AS ip_src, s.port AS src_port,
+           d.mac AS mac_dst, d.ip AS ip_dst, d.port AS dst_port
+    FROM flows f
+    JOIN workloads s ON s.workload_id = f.workload_id_src
+    JOIN workloads d ON d.workload_id = f.workload_id_dst
+    WHERE s.mac IS NOT NULL AND s.ip IS NOT NULL AND s.port IS NOT NULL
+      AND d.mac IS NOT NULL AND d.ip IS NOT NULL AND d.port IS NOT NULL
+    ORDER BY f.last_packet
+"""
+
+
+def graph_flows(star_dir):
+    con = connect_duckdb()
+    try:
+        for name in ('flows', 'workloads'):
+            con.execute(f"CREATE VIEW {name} AS "
+                        f"SELECT * FROM read_parquet('{os.path.join(star_dir, name + '.parquet')}')")
+        return con.execute(GRAPH_FLOWS_SQL).df()
+    finally:
+        con.close()
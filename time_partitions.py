@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Time-partitioned output for stream_process_json(layout='partitioned').
+
+The wide all_workloads table is rewritten as a hive-partitioned Parquet
+dataset, capture_day=YYYY-MM-DD/capture_hour=H/ (UTC, from epoch_minute;
+packets without a timestamp go to the __HIVE_DEFAULT_PARTITION__ directory).
+Within a partition rows are sorted by workload_id_src and frame_time_epoch
+and written in small row groups, so the min/max statistics of those columns
+are tight, and DuckDB adds bloom filters for the dictionary-encoded
+columns (workload ids, ips, macs, ...). A query on a time range and a
+workload reads only the footers plus the few row groups that match.
+
+packet_row keeps each packet's position in the wide table.
+"""
+
+import os
+
+from workload_features import connect_duckdb
+
+
+ROW_GROUP_ROWS = 16_384
+SORT_KEY = ['workload_id_src', 'frame_time_epoch']
+
+CAPTURE_DAY_SQL = "strftime(make_timestamp(CAST(epoch_minute AS BIGINT) * 60000000), '%Y-%m-%d')"
+CAPTURE_HOUR_SQL = "CAST(epoch_minute AS BIGINT) // 60 % 24"
+
+
+def write_partitioned(wide_parquet, out_dir, memory_budget_mb=None, row_group_rows=ROW_GROUP_ROWS):
+    con = connect_duckdb(memory_budget_mb, temp_dir=out_dir.rstrip('/\\') + '.duckdb.tmp')
+    try:
+        con.execute(f"""COPY (
+            SELECT * EXCLUDE (file_row_number), file_row_number AS packet_row,
+                   {CAPTURE_DAY_SQL} AS capture_day, {CAPTURE_HOUR_SQL} AS capture_hour
+            FROM read_parquet('{wide_parquet}', file_row_number = true)
+            ORDER BY {', '.join(SORT_KEY)}, packet_row
+        ) TO '{out_dir}' (FORMAT parquet, PARTITION_BY (capture_day, capture_hour), OVERWRITE,
+                          ROW_GROUP_SIZE {row_group_rows})""")
+    finally:
+        con.close()
+
+
+def dataset_sql(out_dir):
+    return (f"read_parquet('{os.path.join(out_dir, '**', '*.parquet')}', hive_partitioning = true, "
+            "hive_types = {'capture_day': VARCHAR, 'capture_hour': BIGINT})")
+
+
+def partition_view(con, out_dir, name='all_workloads'):
+    # The dataset as a view on con; capture_day/capture_hour filters prune whole directories
+    con.execute(f"CREATE OR REPLACE VIEW {name} AS SELECT * FROM {dataset_sql(out_dir)}")
+
+
+def time_slice_sql(start_epoch, end_epoch):
+    # start_epoch <= frame_time_epoch < end_epoch, with the partition
+    # predicates spelled out so only the matching hours are opened
+    hours = range(int(start_epoch // 3600), int((end_epoch - 1e-9) // 3600) + 1)
+    partitions = ', '.join(
+        f"(strftime(make_timestamp({h * 3600_000_000}), '%Y-%m-%d'), {h % 24})" for h in hours)
+    return (f"(capture_day, capture_hour) IN ({partitions}) "
+            f"AND frame_time_epoch >= make_timestamp({round(start_epoch * 1e6)}) "
+            f"AND frame_time_epoch < make_timestamp({round(end_epoch * 1e6)})")
+
+
+def time_slice(out_dir, start_epoch, end_epoch, workload_id=None, columns=None):
+    # Packets in [start_epoch, end_epoch), optionally only those to or from
+    # workload_id. The two sides are separate scans: an equality on one id
+    # column is pushed down to the row-group statistics and bloom filters, an
+    # OR across both is not.
+    where = time_slice_sql(start_epoch, end_epoch)
+    columns = '*' if columns is None else ', '.join(dict.fromkeys(['packet_row', *columns]))
+    if workload_id is None:
+        query = f"SELECT {columns} FROM {dataset_sql(out_dir)} WHERE {where}"
+    else:
+        wid = int(workload_id)
+        query = f"""
+            SELECT {columns} FROM {dataset_sql(out_dir)} WHERE {where} AND workload_id_src = {wid}
+            UNION ALL
+            SELECT {columns} FROM {dataset_sql(out_dir)}
+            WHERE {where} AND workload_id_dst = {wid} AND workload_id_src <> {wid}
+        """
+    con = connect_duckdb()
+    try:
+        return con.execute(f"SELECT * FROM ({query}) ORDER BY packet_row").df()
+    finally:
+        con.close()
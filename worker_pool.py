@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Worker processes for the parallel build (stream_process_json(workers=...)).
+
+A task is a module-level function and its arguments. Each one runs in a
+fresh `python worker_pool.py` process, at most `workers` at a time, with
+task and result passed as pickle files in a scratch directory. Plain
+subprocesses rather than multiprocessing: preprosessing_update.py runs its
+pipeline at module level, and multiprocessing's spawn start method
+(Windows, macOS, IDE consoles) would run it again in every worker.
+"""
+
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _run(task, scratch_dir):
+    fd, path = tempfile.mkstemp(prefix='task_', suffix='.pkl', dir=scratch_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(task, f, protocol=pickle.HIGHEST_PROTOCOL)
+        subprocess.run([sys.executable, os.path.abspath(__file__), path], check=True)
+        with open(path, 'rb') as f:
+            ok, result = pickle.load(f)
+    finally:
+        os.remove(path)
+    if not ok:
+        raise RuntimeError(f"worker task {task[0].__name__} failed:\n{result}")
+    return result
+
+
+def run_tasks(tasks, workers, scratch_dir=None):
+    # Results of [(function, args)] in task order, each as soon as it and
+    # all tasks before it are done
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(lambda task: _run(task, scratch_dir), tasks)
+
+
+def main(path):
+    try:
+        with open(path, 'rb') as f:
+            func, args = pickle.load(f)
+        result = (True, func(*args))
+    except Exception:
+        result = (False, traceback.format_exc())
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
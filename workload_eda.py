@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+EDA helpers that aggregate in DuckDB and return only what gets plotted.
+
+histogram bins a column inside the query and returns numpy.histogram's
+(counts, edges); plot with plt.hist(edges[:-1], bins=edges, weights=counts)
+to get the same figure as plt.hist on the raw values. reservoir_sample
+draws a fixed-size sample with DuckDB's reservoir sampling. Memory is a few
+arrays of bin counts or sample rows, whatever the size of the capture.
+"""
+
+import numpy as np
+
+
+def _value_range(con, source, value):
+    lo, hi = con.execute(f"SELECT MIN({value}), MAX({value}) FROM {source}").fetchone()
+    if lo is None:
+        return 0.0, 1.0
+    if lo == hi:  # numpy widens an empty range the same way
+        return lo - 0.5, hi + 0.5
+    return lo, hi
+
+
+def histogram(con, source, column, bins=10, range=None):
+    # numpy.histogram(values of column, bins, range) with the binning in SQL;
+    # nulls are skipped, values outside range dropped, the last bin is closed
+    value = f'CAST("{column}" AS DOUBLE)'
+    if not np.isscalar(bins):
+        edges = np.asarray(bins, dtype=float)
+        if not np.allclose(np.diff(edges), edges[1] - edges[0]):
+            # Uneven edges: count per distinct value, bin those in numpy
+            rows = con.execute(f"SELECT {value}, COUNT(*) FROM {source} WHERE {value} IS NOT NULL GROUP BY 1").fetchall()
+            values = np.array([v for v, _ in rows], dtype=float)
+            counts, edges = np.histogram(values, edges, weights=np.array([n for _, n in rows], dtype=float))
+            return counts.astype(np.int64), edges
+        range, bins = (edges[0], edges[-1]), len(edges) - 1
+    lo, hi = map(float, range if range is not None else _value_range(con, source, value))
+    edges = np.linspace(lo, hi, bins + 1)
+    # numpy's binning: the floor of the scaled value, moved one bin down or
+    # up where rounding put it on the wrong side of its edges (e[i + 1] is
+    # edges[i]). Bounds and edges go in as parameters: SQL literals are read
+    # as DECIMAL and would not round-trip to the same doubles.
+    rows = con.execute(f"""
+        WITH b AS (
+            SELECT v, LEAST(CAST(FLOOR((v - $lo) / ($hi - $lo) * {bins}) AS BIGINT), {bins - 1}) AS i,
+                   $edges::DOUBLE[] AS e
+            FROM (SELECT {value} AS v FROM {source}) AS t
+            WHERE v >= $lo AND v <= $hi
+        )
+        SELECT CASE WHEN v < e[i + 1] THEN i - 1
+                    WHEN v >= e[i + 2] AND i < {bins - 1} THEN i + 1
+                    ELSE i END AS bin,
+               COUNT(*) AS n
+        FROM b
+        GROUP BY bin
+    """, {'lo': lo, 'hi': hi, 'edges': edges.tolist()}).fetchall()
+    counts = np.zeros(bins, dtype=np.int64)
+    for b, n in rows:
+        counts[b] = n
+    return counts, edges
+
+
+def reservoir_sample(con, source, columns, n=1000, seed=42):
+    # n rows (all, if fewer) of columns without nulls, as a DataFrame
+    names = ', '.join(f'"{c}"' for c in columns)
+    not_null = ' AND '.join(f'"{c}" IS NOT NULL' for c in columns)
+    return con.execute(f"""
+        SELECT * FROM (SELECT {names} FROM {source} WHERE {not_null})
+        USING SAMPLE reservoir({int(n)} ROWS) REPEATABLE ({int(seed)})
+    """).df()
@@ -0,0 +1,602 @@
+# -*- coding: utf-8 -*-
+"""
+Workload feature building for preprosessing_update.stream_process_json.
+
+Out-of-core mode (memory_budget_mb / chunk_rows): the enriched packets are
+converted to typed Arrow record batches every chunk_rows rows and spilled to
+a temporary Parquet dataset. DuckDB then computes the per-workload and
+per-host aggregates over that dataset (spilling to disk under the same
+budget), the global thresholds are derived from the aggregate tables, and a
+last pass streams the packets back one chunk at a time, broadcasts the
+aggregates and writes the same columns as the in-memory path.
+
+Memory is bounded by the chunk size plus the aggregate tables, which grow
+with the number of distinct workloads/hosts, not with the number of packets.
+
+The in-memory path builds the same aggregate tables with workload_aggregates
+(one sort per workload side instead of a groupby lambda per feature) and
+shares the row-level derivation, apply_workload_features.
+
+write_features(workers=n) splits the last pass by spill row groups across n
+worker processes (worker_pool.py) and concatenates their parts in order.
+"""
+
+import os
+import pickle
+import shutil
+import tempfile
+
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from artifact_scoring import score_artifacts
+from dataset_profile import ColumnSketches
+from output_schema import write_compact
+from sketches import bucket_edge
+from worker_pool import run_tasks
+
+
+# Rough footprint of one buffered entry dict, used to turn a memory budget
+# into a chunk size. The buffer gets a quarter of the budget; the DataFrame,
+# Arrow copies and DuckDB get the rest.
+ENTRY_BYTES = 4096
+
+PACKET_TYPES = {
+    'frame_len': pa.int64(),
+    'frame_time_epoch': pa.float64(),
+    'epoch_minute': pa.int64(),
+    'epoch_second': pa.int64(),
+    'tcp_dstport': pa.float64(),
+    'udp_dstport': pa.float64(),
+    'financial_suspect_score': pa.int64(),
+    'workload_id_src': pa.int64(),
+    'workload_id_dst': pa.int64(),
+    'src_is_internal': pa.bool_(),
+    'dst_is_internal': pa.bool_(),
+    'tls_is_handshake': pa.bool_(),
+}
+
+FEATURE_TYPES = {
+    'session_length_src': pa.float64(),
+    'session_length_dst': pa.float64(),
+    'avg_payload_size_src': pa.float64(),
+    'avg_payload_size_dst': pa.float64(),
+    'data_volume': pa.int64(),
+    'session_volatility': pa.float64(),
+    'session_volatility_src': pa.int64(),
+    'session_volatility_dst': pa.int64(),
+    'ttl_variability': pa.float64(),
+    'active_seconds_src': pa.float64(),
+    'active_seconds_dst': pa.float64(),
+    'connection_count_src': pa.int64(),
+    'connection_count_dst': pa.int64(),
+    'bytes_sent': pa.float64(),
+    'bytes_received': pa.float64(),
+    'response_delay_src': pa.float64(),
+    'response_delay_dst': pa.float64(),
+    'peer_count_src': pa.float64(),
+    'peer_count_dst': pa.float64(),
+    'active_minute_count_src': pa.int64(),
+    'active_minute_count_dst': pa.int64(),
+    'artifact_type_entropy': pa.float64(),
+    'artifact_type_top_score': pa.float64(),
+    'artifact_type_ranked': pa.list_(pa.string()),
+}
+
+
+def column_type(name, dtype=None):
+    if name in PACKET_TYPES:
+        return PACKET_TYPES[name]
+    if name in FEATURE_TYPES:
+        return FEATURE_TYPES[name]
+    if name.startswith(('is_', 'has_')):
+        return pa.bool_()
+    if dtype is not None and pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+        # Raw fields that Parquet input already delivers as numbers
+        return pa.float64()
+    return pa.string()
+
+
+def frame_to_batch(df, schema):
+    arrays = []
+    for field in schema:
+        col = df[field.name]
+        try:
+            arr = pa.Array.from_pandas(col, type=field.type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Raw tshark values that are not strings yet (e.g. ints from Parquet input)
+            arr = pa.Array.from_pandas(col.map(lambda v: v if v is None or isinstance(v, str) or v != v else str(v)),
+                                       type=field.type)
+        arrays.append(arr)
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def spill_schema(df):
+    # Spill schema derived from the first prepared chunk
+    return pa.schema([pa.field(c, column_type(c, df[c].dtype)) for c in df.columns])
+
+
+def chunk_rows_for_budget(memory_budget_mb):
+    return max(10_000, memory_budget_mb * (1 << 20) // 4 // ENTRY_BYTES)
+
+
+class PacketSpill:
+    # Typed Parquet spill of prepared packet chunks (one row group per chunk)
+
+    def __init__(self, spill_dir=None, near=None):
+        parent = spill_dir or os.path.dirname(os.path.abspath(near or '.'))
+        os.makedirs(parent, exist_ok=True)
+        self.dir = tempfile.mkdtemp(prefix='packet_spill_', dir=parent)
+        self.path = os.path.join(self.dir, 'packets.parquet')
+        self.schema = None
+        self.rows = 0
+        self._writer = None
+
+    def open(self, schema):
+        self.schema = schema
+        self._writer = pq.ParquetWriter(self.path, schema, compression='zstd')
+
+    def write(self, df):
+        if self.schema is None:
+            self.open(spill_schema(df))
+        self.write_batch(frame_to_batch(df, self.schema))
+
+    def write_batch(self, batch):
+        self._writer.write_batch(batch)
+        self.rows += batch.num_rows
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def iter_frames(self, batch_rows):
+        for batch in pq.ParquetFile(self.path).iter_batches(batch_size=batch_rows):
+            yield batch.to_pandas()
+
+    def remove(self):
+        self.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def weighted_quantile(values, weights, q):
+    # Same result as pd.Series(np.repeat(values, weights)).quantile(q), without
+    # materialising the repeated series: a threshold over packets computed from
+    # a per-key table (weights = packets per key).
+    values = np.asarray(values, dtype='float64')
+    weights = np.asarray(weights, dtype='int64')
+    keep = ~np.isnan(values)
+    values, weights = values[keep], weights[keep]
+    n = int(weights.sum())
+    if not n:
+        return np.nan
+    order = np.argsort(values, kind='stable')
+    values = values[order]
+    ends = np.cumsum(weights[order])
+    virtual = (n - 1) * q
+    lo = int(np.floor(virtual))
+    t = virtual - lo
+    a = values[np.searchsorted(ends, lo, side='right')]
+    b = values[np.searchsorted(ends, min(lo + 1, n - 1), side='right')]
+    # numpy's linear interpolation, so thresholds match the in-memory path bit for bit
+    return b - (b - a) * (1 - t) if t >= 0.5 else a + (b - a) * t
+
+
+WORKLOAD_SQL = """
+    SELECT {key},
+           COUNT(*) AS packets,
+           MAX(frame_time_epoch) - MIN(frame_time_epoch) AS session_length,
+           AVG(frame_len) AS avg_payload_size,
+           COUNT(frame_time_epoch) AS connection_count,
+           COUNT(DISTINCT epoch_minute) AS active_minute_count,
+           CASE WHEN COUNT(*) <= 1 THEN 0
+                -- a missing timestamp makes the pandas median NaN as well
+                WHEN COUNT(frame_time_epoch) < COUNT(*) THEN NULL
+                ELSE MEDIAN(gap) END AS response_delay
+    FROM (
+        SELECT {key}, frame_time_epoch, frame_len, epoch_minute,
+               frame_time_epoch - LAG(frame_time_epoch) OVER (PARTITION BY {key} ORDER BY frame_time_epoch) AS gap
+        FROM packets
+    )
+    GROUP BY {key}
+"""
+
+COMBO_SQL = """
+    SELECT p.mac_ip_combo,
+           COUNT(*) AS packets,
+           COALESCE(SUM(p.frame_len), 0) AS data_volume,
+           STDDEV_SAMP(w.session_length) AS session_volatility,
+           COUNT(DISTINCT p.workload_id_src) AS session_volatility_src,
+           COUNT(DISTINCT p.workload_id_dst) AS session_volatility_dst,
+           STDDEV_SAMP(TRY_CAST(p.ip_ttl AS DOUBLE)) AS ttl_variability
+    FROM packets p
+    JOIN workloads_src w USING (workload_id_src)
+    GROUP BY p.mac_ip_combo
+"""
+
+HOST_SQL = """
+    SELECT mac_{side} AS mac, ip_{side} AS ip,
+           SUM(frame_len) AS bytes,
+           COUNT(DISTINCT ip_{peer}) AS peers
+    FROM packets
+    WHERE mac_{side} IS NOT NULL AND ip_{side} IS NOT NULL
+    GROUP BY mac_{side}, ip_{side}
+"""
+
+
+def connect_duckdb(memory_budget_mb=None, temp_dir=None, threads=None):
+    con = duckdb.connect()
+    if memory_budget_mb:
+        con.execute(f"SET memory_limit = '{int(memory_budget_mb)}MB'")
+    if temp_dir:
+        con.execute(f"SET temp_directory = '{temp_dir}'")
+    if threads:
+        con.execute(f"SET threads = {int(threads)}")
+    return con
+
+
+def create_aggregate_tables(con):
+    # Tables workloads_src/dst, combos, ip_macs, hosts_src/dst and dst_macs
+    # over the packets view
+    for side in ('src', 'dst'):
+        con.execute(f"CREATE TABLE workloads_{side} AS " + WORKLOAD_SQL.format(key=f'workload_id_{side}'))
+    con.execute("CREATE TABLE combos AS " + COMBO_SQL)
+    con.execute("""
+        CREATE TABLE ip_macs AS
+        SELECT ip_src, COUNT(DISTINCT mac_src) AS macs FROM packets WHERE ip_src IS NOT NULL GROUP BY ip_src
+    """)
+    for side, peer in (('src', 'dst'), ('dst', 'src')):
+        con.execute(f"CREATE TABLE hosts_{side} AS " + HOST_SQL.format(side=side, peer=peer))
+    con.execute("CREATE TABLE dst_macs AS SELECT DISTINCT mac_dst AS mac FROM packets")
+
+
+def compute_aggregates(spill_path, memory_budget_mb=None, temp_dir=None):
+    con = connect_duckdb(memory_budget_mb, temp_dir)
+    con.execute(f"CREATE VIEW packets AS SELECT * FROM read_parquet('{spill_path}')")
+    create_aggregate_tables(con)
+    aggs = fetch_aggregates(con)
+    con.close()
+    return aggs
+
+
+def fetch_aggregates(con):
+    # The aggregate tables as the pandas objects apply_workload_features expects
+    aggs = {}
+    for side in ('src', 'dst'):
+        key = f'workload_id_{side}'
+        aggs[f'workloads_{side}'] = con.execute(f"SELECT * FROM workloads_{side}").df().set_index(key)
+    aggs['combos'] = con.execute("SELECT * FROM combos").df().set_index('mac_ip_combo')
+    aggs['ip_macs'] = con.execute("SELECT * FROM ip_macs").df().set_index('ip_src')['macs']
+    for side in ('src', 'dst'):
+        aggs[f'hosts_{side}'] = con.execute(f"SELECT * FROM hosts_{side}").df().set_index(['mac', 'ip'])
+    aggs['dst_macs'] = [m for (m,) in con.execute("SELECT mac FROM dst_macs").fetchall()]
+    return aggs
+
+
+def workload_table(keys, epoch, frame_len, minute):
+    # Same columns as WORKLOAD_SQL from a single sort by (workload, time):
+    # segment boundaries give every statistic, and the median inter-arrival
+    # gap is read off the gaps re-sorted within each segment.
+    keys = np.asarray(keys, dtype=np.int64)
+    epoch, frame_len, minute = (np.asarray(c, dtype=np.float64) for c in (epoch, frame_len, minute))
+    columns = ['packets', 'session_length', 'avg_payload_size', 'connection_count',
+               'active_minute_count', 'response_delay']
+    if not len(keys):
+        return pd.DataFrame(columns=columns, index=pd.Index(keys))
+
+    order = np.lexsort((epoch, keys))  # NaN epochs sort last in their segment
+    keys, t = keys[order], epoch[order]
+    frame_len, minute = frame_len[order], minute[order]
+    new = np.r_[True, keys[1:] != keys[:-1]]
+    starts = np.flatnonzero(new)
+    packets = np.diff(np.r_[starts, len(keys)])
+
+    has_time = ~np.isnan(t)
+    has_len = ~np.isnan(frame_len)
+    connection_count = np.add.reduceat(has_time.astype(np.int64), starts)
+    len_count = np.add.reduceat(has_len.astype(np.int64), starts)
+    len_sum = np.add.reduceat(np.where(has_len, frame_len, 0.0), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg_payload_size = len_sum / len_count
+    session_length = np.fmax.reduceat(t, starts) - np.fmin.reduceat(t, starts)
+
+    # Minutes are non-decreasing along a segment, so distinct = changes
+    first_in_minute = ~np.isnan(minute) & (new | (minute != np.r_[np.nan, minute[:-1]]))
+    active_minute_count = np.add.reduceat(first_in_minute.astype(np.int64), starts)
+
+    segment = np.cumsum(new) - 1
+    inner = ~new[1:]
+    gaps, gap_segment = np.diff(t)[inner], segment[1:][inner]
+    gaps = gaps[np.lexsort((gaps, gap_segment))]
+    n_gaps = packets - 1
+    first_gap = np.cumsum(n_gaps) - n_gaps
+    response_delay = np.zeros(len(starts))
+    many = n_gaps > 0
+    lo = first_gap[many] + (n_gaps[many] - 1) // 2
+    hi = first_gap[many] + n_gaps[many] // 2
+    response_delay[many] = (gaps[lo] + gaps[hi]) / 2
+    response_delay[many & (connection_count < packets)] = np.nan
+
+    return pd.DataFrame({
+        'packets': packets,
+        'session_length': session_length,
+        'avg_payload_size': avg_payload_size,
+        'connection_count': connection_count,
+        'active_minute_count': active_minute_count,
+        'response_delay': response_delay,
+    }, index=pd.Index(keys[starts]))
+
+
+def workload_aggregates(df):
+    # In-memory counterpart of compute_aggregates for a packet DataFrame
+    aggs = {}
+    for side in ('src', 'dst'):
+        key = f'workload_id_{side}'
+        table = workload_table(df[key], df['frame_time_epoch'], df['frame_len'], df['epoch_minute'])
+        table.index.name = key
+        aggs[f'workloads_{side}'] = table
+
+    session_length_src = aggs['workloads_src']['session_length'].reindex(df['workload_id_src']).to_numpy()
+    combos = df[['mac_ip_combo', 'frame_len', 'workload_id_src', 'workload_id_dst']].assign(
+        session_length_src=session_length_src,
+        ip_ttl=pd.to_numeric(df['ip_ttl'], errors='coerce'),
+    ).groupby('mac_ip_combo')
+    aggs['combos'] = combos.agg(
+        packets=('frame_len', 'size'),
+        data_volume=('frame_len', 'sum'),
+        session_volatility=('session_length_src', 'std'),
+        session_volatility_src=('workload_id_src', 'nunique'),
+        session_volatility_dst=('workload_id_dst', 'nunique'),
+        ttl_variability=('ip_ttl', 'std'),
+    )
+    aggs['ip_macs'] = df.groupby('ip_src')['mac_src'].nunique().rename('macs')
+    for side, peer in (('src', 'dst'), ('dst', 'src')):
+        hosts = df.groupby([f'mac_{side}', f'ip_{side}']).agg(
+            bytes=('frame_len', 'sum'), peers=(f'ip_{peer}', 'nunique'))
+        hosts.index.names = ['mac', 'ip']
+        aggs[f'hosts_{side}'] = hosts
+    aggs['dst_macs'] = list(df['mac_dst'].unique())
+    return aggs
+
+
+def burstiness_ratio(workloads):
+    return workloads['active_minute_count'] / (workloads['session_length'] / 60).clip(lower=1)
+
+
+def sketch_quantile(values, weights, q, upper):
+    # weighted_quantile over the log-bucket histogram of values, read off the
+    # upper (threshold tested with ">") or lower bucket edges (see sketches.py)
+    weights = pd.Series(np.broadcast_to(np.asarray(weights, dtype='int64'), np.shape(values)))
+    histogram = weights.groupby(bucket_edge(values, upper)).sum()
+    return weighted_quantile(histogram.index, histogram.to_numpy(), q)
+
+
+def compute_thresholds(aggs, approximate=False):
+    # approximate: quantiles from log-bucket sketches instead of the sorted values
+    src, dst, combos = aggs['workloads_src'], aggs['workloads_dst'], aggs['combos']
+    ttl_std = combos['ttl_variability']
+
+    def quantile(values, weights, q, upper):
+        if approximate:
+            return sketch_quantile(values, weights, q, upper)
+        return weighted_quantile(values, weights, q)
+
+    if approximate:
+        ip_reuse_threshold = sketch_quantile(aggs['ip_macs'], 1, 0.5, upper=True)
+        ttl_median = sketch_quantile(ttl_std, 1, 0.5, upper=True)
+    else:
+        ip_reuse_threshold = aggs['ip_macs'].median()
+        ttl_median = ttl_std.median()
+    return {
+        'data_volume_q60': quantile(combos['data_volume'], combos['packets'], 0.60, upper=True),
+        'session_volatility_median': quantile(combos['session_volatility'], combos['packets'], 0.5, upper=False),
+        'session_length_src_median': quantile(src['session_length'], src['packets'], 0.5, upper=True),
+        'ip_reuse_threshold': ip_reuse_threshold,
+        'container_src_q65': quantile(combos['session_volatility_src'], combos['packets'], 0.65, upper=True),
+        'container_dst_q65': quantile(combos['session_volatility_dst'], combos['packets'], 0.65, upper=True),
+        'ttl_unstable': ttl_median + ttl_std.std(),
+        'bursty_src_median': quantile(burstiness_ratio(src), src['packets'], 0.5, upper=False),
+        'bursty_dst_median': quantile(burstiness_ratio(dst), dst['packets'], 0.5, upper=False),
+    }
+
+
+def _broadcast(table, *keys):
+    # Every column of an aggregate table aligned to the rows in one lookup
+    index = keys[0].to_numpy() if len(keys) == 1 else pd.MultiIndex.from_arrays(keys)
+    return {name: values.to_numpy() for name, values in table.reindex(index).items()}
+
+
+def apply_workload_features(df, aggs, th, scoring=None):
+    # Row-level part of stream_process_json for one chunk, with the groupby
+    # results looked up in the precomputed aggregate tables.
+    src = _broadcast(aggs['workloads_src'], df['workload_id_src'])
+    dst = _broadcast(aggs['workloads_dst'], df['workload_id_dst'])
+    combos = _broadcast(aggs['combos'], df['mac_ip_combo'])
+    hosts_src = _broadcast(aggs['hosts_src'], df['mac_src'], df['ip_src'])
+    hosts_dst = _broadcast(aggs['hosts_dst'], df['mac_dst'], df['ip_dst'])
+
+    df['session_length_src'] = src['session_length']
+    df['avg_payload_size_src'] = src['avg_payload_size']
+    df['is_data_heavy_src'] = df['avg_payload_size_src'] > 800
+    df['is_fin_api_pattern_src'] = df['is_tls_without_http'] & df['is_data_heavy_src']
+
+    df['session_length_dst'] = dst['session_length']
+    df['avg_payload_size_dst'] = dst['avg_payload_size']
+    df['is_data_heavy_dst'] = df['avg_payload_size_dst'] > 800
+    df['is_fin_api_pattern_dst'] = df['is_tls_without_http'] & df['is_data_heavy_dst']
+
+    df['data_volume'] = combos['data_volume']
+    df['is_data_intensive'] = df['data_volume'] > th['data_volume_q60']
+    df['session_volatility'] = combos['session_volatility']
+    df['is_stable_workload'] = df['session_volatility'] < th['session_volatility_median']
+    df['is_compliance_sensitive'] = (df['flow_relation'] == 'internal_only') & (
+        df['session_length_src'] > th['session_length_src_median'])
+
+    df['is_api_backend'] = df['is_fin_api_pattern_dst'] & df['is_data_heavy_dst']
+    df['is_gateway_pattern'] = df['is_fin_api_pattern_dst'] & ~df['is_data_heavy_dst']
+
+    df['inferred_artifact_type'] = None  # set with the scores below (artifact_scoring.py)
+
+    ip_macs = aggs['ip_macs']
+    df['is_possible_switch'] = df['ip_src'].isin(ip_macs.index[ip_macs > 3])
+    # mac_src is always in the set of source MACs, so "source-only" means
+    # "never seen as a destination"
+    df['is_forward_only_mac'] = ~df['mac_src'].isin(aggs['dst_macs'])
+    df['is_broadcast'] = df['mac_dst'] == 'ff:ff:ff:ff:ff:ff'
+    df['is_possible_switch'] |= df['is_forward_only_mac'] | df['is_broadcast']
+
+    df['dst_role'] = 'client'
+    df.loc[df['flow_relation'].isin(['external_to_internal', 'internal_to_external', 'external_only']),'dst_role'] = 'external_router'
+    df.loc[(df['flow_relation'] == 'internal_only') & df['src_is_internal'].fillna(False).astype(bool)
+           & df['dst_is_internal'].fillna(False).astype(bool),'dst_role'] = 'internal_router'
+
+    df['is_possible_vm_by_ip_reuse'] = df['ip_src'].map(ip_macs) > th['ip_reuse_threshold']
+
+    df['session_volatility_src'] = combos['session_volatility_src']
+    df['is_possible_container_src'] = df['session_volatility_src'] > th['container_src_q65']
+    df['session_volatility_dst'] = combos['session_volatility_dst']
+    df['is_possible_container_dst'] = df['session_volatility_dst'] > th['container_dst_q65']
+
+    df['ttl_variability'] = combos['ttl_variability']
+    df['is_ttl_unstable'] = df['ttl_variability'] > th['ttl_unstable']
+
+    virtual_flags = (
+        df['is_virtual_machine'] |
+        df['is_possible_vm_by_ip_reuse'] |
+        df['is_possible_container_src'] |
+        df['is_possible_container_dst'] |
+        df['is_ttl_unstable']
+    )
+    df['is_physical_machine'] = ~virtual_flags
+
+    df['active_seconds_src'] = df['session_length_src']
+    df['active_seconds_dst'] = df['session_length_dst']
+    df['connection_count_src'] = src['connection_count']
+    df['connection_count_dst'] = dst['connection_count']
+
+    df['bytes_sent'] = hosts_src['bytes']
+    df['bytes_received'] = hosts_dst['bytes']
+
+    df['response_delay_src'] = src['response_delay']
+    df['response_delay_dst'] = dst['response_delay']
+
+    df['peer_count_src'] = hosts_src['peers']
+    df['peer_count_dst'] = hosts_dst['peers']
+
+    df['active_minute_count_src'] = src['active_minute_count']
+    ratio = df['active_minute_count_src'] / (df['active_seconds_src'] / 60).clip(lower=1)
+    df['is_bursty_src'] = ratio < th['bursty_src_median']
+    df['active_minute_count_dst'] = dst['active_minute_count']
+    ratio = df['active_minute_count_dst'] / (df['active_seconds_dst'] / 60).clip(lower=1)
+    df['is_bursty_dst'] = ratio < th['bursty_dst_median']
+
+    for name, values in score_artifacts(df, scoring).items():
+        df[name] = values
+    return df
+
+
+def build_out_of_core(spill, out_parquet, memory_budget_mb=None, chunk_rows=65_536, scoring=None, workers=None):
+    # Second and third pass over the spilled packets: aggregates + thresholds
+    # via DuckDB, then chunk-by-chunk feature derivation into out_parquet.
+    spill.close()
+    aggs = compute_aggregates(spill.path, memory_budget_mb, temp_dir=os.path.join(spill.dir, 'duckdb'))
+    write_features(spill, out_parquet, aggs, chunk_rows, scoring, workers=workers)
+
+
+def feature_batches(frames, packet_schema, aggs, th, scoring=None):
+    schema = None
+    for df in frames:
+        df = apply_workload_features(df, aggs, th, scoring)
+        if schema is None:
+            schema = pa.schema([packet_schema.field(c) if c in packet_schema.names else pa.field(c, column_type(c))
+                                for c in df.columns])
+        yield frame_to_batch(df, schema)
+
+
+def write_features(spill, out_parquet, aggs, chunk_rows=65_536, scoring=None, approximate=False, workers=None):
+    th = compute_thresholds(aggs, approximate)
+    row_groups = pq.ParquetFile(spill.path).num_row_groups if workers and workers > 1 else 0
+    if row_groups > 1:
+        write_feature_parts(spill, out_parquet, (aggs, th, scoring), chunk_rows, workers, row_groups)
+        return
+    write_compact(feature_batches(spill.iter_frames(chunk_rows), spill.schema, aggs, th, scoring), out_parquet)
+
+
+def write_feature_part(spill_path, packet_schema, row_groups, features_path, chunk_rows, out_part):
+    # Worker: the last pass over some row groups of the spill
+    with open(features_path, 'rb') as f:
+        aggs, th, scoring = pickle.load(f)
+    batches = pq.ParquetFile(spill_path).iter_batches(batch_size=chunk_rows, row_groups=row_groups)
+    write_compact(feature_batches((b.to_pandas() for b in batches), packet_schema, aggs, th, scoring), out_part)
+    return out_part
+
+
+def write_feature_parts(spill, out_parquet, features, chunk_rows, workers, row_groups):
+    # Contiguous row-group ranges, one per worker; the parts are appended
+    # to out_parquet in spill order
+    features_path = os.path.join(spill.dir, 'features.pkl')
+    with open(features_path, 'wb') as f:
+        pickle.dump(features, f, protocol=pickle.HIGHEST_PROTOCOL)
+    tasks = [(write_feature_part, (spill.path, spill.schema, groups.tolist(), features_path, chunk_rows,
+                                   os.path.join(spill.dir, f'features-{i:05d}.parquet')))
+             for i, groups in enumerate(np.array_split(np.arange(row_groups), min(workers, row_groups)))]
+    writer = None
+    sketches = ColumnSketches()
+    try:
+        for part in run_tasks(tasks, workers, spill.dir):
+            part_file = pq.ParquetFile(part)
+            if writer is None:
+                writer = pq.ParquetWriter(out_parquet, part_file.schema_arrow, compression='zstd')
+            for i in range(part_file.num_row_groups):
+                writer.write_table(part_file.read_row_group(i))
+            sketches.merge(ColumnSketches.from_metadata(part_file.metadata.metadata))
+            part_file.close()
+            os.remove(part)
+        writer.add_key_value_metadata(sketches.metadata())
+    finally:
+        if writer is not None:
+            writer.close()
+        os.remove(features_path)
+
+
+def _id_part(value):
+    # The string that went into the workload hash (workload_key), so that
+    # workload_key(mac, ip, port) of a lookup row gives its workload_id back:
+    # a missing part was hashed as 'None'. Ports parsed as ints come back as
+    # floats (or NaN) once a column has gaps; print those as ints / 'None' again.
+    if value is None or value is pd.NA or (isinstance(value, float) and value != value):
+        return 'None'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def workload_lookup(df, known=None):
+    # Distinct workload_id -> (mac, ip, port) of a packet frame, merged into known
+    parts = [] if known is None else [known]
+    for side in ('src', 'dst'):
+        part = df[[f'workload_id_{side}', f'mac_{side}', f'ip_{side}', f'{side}_port']].drop_duplicates(f'workload_id_{side}')
+        part.columns = ['workload_id', 'mac', 'ip', 'port']
+        for col in ('mac', 'ip', 'port'):
+            part[col] = part[col].astype(object).map(_id_part)
+        parts.append(part)
+    return pd.concat(parts, ignore_index=True).drop_duplicates('workload_id')
+
+
+def upsert_workload_ids(path, ids):
+    if os.path.exists(path):
+        known = pd.read_parquet(path)
+        # Tables from earlier runs stored missing parts as nulls
+        known[['mac', 'ip', 'port']] = known[['mac', 'ip', 'port']].astype(object).fillna('None')
+        ids = pd.concat([known, ids], ignore_index=True).drop_duplicates('workload_id')
+    table = pa.table({
+        'workload_id': pa.Array.from_pandas(ids['workload_id'], type=pa.int64()),
+        'mac': pa.Array.from_pandas(ids['mac'], type=pa.string()),
+        'ip': pa.Array.from_pandas(ids['ip'], type=pa.string()),
+        'port': pa.Array.from_pandas(ids['port'], type=pa.string()),
+    })
+    pq.write_table(table, path + '.tmp')
+    os.replace(path + '.tmp', path)
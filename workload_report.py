@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Summary report over the all_workloads output in one scan.
+
+Every report section is a list of aggregates (or a distribution of one
+column) over the packets. report_sql puts all of them, plus a null count
+per column, into a single SELECT, so DuckDB reads the dataset once however
+many sections there are; distributions come back as histogram() maps.
+
+The resulting metrics are cached in a JSON file next to the dataset
+(<dataset>.report.json), keyed on a fingerprint of its files (path, size,
+mtime) and of the report SQL. Re-running the report on an unchanged
+output reads the cache and does not scan at all. Given a profile
+(dataset_profile.py) that knows the null count of every column, the null
+counts are taken from it and left out of the scan.
+"""
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+
+# (title, [(column, aggregate)]) or (title, {'group': column, 'where': ..., 'sort': bool})
+REPORT_SECTIONS = [
+    # workloads (initiators vs responders)
+    ("WORKLOADS: Count of Source and Destination Workloads", [
+        ('src_workloads', "COUNT(workload_id_src)"),
+        ('dst_workloads', "COUNT(workload_id_dst)"),
+    ]),
+    ("WORKLOADS: Count of Unique Source and Destination Workloads", [
+        ('unique_src_workloads', "COUNT(DISTINCT workload_id_src)"),
+        ('unique_dst_workloads', "COUNT(DISTINCT workload_id_dst)"),
+    ]),
+
+    # packet characteristics, volume, protocols, and infrastructure
+    ("TRAFFIC: Frame Size and TTL Distribution", [
+        ('avg_frame_len', "AVG(CAST(frame_len AS DOUBLE))"),
+        ('max_frame_len', "MAX(CAST(frame_len AS DOUBLE))"),
+        ('min_frame_len', "MIN(CAST(frame_len AS DOUBLE))"),
+        ('avg_ttl', "AVG(CAST(ip_ttl AS DOUBLE))"),
+        ('max_ttl', "MAX(CAST(ip_ttl AS DOUBLE))"),
+        ('min_ttl', "MIN(CAST(ip_ttl AS DOUBLE))"),
+    ]),
+    ("WORKLOADS: Count of Protocol Usage by Unique Workloads", [
+        (f'{proto}_{side}', f"COUNT(DISTINCT workload_id_{side}) FILTER (WHERE has_{proto})")
+        for proto in ('tls', 'fix', 'iso8583') for side in ('src', 'dst')
+    ]),
+    ("TRAFFIC: Protocol Presence", [
+        (proto, f"SUM(has_{proto}::INT)")
+        for proto in ('tcp', 'udp', 'tls', 'fix', 'iso8583', 'swift', 'rtsp', 'rtp', 'rtcp', 'icmp', 'arp', 'igmp')
+    ]),
+    ("TRAFFIC: DNS & QUIC/TLS Detection", [
+        ('dns_queries', "SUM(is_dns_query::INT)"),
+        ('dns_responses', "SUM(is_dns_response::INT)"),
+        ('quic_suspected', "SUM(is_quic::INT)"),
+        ('tls_wo_http', "SUM(is_tls_without_http::INT)"),
+    ]),
+    ("TRAFFIC: Financial Protocol Activity", [
+        ('likely_financial_flows', "SUM(is_likely_financial::INT)"),
+        ('avg_score', "AVG(financial_suspect_score)"),
+        ('max_score', "MAX(financial_suspect_score)"),
+    ]),
+    ("TRAFFIC: Switch Detection", [
+        ('possible_switches', "COUNT(*) FILTER (WHERE is_possible_switch)"),
+    ]),
+    ("TRAFFIC: Router Roles", {'group': 'dst_role'}),
+    ("TRAFFIC: Virtual/Physical Host Summary", [
+        ('vm_oui', "SUM(is_virtual_machine::INT)"),
+        ('vm_by_ip_reuse', "SUM(is_possible_vm_by_ip_reuse::INT)"),
+        ('containers', "SUM(is_possible_container_src::INT + is_possible_container_dst::INT)"),
+        ('ttl_unstable', "SUM(is_ttl_unstable::INT)"),
+        ('physical_hosts', "SUM(is_physical_machine::INT)"),
+    ]),
+
+    # behavior over time, interaction, and flow characteristics
+    ("COMM: Persistence by Workload Source", [
+        ('avg_active_seconds_src', "ROUND(AVG(active_seconds_src), 2)"),
+        ('max_active_seconds_src', "ROUND(MAX(active_seconds_src), 2)"),
+        ('avg_connection_count_src', "ROUND(AVG(connection_count_src), 2)"),
+        ('sessions_over_1_minute_src', "COUNT(*) FILTER (WHERE active_seconds_src > 60)"),
+    ]),
+    ("COMM: Persistence by Workload Destination", [
+        ('avg_active_seconds_dst', "ROUND(AVG(active_seconds_dst), 2)"),
+        ('max_active_seconds_dst', "ROUND(MAX(active_seconds_dst), 2)"),
+        ('avg_connection_count_dst', "ROUND(AVG(connection_count_dst), 2)"),
+        ('sessions_over_1_minute_dst', "COUNT(*) FILTER (WHERE active_seconds_dst > 60)"),
+    ]),
+    ("COMM: Traffic Symmetry & Delay", [
+        ('avg_bytes_sent', "ROUND(AVG(bytes_sent), 2)"),
+        ('avg_bytes_received', "ROUND(AVG(bytes_received), 2)"),
+        ('avg_response_delay_src', "ROUND(AVG(response_delay_src), 2)"),
+        ('avg_response_delay_dst', "ROUND(AVG(response_delay_dst), 2)"),
+        ('max_response_delay_src', "MAX(response_delay_src)"),
+        ('max_response_delay_dst', "MAX(response_delay_dst)"),
+    ]),
+    ("COMM: Fan-in and Fan-out", [
+        ('avg_fanout', "ROUND(AVG(peer_count_src), 2)"),
+        ('max_fanout', "ROUND(MAX(peer_count_src), 2)"),
+        ('avg_fanin', "ROUND(AVG(peer_count_dst), 2)"),
+        ('max_fanin', "ROUND(MAX(peer_count_dst), 2)"),
+    ]),
+    ("COMM: Bursty vs Rhythmic Behavior", [
+        ('bursty_src', "COUNT(*) FILTER (WHERE is_bursty_src)"),
+        ('rhythmic_src', "COUNT(*) FILTER (WHERE NOT is_bursty_src)"),
+        ('bursty_dst', "COUNT(*) FILTER (WHERE is_bursty_dst)"),
+        ('rhythmic_dst', "COUNT(*) FILTER (WHERE NOT is_bursty_dst)"),
+    ]),
+    ("Suitable Deployment Artifact Types", {'group': 'inferred_artifact_type', 'sort': True}),
+    ("Fallback Probabilities for None-Labeled Artifacts",
+     {'group': 'artifact_type_top', 'where': "inferred_artifact_type IS NULL", 'sort': True}),
+]
+
+CAPTURES = {'group': 'capture_id'}
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def report_sql(source, columns, sections=REPORT_SECTIONS):
+    # One SELECT for all sections (aliases s<i>_<column>), the packets per
+    # capture and the nulls per column (n<j>)
+    exprs = ["COUNT(*) AS total_rows"]
+    for i, (_, spec) in enumerate([*sections, ('captures', CAPTURES)]):
+        if isinstance(spec, dict):
+            where = spec.get('where')
+            group = _quote(spec['group'])
+            exprs.append(f"histogram({group})" + (f" FILTER (WHERE {where})" if where else "") + f" AS s{i}_values")
+            exprs.append(f"COUNT(*) FILTER (WHERE {group} IS NULL" + (f" AND {where}" if where else "")
+                         + f") AS s{i}_nulls")
+        else:
+            exprs += [f"{expr} AS s{i}_{name}" for name, expr in spec]
+    exprs += [f"COUNT(*) - COUNT({_quote(col)}) AS n{j}" for j, col in enumerate(columns)]
+    return f"SELECT {', '.join(exprs)} FROM {source}"
+
+
+def dataset_files(path):
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(path)
+                  for name in names if name.endswith('.parquet'))
+
+
+def fingerprint(path, sql):
+    h = hashlib.sha1(sql.encode('utf-8'))
+    for f in dataset_files(path):
+        stat = os.stat(f)
+        h.update(f"{os.path.relpath(f, path)}|{stat.st_size}|{stat.st_mtime_ns}".encode('utf-8'))
+    return h.hexdigest()
+
+
+def _plain(value):
+    # JSON-friendly metric values; histogram maps become [[value, count], ...]
+    if isinstance(value, dict):
+        return [[k, _plain(v)] for k, v in value.items()]
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+def _profile_nulls(profile, columns):
+    if profile is None:
+        return None
+    known = profile.set_index('column')['null_count']
+    if not all(col in known.index and not pd.isna(known[col]) for col in columns):
+        return None
+    return [int(known[col]) for col in columns]
+
+
+def report_metrics(con, source, dataset_path, cache_path=None, profile=None):
+    # {'columns': [...], 'values': {alias: value}} for source (a view or
+    # parquet_scan(...) over dataset_path), cached per dataset fingerprint
+    columns = [name for name, *_ in con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+    nulls = _profile_nulls(profile, columns)
+    sql = report_sql(source, columns if nulls is None else [])
+    key = fingerprint(dataset_path, sql)
+    cache_path = cache_path or dataset_path.rstrip('/\\') + '.report.json'
+    if os.path.exists(cache_path):
+        with open(cache_path, encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached.get('fingerprint') == key:
+            return cached['metrics']
+
+    result = con.execute(sql)
+    names = [d[0] for d in result.description]
+    metrics = {'columns': columns, 'values': {n: _plain(v) for n, v in zip(names, result.fetchone())}}
+    if nulls is not None:
+        metrics['values'].update({f'n{j}': n for j, n in enumerate(nulls)})
+    with open(cache_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'fingerprint': key, 'metrics': metrics}, f)
+    os.replace(cache_path + '.tmp', cache_path)
+    return metrics
+
+
+def null_counts(metrics):
+    # Series column -> null count
+    return pd.Series([metrics['values'][f'n{j}'] for j in range(len(metrics['columns']))],
+                     index=metrics['columns'])
+
+
+def _distribution(values, i, spec):
+    column = spec['group']
+    pairs = list(values[f's{i}_values'] or [])
+    if values[f's{i}_nulls']:
+        pairs.append([None, values[f's{i}_nulls']])
+    frame = pd.DataFrame(pairs, columns=[column, 'count'])
+    if spec.get('sort'):
+        frame = frame.sort_values('count', ascending=False, kind='stable')
+    return frame.reset_index(drop=True)
+
+
+def report_sections(metrics, captures=None):
+    # [(title, DataFrame)] in report order; captures: capture table to join
+    # onto the packets per capture
+    values = metrics['values']
+    sections = []
+    if captures is not None:
+        packets = _distribution(values, len(REPORT_SECTIONS), CAPTURES).rename(columns={'count': 'packets'})
+        sections.append(("CAPTURES: Packets per Capture", packets.merge(captures, on='capture_id', how='left')))
+    nulls = null_counts(metrics)
+    missing = pd.DataFrame({'Column': [f'{col}_missing' for col in nulls.index], 'Missing Count': nulls.to_numpy()})
+    missing = missing.sort_values(by='Missing Count', ascending=False, kind='stable').reset_index(drop=True)
+    sections.append(("MISSING VALUES SUMMARY", missing))
+    for i, (title, spec) in enumerate(REPORT_SECTIONS):
+        if isinstance(spec, dict):
+            sections.append((title, _distribution(values, i, spec)))
+        else:
+            sections.append((title, pd.DataFrame([{name: values[f's{i}_{name}'] for name, _ in spec}])))
+    return sections
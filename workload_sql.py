@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+DuckDB backend for preprosessing_update.stream_process_json.
+
+The packets are enriched and spilled exactly as in the out-of-core pandas
+build (workload_features.PacketSpill); from there every derivation runs in
+DuckDB: the per-workload / per-host aggregate tables, the quantile and
+median thresholds, the row-level flags, the artifact scores, entropy and
+ranking. The result is streamed out in record batches, so DuckDB spills to
+disk under the memory budget and uses all cores; pandas never holds more
+than one chunk.
+
+Thresholds are weighted quantiles over the aggregate tables (weight =
+packets per key), which is what the pandas quantile over the packet rows
+computes, without keeping one value per packet in memory.
+"""
+
+import os
+
+from artifact_scoring import ARTIFACT_SCORING, rules_sql, scores_sql
+from output_schema import write_compact
+from sketches import bucket_edge_sql
+from workload_features import connect_duckdb, create_aggregate_tables
+
+
+OUTPUT_BATCH_ROWS = 122_880
+
+FEATURE_COLUMNS = [
+    'session_length_src', 'avg_payload_size_src', 'is_data_heavy_src', 'is_fin_api_pattern_src',
+    'session_length_dst', 'avg_payload_size_dst', 'is_data_heavy_dst', 'is_fin_api_pattern_dst',
+    'data_volume', 'is_data_intensive', 'session_volatility', 'is_stable_workload', 'is_compliance_sensitive',
+    'is_api_backend', 'is_gateway_pattern', 'inferred_artifact_type',
+    'is_possible_switch', 'is_forward_only_mac', 'is_broadcast', 'dst_role', 'is_possible_vm_by_ip_reuse',
+    'session_volatility_src', 'is_possible_container_src', 'session_volatility_dst', 'is_possible_container_dst',
+    'ttl_variability', 'is_ttl_unstable', 'is_physical_machine',
+    'active_seconds_src', 'active_seconds_dst', 'connection_count_src', 'connection_count_dst',
+    'bytes_sent', 'bytes_received', 'response_delay_src', 'response_delay_dst', 'peer_count_src', 'peer_count_dst',
+    'active_minute_count_src', 'is_bursty_src', 'active_minute_count_dst', 'is_bursty_dst',
+    'artifact_type_entropy', 'artifact_type_top', 'artifact_type_top_score', 'artifact_type_ranked',
+]
+
+def weighted_quantile_sql(table, value, weight, q, midpoint=False):
+    # workload_features.weighted_quantile as a scalar subquery; midpoint gives
+    # pandas' median ((a + b) / 2) instead of linear interpolation.
+    result = "(a + b) / 2" if midpoint else "CASE WHEN t >= 0.5 THEN b - (b - a) * (1 - t) ELSE a + (b - a) * t END"
+    return f"""(
+        WITH v AS (
+            SELECT CAST({value} AS DOUBLE) AS value, SUM({weight}) AS w
+            FROM {table} WHERE {value} IS NOT NULL GROUP BY 1
+        ),
+        c AS (SELECT value, SUM(w) OVER (ORDER BY value) AS ends FROM v),
+        p AS (
+            SELECT pos, lo, LEAST(lo + 1, n - 1) AS hi, pos - lo AS t
+            FROM (SELECT pos, FLOOR(pos) AS lo, n
+                  FROM (SELECT (CAST(SUM(w) AS DOUBLE) - 1) * {q} AS pos, SUM(w) AS n FROM v))
+        ),
+        ab AS (
+            SELECT (SELECT MIN(value) FROM c WHERE ends > p.lo) AS a,
+                   (SELECT MIN(value) FROM c WHERE ends > p.hi) AS b, t
+            FROM p
+        )
+        SELECT {result} FROM ab
+    )"""
+
+
+def _bursty_ratio(prefix=''):
+    return (f"{prefix}active_minute_count / CASE WHEN {prefix}session_length IS NULL THEN NULL "
+            f"ELSE GREATEST({prefix}session_length / 60, 1) END")
+
+
+def thresholds_sql(approximate=False):
+    # approximate: quantiles over log-bucket histograms (sketches.py), as
+    # workload_features.compute_thresholds(approximate=True)
+    def quantile(table, value, weight, q, upper, midpoint=False):
+        if approximate:
+            value = bucket_edge_sql(value, upper)
+        return weighted_quantile_sql(table, value, weight, q, midpoint)
+
+    return f"""
+    CREATE TABLE thresholds AS SELECT
+        {quantile('combos', 'data_volume', 'packets', 0.60, upper=True)} AS data_volume_q60,
+        {quantile('combos', 'session_volatility', 'packets', 0.5, upper=False)} AS session_volatility_median,
+        {quantile('workloads_src', 'session_length', 'packets', 0.5, upper=True)} AS session_length_src_median,
+        {quantile('ip_macs', 'macs', '1', 0.5, upper=True, midpoint=True)} AS ip_reuse_threshold,
+        {quantile('combos', 'session_volatility_src', 'packets', 0.65, upper=True)} AS container_src_q65,
+        {quantile('combos', 'session_volatility_dst', 'packets', 0.65, upper=True)} AS container_dst_q65,
+        {quantile('combos', 'ttl_variability', '1', 0.5, upper=True, midpoint=True)}
+            + (SELECT STDDEV_SAMP(ttl_variability) FROM combos) AS ttl_unstable,
+        {quantile('workloads_src', _bursty_ratio(), 'packets', 0.5, upper=False)} AS bursty_src_median,
+        {quantile('workloads_dst', _bursty_ratio(), 'packets', 0.5, upper=False)} AS bursty_dst_median
+"""
+
+
+FEATURES_SQL = """
+    WITH joined AS (
+        SELECT p.*,
+               ws.session_length AS session_length_src, ws.avg_payload_size AS avg_payload_size_src,
+               ws.connection_count AS connection_count_src, ws.response_delay AS response_delay_src,
+               ws.active_minute_count AS active_minute_count_src,
+               {bursty_src} AS bursty_ratio_src,
+               wd.session_length AS session_length_dst, wd.avg_payload_size AS avg_payload_size_dst,
+               wd.connection_count AS connection_count_dst, wd.response_delay AS response_delay_dst,
+               wd.active_minute_count AS active_minute_count_dst,
+               {bursty_dst} AS bursty_ratio_dst,
+               CAST(c.data_volume AS BIGINT) AS data_volume, c.session_volatility,
+               c.session_volatility_src, c.session_volatility_dst, c.ttl_variability,
+               CAST(hs.bytes AS DOUBLE) AS bytes_sent, CAST(hs.peers AS DOUBLE) AS peer_count_src,
+               CAST(hd.bytes AS DOUBLE) AS bytes_received, CAST(hd.peers AS DOUBLE) AS peer_count_dst,
+               im.macs AS ip_mac_count,
+               -- a missing mac_src counts as seen when some mac_dst is missing too
+               dm.mac IS NULL AND NOT (p.mac_src IS NULL AND EXISTS (SELECT 1 FROM dst_macs WHERE mac IS NULL))
+                   AS is_forward_only_mac
+        FROM packets p
+        LEFT JOIN workloads_src ws ON ws.workload_id_src = p.workload_id_src
+        LEFT JOIN workloads_dst wd ON wd.workload_id_dst = p.workload_id_dst
+        LEFT JOIN combos c ON c.mac_ip_combo = p.mac_ip_combo
+        LEFT JOIN hosts_src hs ON hs.mac = p.mac_src AND hs.ip = p.ip_src
+        LEFT JOIN hosts_dst hd ON hd.mac = p.mac_dst AND hd.ip = p.ip_dst
+        LEFT JOIN ip_macs im ON im.ip_src = p.ip_src
+        LEFT JOIN dst_macs dm ON dm.mac = p.mac_src
+    ),
+    flagged AS (
+        SELECT j.*,
+               COALESCE(avg_payload_size_src > 800, false) AS is_data_heavy_src,
+               COALESCE(avg_payload_size_dst > 800, false) AS is_data_heavy_dst,
+               COALESCE(data_volume > th.data_volume_q60, false) AS is_data_intensive,
+               COALESCE(session_volatility < th.session_volatility_median, false) AS is_stable_workload,
+               COALESCE(flow_relation = 'internal_only' AND session_length_src > th.session_length_src_median, false)
+                   AS is_compliance_sensitive,
+               COALESCE(mac_dst = 'ff:ff:ff:ff:ff:ff', false) AS is_broadcast,
+               CASE WHEN flow_relation IN ('external_to_internal', 'internal_to_external', 'external_only')
+                        THEN 'external_router'
+                    WHEN flow_relation = 'internal_only' AND COALESCE(src_is_internal, false)
+                         AND COALESCE(dst_is_internal, false) THEN 'internal_router'
+                    ELSE 'client' END AS dst_role,
+               COALESCE(ip_mac_count > th.ip_reuse_threshold, false) AS is_possible_vm_by_ip_reuse,
+               COALESCE(session_volatility_src > th.container_src_q65, false) AS is_possible_container_src,
+               COALESCE(session_volatility_dst > th.container_dst_q65, false) AS is_possible_container_dst,
+               COALESCE(ttl_variability > th.ttl_unstable, false) AS is_ttl_unstable,
+               COALESCE(bursty_ratio_src < th.bursty_src_median, false) AS is_bursty_src,
+               COALESCE(bursty_ratio_dst < th.bursty_dst_median, false) AS is_bursty_dst
+        FROM joined j, thresholds th
+    ),
+    derived AS (
+        SELECT *,
+               COALESCE(is_tls_without_http, false) AND is_data_heavy_src AS is_fin_api_pattern_src,
+               COALESCE(is_tls_without_http, false) AND is_data_heavy_dst AS is_fin_api_pattern_dst,
+               COALESCE(ip_mac_count > 3, false) OR is_forward_only_mac OR is_broadcast AS is_possible_switch,
+               NOT (COALESCE(is_virtual_machine, false) OR is_possible_vm_by_ip_reuse OR is_possible_container_src
+                    OR is_possible_container_dst OR is_ttl_unstable) AS is_physical_machine,
+               session_length_src AS active_seconds_src,
+               session_length_dst AS active_seconds_dst
+        FROM flagged
+    ),
+    labelled AS (
+        SELECT *,
+               is_fin_api_pattern_dst AND is_data_heavy_dst AS is_api_backend,
+               is_fin_api_pattern_dst AND NOT is_data_heavy_dst AS is_gateway_pattern
+        FROM derived
+    ),
+    scored AS (
+        SELECT *, {rules} AS rule_artifact_type, {scores}
+        FROM labelled
+    ),
+    ranked AS (
+        SELECT *,
+               {score_sum} AS score_sum,
+               list_transform(list_sort([{score_structs}]), x -> x.name) AS artifact_type_ranked,
+               GREATEST({score_cols}) AS artifact_type_top_score
+        FROM scored
+    ),
+    normalized AS (
+        SELECT *, {normalized}
+        FROM ranked
+    )
+    SELECT {columns}
+    FROM (
+        SELECT *,
+               -({entropy}) AS artifact_type_entropy,
+               artifact_type_ranked[1] AS artifact_type_top,
+               -- no rule matched: fall back to the top-ranked artifact
+               COALESCE(rule_artifact_type, {fallback}) AS inferred_artifact_type
+        FROM normalized
+    )
+    ORDER BY file_row_number
+"""
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def features_sql(packet_columns, scoring=None):
+    scoring = scoring or ARTIFACT_SCORING
+    artifact_scores = scores_sql(scoring)
+    names = [name for name, _ in artifact_scores]
+    score = {name: f"score_{name}" for name in names}
+    norm = {name: f"norm_{name}" for name in names}
+    entropy = ' + '.join(f"{norm[name]} * LN({norm[name]})" for name in names)
+    fallback = "artifact_type_ranked[1]"
+    if scoring['fallback_max_entropy'] is not None:
+        fallback = f"CASE WHEN -({entropy}) < {scoring['fallback_max_entropy']} THEN {fallback} END"
+    return FEATURES_SQL.format(
+        bursty_src=_bursty_ratio('ws.'),
+        bursty_dst=_bursty_ratio('wd.'),
+        rules=rules_sql(scoring),
+        scores=', '.join(f"CAST({expr} AS DOUBLE) AS {score[name]}" for name, expr in artifact_scores),
+        score_sum=' + '.join(score[name] for name in names),
+        # tied scores keep config order (the pandas build keeps the original tie order, see artifact_scoring.py)
+        score_structs=', '.join(f"{{'key': -{score[name]}, 'rank': {i}, 'name': '{name}'}}"
+                                for i, name in enumerate(names)),
+        score_cols=', '.join(score[name] for name in names),
+        normalized=', '.join(
+            f"LEAST(GREATEST({score[name]} / CASE WHEN score_sum = 0 THEN 1 ELSE score_sum END, 1e-12), 1.0)"
+            f" AS {norm[name]}" for name in names),
+        entropy=entropy,
+        fallback=fallback,
+        columns=', '.join(_quote(c) for c in list(packet_columns) + FEATURE_COLUMNS),
+    )
+
+
+def build_in_duckdb(spill, out_parquet, memory_budget_mb=None, threads=None, scoring=None):
+    # Everything after the enrichment pass, as DuckDB SQL over the spilled packets
+    spill.close()
+    con = connect_duckdb(memory_budget_mb, temp_dir=os.path.join(spill.dir, 'duckdb'), threads=threads)
+    try:
+        con.execute(f"CREATE VIEW packets AS SELECT * FROM read_parquet('{spill.path}', file_row_number = true)")
+        create_aggregate_tables(con)
+        write_features_sql(con, spill, out_parquet, scoring)
+    finally:
+        con.close()
+
+
+def write_features_sql(con, spill, out_parquet, scoring=None, approximate=False):
+    # Thresholds and row features from the aggregate tables already in con
+    con.execute(thresholds_sql(approximate))
+    result = con.execute(features_sql(spill.schema.names, scoring))
+    # to_arrow_reader: fetch_record_batch's newer name (the old one is deprecated)
+    reader = getattr(result, 'to_arrow_reader', result.fetch_record_batch)(OUTPUT_BATCH_ROWS)
+    write_compact(reader, out_parquet, reader.schema)
@@ -0,0 +1,568 @@
+# -*- coding: utf-8 -*-
+"""
+Persisted, mergeable aggregate state for stream_process_json(state_dir=...).
+
+Instead of recomputing every per-workload and per-host statistic over the
+whole history, each run reduces only the new capture to partial state
+tables and merges them into the stored state:
+
+- counts, sums, min/max time per workload, packets and bytes per host;
+- Welford (count, mean, M2) for the TTL of each mac_ip_combo, merged with
+  Chan's formula;
+- sets of (key, member) rows for every distinct count: minutes per
+  workload, src/dst workloads per combo, MACs per IP, peers per host;
+- packets per (combo, src workload), so the session-length volatility of
+  a combo follows its workloads' current session lengths;
+- a log-bucket histogram of inter-arrival gaps per workload.
+
+The state grows with the number of keys, never with packets, and the packet
+history is never read again. The features of the new capture are derived
+from the merged state, i.e. they reflect every capture ingested so far.
+
+Every state table is a list of segment files, and an ingest only writes
+the new capture's partial table as a new segment: nothing stored is
+rewritten, and readers merge the segments per key. Member sets only get
+the members not stored yet (an anti-join on the keys the capture
+touches), plus a count table per key (<set>_n), so distinct counts are read
+from the counts, never from the sets. Segments of a table are compacted
+size-tiered: the newest one is merged into the one before it while it is
+at least 1/COMPACT_RATIO of its size, which keeps a logarithmic number of
+segments and rewrites every row a logarithmic number of times.
+
+response_delay is the one approximate feature: an exact median cannot be
+merged in bounded space, so it is read off the gap histogram (relative
+error below (GAP_GAMMA - 1) / (GAP_GAMMA + 1), i.e. 1%). Captures of a
+workload are expected in time order; the gap between two captures is added
+when they do not overlap.
+
+Each merge writes its segments and a new version manifest (vNNNNNN.json,
+the segment files per table) and then switches the CURRENT pointer, so an
+interrupted run leaves the previous state intact. Captures are recorded by
+capture_id; packets without one (input from before capture metadata) by a
+fingerprint of their contents, so merging the same input twice is refused
+either way.
+
+approximate=True keeps HyperLogLog registers instead of the member sets
+(SKETCHED_SETS; the (combo, src workload) packets stay, they carry the
+volatility) and takes the thresholds from log-bucket sketches, so no table
+grows with the number of distinct members. build_approximate uses the same
+state for a single capture without keeping it; approximation_report
+compares both modes on a sample. Error bounds are in sketches.py.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from sketches import (bucket_edge_error, bucket_value_sql, hll_count_sql, hll_error, hll_registers_sql,
+                      log_bucket_error, log_bucket_sql)
+from workload_features import (apply_workload_features, compute_thresholds, connect_duckdb,
+                               create_aggregate_tables, fetch_aggregates, write_features)
+from workload_sql import FEATURE_COLUMNS, write_features_sql
+
+
+GAP_GAMMA = 1.02
+COMPACT_RATIO = 2
+
+
+def _gap_bucket(gap):
+    return log_bucket_sql(gap, GAP_GAMMA)
+
+
+def _gap_value(bucket):
+    return bucket_value_sql(bucket, GAP_GAMMA)
+
+
+# name: (key columns, {column: merge aggregate}, partial state SQL over packets)
+STATE_TABLES = {}
+for _side, _peer in (('src', 'dst'), ('dst', 'src')):
+    _key = f'workload_id_{_side}'
+    STATE_TABLES[f'workloads_{_side}'] = ([_key], {
+        'packets': 'SUM', 't_min': 'MIN', 't_max': 'MAX',
+        'len_sum': 'SUM', 'len_count': 'SUM', 'connection_count': 'SUM',
+    }, f"""
+        SELECT {_key}, COUNT(*) AS packets,
+               MIN(frame_time_epoch) AS t_min, MAX(frame_time_epoch) AS t_max,
+               CAST(COALESCE(SUM(frame_len), 0) AS BIGINT) AS len_sum, COUNT(frame_len) AS len_count,
+               COUNT(frame_time_epoch) AS connection_count
+        FROM packets GROUP BY {_key}
+    """)
+    STATE_TABLES[f'workload_minutes_{_side}'] = ([_key, 'minute'], {}, f"""
+        SELECT DISTINCT {_key}, CAST(epoch_minute AS BIGINT) AS minute
+        FROM packets WHERE epoch_minute IS NOT NULL
+    """)
+    STATE_TABLES[f'workload_gaps_{_side}'] = ([_key, 'bucket'], {'n': 'SUM'}, f"""
+        SELECT {_key}, {_gap_bucket('gap')} AS bucket, COUNT(*) AS n
+        FROM (
+            SELECT {_key},
+                   frame_time_epoch - LAG(frame_time_epoch) OVER (PARTITION BY {_key} ORDER BY frame_time_epoch) AS gap
+            FROM packets
+        )
+        WHERE gap IS NOT NULL GROUP BY ALL
+    """)
+    STATE_TABLES[f'combo_workloads_{_side}'] = (['mac_ip_combo', _key], {'packets': 'SUM'}, f"""
+        SELECT mac_ip_combo, {_key}, COUNT(*) AS packets FROM packets GROUP BY ALL
+    """)
+    STATE_TABLES[f'hosts_{_side}'] = (['mac', 'ip'], {'bytes': 'SUM'}, f"""
+        SELECT mac_{_side} AS mac, ip_{_side} AS ip, CAST(SUM(frame_len) AS BIGINT) AS bytes
+        FROM packets WHERE mac_{_side} IS NOT NULL AND ip_{_side} IS NOT NULL GROUP BY ALL
+    """)
+    STATE_TABLES[f'host_peers_{_side}'] = (['mac', 'ip', 'peer'], {}, f"""
+        SELECT DISTINCT mac_{_side} AS mac, ip_{_side} AS ip, ip_{_peer} AS peer
+        FROM packets WHERE mac_{_side} IS NOT NULL AND ip_{_side} IS NOT NULL AND ip_{_peer} IS NOT NULL
+    """)
+STATE_TABLES['combos'] = (['mac_ip_combo'], None, """
+    SELECT mac_ip_combo, COUNT(*) AS packets, CAST(COALESCE(SUM(frame_len), 0) AS BIGINT) AS data_volume,
+           COUNT(ttl) AS ttl_n, AVG(ttl) AS ttl_mean, COALESCE(VAR_POP(ttl) * COUNT(ttl), 0) AS ttl_m2
+    FROM (SELECT *, TRY_CAST(ip_ttl AS DOUBLE) AS ttl FROM packets)
+    GROUP BY mac_ip_combo
+""")
+STATE_TABLES['ip_macs'] = (['ip_src', 'mac_src'], {}, """
+    SELECT DISTINCT ip_src, mac_src FROM packets WHERE ip_src IS NOT NULL
+""")
+STATE_TABLES['dst_macs'] = (['mac'], {}, "SELECT DISTINCT mac_dst AS mac FROM packets")
+STATE_TABLES['captures'] = (['capture_id'], {}, """
+    SELECT DISTINCT capture_id FROM packets WHERE capture_id IS NOT NULL
+""")
+
+# Distinct-count sets kept as HyperLogLog registers (sketches.py) in
+# approximate mode, as table name + '_hll': (keys, member, source)
+SKETCHED_SETS = {
+    'combo_workloads_dst': (['mac_ip_combo'], 'workload_id_dst', 'packets'),
+    'ip_macs': (['ip_src'], 'mac_src', "(SELECT ip_src, mac_src FROM packets WHERE ip_src IS NOT NULL)"),
+}
+for _side, _peer in (('src', 'dst'), ('dst', 'src')):
+    _key = f'workload_id_{_side}'
+    SKETCHED_SETS[f'workload_minutes_{_side}'] = (
+        [_key], 'minute', f"(SELECT {_key}, CAST(epoch_minute AS BIGINT) AS minute FROM packets)")
+    SKETCHED_SETS[f'host_peers_{_side}'] = (['mac', 'ip'], 'peer', f"""(
+        SELECT mac_{_side} AS mac, ip_{_side} AS ip, ip_{_peer} AS peer
+        FROM packets WHERE mac_{_side} IS NOT NULL AND ip_{_side} IS NOT NULL
+    )""")
+
+
+def state_tables(approximate=False):
+    # Exact state adds a count table per member set of SKETCHED_SETS
+    # (no partial SQL: filled from the members a merge adds)
+    if not approximate:
+        tables = dict(STATE_TABLES)
+        for name, (keys, _, _) in SKETCHED_SETS.items():
+            if STATE_TABLES[name][1] == {}:
+                tables[name + '_n'] = (keys, {'n': 'SUM'}, None)
+        return tables
+    tables = {}
+    for name, table in STATE_TABLES.items():
+        if name in SKETCHED_SETS:
+            keys, member, source = SKETCHED_SETS[name]
+            tables[name + '_hll'] = (keys + ['reg'], {'rank': 'MAX'}, hll_registers_sql(source, keys, member))
+        else:
+            tables[name] = table
+    return tables
+
+# Welford merge (Chan et al.): M2 = sum M2_i + sum n_i * (mean_i - mean)^2
+COMBOS_MERGE_SQL = """
+    WITH u AS (SELECT * FROM {rows}),
+    g AS (
+        SELECT mac_ip_combo, SUM(packets) AS packets, SUM(data_volume) AS data_volume, SUM(ttl_n) AS ttl_n,
+               SUM(ttl_n * ttl_mean) / NULLIF(SUM(ttl_n), 0) AS ttl_mean
+        FROM u GROUP BY mac_ip_combo
+    )
+    SELECT g.mac_ip_combo, CAST(g.packets AS BIGINT) AS packets, CAST(g.data_volume AS BIGINT) AS data_volume,
+           CAST(g.ttl_n AS BIGINT) AS ttl_n, g.ttl_mean,
+           SUM(u.ttl_m2 + COALESCE(u.ttl_n * POW(u.ttl_mean - g.ttl_mean, 2), 0)) AS ttl_m2
+    FROM g JOIN u USING (mac_ip_combo)
+    GROUP BY ALL
+"""
+
+# Gap between the stored and the new packets of a workload, when the two do not overlap
+BOUNDARY_GAPS_SQL = """
+    SELECT {key}, {bucket} AS bucket, 1 AS n
+    FROM (
+        SELECT n.{key},
+               CASE WHEN n.t_min >= o.t_max THEN n.t_min - o.t_max
+                    WHEN n.t_max <= o.t_min THEN o.t_min - n.t_max END AS gap
+        FROM new_workloads_{side} n JOIN old_workloads_{side} o USING ({key})
+    )
+    WHERE gap IS NOT NULL
+"""
+
+# Aggregate tables of workload_features.create_aggregate_tables, from the
+# state; {name} stands for the distinct counts of SKETCHED_SETS[name]
+AGGREGATES_SQL = {}
+for _side in ('src', 'dst'):
+    _key = f'workload_id_{_side}'
+    AGGREGATES_SQL[f'workloads_{_side}'] = f"""
+        SELECT w.{_key}, w.packets, w.t_max - w.t_min AS session_length,
+               w.len_sum / NULLIF(w.len_count, 0) AS avg_payload_size, w.connection_count,
+               COALESCE(m.n, 0) AS active_minute_count,
+               CASE WHEN w.packets <= 1 THEN 0
+                    WHEN w.connection_count < w.packets THEN NULL
+                    ELSE g.median END AS response_delay
+        FROM state_workloads_{_side} w
+        LEFT JOIN ({{workload_minutes_{_side}}}) m USING ({_key})
+        LEFT JOIN (
+            SELECT {_key}, (MIN(value) FILTER (WHERE ends > (total - 1) // 2)
+                            + MIN(value) FILTER (WHERE ends > total // 2)) / 2 AS median
+            FROM (
+                SELECT {_key}, {_gap_value('bucket')} AS value,
+                       SUM(n) OVER (PARTITION BY {_key} ORDER BY bucket) AS ends,
+                       SUM(n) OVER (PARTITION BY {_key}) AS total
+                FROM state_workload_gaps_{_side}
+            )
+            GROUP BY ALL
+        ) g USING ({_key})
+    """
+    AGGREGATES_SQL[f'hosts_{_side}'] = f"""
+        SELECT h.mac, h.ip, h.bytes, COALESCE(p.n, 0) AS peers
+        FROM state_hosts_{_side} h
+        LEFT JOIN ({{host_peers_{_side}}}) p USING (mac, ip)
+    """
+AGGREGATES_SQL['combos'] = """
+    WITH x AS (
+        -- session lengths shifted by the combo's smallest, so equal ones give exactly 0
+        SELECT cw.mac_ip_combo, cw.packets,
+               w.session_length - MIN(w.session_length) OVER (PARTITION BY cw.mac_ip_combo) AS shifted
+        FROM state_combo_workloads_src cw JOIN workloads_src w USING (workload_id_src)
+        WHERE w.session_length IS NOT NULL
+    ),
+    m AS (
+        SELECT mac_ip_combo, SUM(packets) AS n, SUM(packets * shifted) / SUM(packets) AS mean
+        FROM x GROUP BY mac_ip_combo
+    ),
+    volatility AS (
+        -- sample std of the session length over the combo's packets
+        SELECT mac_ip_combo,
+               CASE WHEN m.n > 1 THEN SQRT(SUM(x.packets * POW(x.shifted - m.mean, 2)) / (m.n - 1)) END
+                   AS session_volatility
+        FROM x JOIN m USING (mac_ip_combo) GROUP BY mac_ip_combo, m.n
+    )
+    SELECT c.mac_ip_combo, c.packets, c.data_volume, v.session_volatility,
+           COALESCE(s.workloads, 0) AS session_volatility_src, COALESCE(d.n, 0) AS session_volatility_dst,
+           CASE WHEN c.ttl_n > 1 THEN SQRT(c.ttl_m2 / (c.ttl_n - 1)) END AS ttl_variability
+    FROM state_combos c
+    LEFT JOIN volatility v USING (mac_ip_combo)
+    LEFT JOIN (SELECT mac_ip_combo, COUNT(*) AS workloads FROM state_combo_workloads_src GROUP BY ALL) s
+        USING (mac_ip_combo)
+    LEFT JOIN ({combo_workloads_dst}) d USING (mac_ip_combo)
+"""
+AGGREGATES_SQL['ip_macs'] = "SELECT ip_src, n AS macs FROM ({ip_macs})"
+AGGREGATES_SQL['dst_macs'] = "SELECT mac FROM state_dst_macs"
+
+# Exact distinct counts, from the count tables of the member sets
+EXACT_COUNTS_SQL = {
+    'combo_workloads_dst': "SELECT mac_ip_combo, COUNT(*) AS n FROM state_combo_workloads_dst GROUP BY ALL",
+    'ip_macs': "SELECT ip_src, n FROM state_ip_macs_n",
+}
+for _side in ('src', 'dst'):
+    EXACT_COUNTS_SQL[f'workload_minutes_{_side}'] = f"SELECT workload_id_{_side}, n FROM state_workload_minutes_{_side}_n"
+    EXACT_COUNTS_SQL[f'host_peers_{_side}'] = f"SELECT mac, ip, n FROM state_host_peers_{_side}_n"
+
+# Packets without a capture_id, recorded in the captures table under this id
+FINGERPRINT_SQL = """
+    SELECT COUNT(*), SUM(hash(frame_time_epoch, frame_len, mac_src, mac_dst, ip_src, ip_dst, src_port, dst_port,
+                              ip_ttl)::HUGEINT)
+    FROM packets WHERE capture_id IS NULL
+"""
+
+
+def aggregates_sql(approximate=False):
+    if approximate:
+        counts = {name: hll_count_sql(f'state_{name}_hll', keys, 'n') for name, (keys, _, _) in SKETCHED_SETS.items()}
+    else:
+        counts = EXACT_COUNTS_SQL
+    return {name: sql.format(**counts) for name, sql in AGGREGATES_SQL.items()}
+
+
+def merge_sql(name, tables, rows):
+    # The merged rows of a state table; rows: a relation with its partial rows
+    keys, merges, _ = tables[name]
+    if merges is None:
+        return COMBOS_MERGE_SQL.format(rows=rows)
+    if not merges:  # member set: its segments are disjoint
+        return f"SELECT * FROM {rows}"
+    columns = ', '.join(keys + [f"CAST(SUM({col}) AS BIGINT) AS {col}" if agg == 'SUM' else f"{agg}({col}) AS {col}"
+                                for col, agg in merges.items()])
+    return f"SELECT {columns} FROM {rows} GROUP BY {', '.join(keys)}"
+
+
+def _segment_rows(state_dir, segments):
+    files = ', '.join(f"'{os.path.join(state_dir, seg['file'])}'" for seg in segments)
+    return f"read_parquet([{files}], union_by_name = true)"
+
+
+def segments_sql(name, tables, state_dir, segments):
+    # The state table over its segments; a single segment is merged already
+    rows = _segment_rows(state_dir, segments)
+    return f"SELECT * FROM {rows}" if len(segments) == 1 else merge_sql(name, tables, rows)
+
+
+def current_version(state_dir):
+    try:
+        with open(os.path.join(state_dir, 'CURRENT'), encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def load_manifest(state_dir, version):
+    # {table: [{'file': path relative to state_dir, 'rows': n}]}. State written
+    # before segments has one file per table in the version directory.
+    path = os.path.join(state_dir, version + '.json')
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    manifest = {}
+    for name in sorted(os.listdir(os.path.join(state_dir, version))):
+        if name.endswith('.parquet'):
+            file = os.path.join(version, name)
+            manifest[name[:-len('.parquet')]] = [
+                {'file': file, 'rows': pq.read_metadata(os.path.join(state_dir, file)).num_rows}]
+    return manifest
+
+
+def _publish(state_dir, version, manifest):
+    path = os.path.join(state_dir, version + '.json')
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+    pointer = os.path.join(state_dir, 'CURRENT')
+    with open(pointer + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(version)
+    os.replace(pointer + '.tmp', pointer)
+
+
+def _write_segment(con, state_dir, name, keys, sql, file):
+    # COPY sql sorted by its keys (row groups then prune on key lookups); the segment entry
+    path = os.path.join(state_dir, file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    order = ', '.join(keys)
+    con.execute(f"COPY (SELECT * FROM ({sql}) ORDER BY {order}) TO '{path}' (FORMAT parquet)")
+    return {'file': file, 'rows': pq.read_metadata(path).num_rows}
+
+
+def _append_segment(con, state_dir, name, tables, segments, version):
+    # Segments of name after adding the table added_<name>, compacted
+    keys = tables[name][0]
+    segments = list(segments)
+    if con.execute(f"SELECT COUNT(*) FROM added_{name}").fetchone()[0]:
+        segments.append(_write_segment(con, state_dir, name, keys, f"SELECT * FROM added_{name}",
+                                       os.path.join('segments', name, f'{version}.parquet')))
+    while len(segments) > 1 and segments[-1]['rows'] * COMPACT_RATIO >= segments[-2]['rows']:
+        sql = merge_sql(name, tables, _segment_rows(state_dir, segments[-2:]))
+        merged = os.path.join('segments', name, f'{version}-{len(segments)}.parquet')
+        segments[-2:] = [_write_segment(con, state_dir, name, keys, sql, merged)]
+    return segments
+
+
+def _remove_unreferenced(state_dir, manifest, version):
+    # Segment files, version manifests and (pre-segment) version directories
+    # the current version does not use
+    keep = {os.path.normpath(seg['file']) for segments in manifest.values() for seg in segments}
+    for root, _, names in os.walk(os.path.join(state_dir, 'segments')):
+        for name in names:
+            file = os.path.normpath(os.path.relpath(os.path.join(root, name), state_dir))
+            if file not in keep:
+                os.remove(os.path.join(root, name))
+    for name in os.listdir(state_dir):
+        path = os.path.join(state_dir, name)
+        if name.startswith('v') and name not in (version, version + '.json') and (
+                name.endswith('.json') or (os.path.isdir(path) and
+                                           not any(k.startswith(name + os.sep) for k in keep))):
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+
+def _new_capture_ids(con):
+    ids = {c for (c,) in con.execute("SELECT capture_id FROM new_captures").fetchall()}
+    unlabelled, digest = con.execute(FINGERPRINT_SQL).fetchone()
+    if unlabelled:
+        fingerprint = f"fingerprint:{unlabelled}:{int(digest) % (1 << 64):016x}"
+        con.execute("INSERT INTO new_captures VALUES (?)", [fingerprint])
+        ids.add(fingerprint)
+    return ids
+
+
+def ingest_capture(spill, state_dir, out_parquet, memory_budget_mb=None, chunk_rows=65_536, backend='pandas',
+                   scoring=None, approximate=False, workers=None):
+    # Merge the spilled capture into the state and write its packets with
+    # features computed over everything ingested so far.
+    # approximate: sketch state (SKETCHED_SETS); a state_dir holds one kind only
+    spill.close()
+    os.makedirs(state_dir, exist_ok=True)
+    tables = state_tables(approximate)
+    old = current_version(state_dir)
+    segments = load_manifest(state_dir, old) if old else {}
+    if old and ('ip_macs_hll' in segments) != approximate:
+        raise ValueError(f"{state_dir} holds {'exact' if approximate else 'approximate'} state; "
+                         f"ingest with approximate={not approximate}")
+    manifest = segments
+    con = connect_duckdb(memory_budget_mb, temp_dir=os.path.join(spill.dir, 'duckdb'))
+    try:
+        con.execute(f"CREATE VIEW packets AS SELECT * FROM read_parquet('{spill.path}', file_row_number = true)")
+        for name, (_, _, sql) in tables.items():
+            if sql is not None:
+                con.execute(f"CREATE TABLE new_{name} AS {sql}")
+            if segments.get(name):
+                con.execute(f"CREATE VIEW old_{name} AS {segments_sql(name, tables, state_dir, segments[name])}")
+            elif name.endswith('_n') and segments.get(name[:-2]):
+                # state from before count tables: counted once from its member set
+                set_name = name[:-2]
+                keys, member, _ = SKETCHED_SETS[set_name]
+                con.execute(f"CREATE TABLE old_{name} AS SELECT {', '.join(keys)}, COUNT({member}) AS n "
+                            f"FROM old_{set_name} GROUP BY ALL")
+                segments[name] = []
+
+        seen = set()
+        if old:
+            seen = {c for (c,) in con.execute("SELECT capture_id FROM old_captures").fetchall()}
+        new_ids = _new_capture_ids(con)
+        if new_ids and new_ids <= seen:
+            print(f"Capture(s) {', '.join(sorted(new_ids))} already in {state_dir}; state not merged again")
+            for name in tables:
+                con.execute(f"CREATE VIEW state_{name} AS SELECT * FROM old_{name}")
+        else:
+            if new_ids & seen:
+                raise ValueError(f"capture(s) {', '.join(sorted(new_ids & seen))} already in {state_dir}; "
+                                 f"ingest the others without them")
+            if old:
+                for side in ('src', 'dst'):
+                    key = f'workload_id_{side}'
+                    con.execute(f"INSERT INTO new_workload_gaps_{side} " + BOUNDARY_GAPS_SQL.format(
+                        key=key, side=side, bucket=_gap_bucket('gap')))
+            # Members not stored yet, then their counts
+            for name, (keys, merges, sql) in tables.items():
+                if sql is None:
+                    continue
+                added = f"SELECT * FROM new_{name}"
+                if merges == {} and old:
+                    match = ' AND '.join(f"o.{k} IS NOT DISTINCT FROM n.{k}" for k in keys)
+                    added = f"SELECT * FROM new_{name} n WHERE NOT EXISTS (SELECT 1 FROM old_{name} o WHERE {match})"
+                con.execute(f"CREATE TABLE added_{name} AS {added}")
+            for name, (keys, _, sql) in tables.items():
+                if sql is None:
+                    member = SKETCHED_SETS[name[:-2]][1]
+                    con.execute(f"CREATE TABLE added_{name} AS SELECT {', '.join(keys)}, COUNT({member}) AS n "
+                                f"FROM added_{name[:-2]} GROUP BY ALL")
+                    if old and not segments.get(name):  # counts of a state from before count tables
+                        con.execute(f"INSERT INTO added_{name} SELECT * FROM old_{name}")
+
+            version = f'v{int(old[1:]) + 1 if old else 1:06d}'
+            manifest = {name: _append_segment(con, state_dir, name, tables, segments.get(name, []), version)
+                        for name in tables}
+            _publish(state_dir, version, manifest)
+            for name in tables:
+                if manifest[name]:
+                    con.execute(f"CREATE VIEW state_{name} AS "
+                                f"{segments_sql(name, tables, state_dir, manifest[name])}")
+                else:
+                    con.execute(f"CREATE VIEW state_{name} AS SELECT * FROM added_{name}")
+
+        aggs = _derive(con, spill, out_parquet, backend, scoring, approximate)
+    finally:
+        con.close()
+    if aggs is not None:
+        write_features(spill, out_parquet, aggs, chunk_rows, scoring, approximate, workers)
+    if current_version(state_dir) != old:
+        _remove_unreferenced(state_dir, manifest, current_version(state_dir))
+
+
+def _derive(con, spill, out_parquet, backend, scoring, approximate):
+    # Aggregate tables from the state_* tables in con. The DuckDB backend
+    # writes the features right away; pandas gets the aggregates back.
+    for name, sql in aggregates_sql(approximate).items():
+        con.execute(f"CREATE TABLE {name} AS {sql}")
+    if backend == 'duckdb':
+        write_features_sql(con, spill, out_parquet, scoring, approximate)
+        return None
+    return fetch_aggregates(con)
+
+
+def build_approximate(spill, out_parquet, memory_budget_mb=None, chunk_rows=65_536, backend='pandas',
+                      scoring=None, workers=None):
+    # stream_process_json(approximate=True) without a state_dir: the capture
+    # reduced to its sketch state, used once and not kept
+    spill.close()
+    con = connect_duckdb(memory_budget_mb, temp_dir=os.path.join(spill.dir, 'duckdb'))
+    try:
+        con.execute(f"CREATE VIEW packets AS SELECT * FROM read_parquet('{spill.path}', file_row_number = true)")
+        for name, (_, _, sql) in state_tables(approximate=True).items():
+            con.execute(f"CREATE TABLE state_{name} AS {sql}")
+        aggs = _derive(con, spill, out_parquet, backend, scoring, approximate=True)
+    finally:
+        con.close()
+    if aggs is not None:
+        write_features(spill, out_parquet, aggs, chunk_rows, scoring, approximate=True, workers=workers)
+
+
+# Error bound of each sketched output column (see sketches.py)
+APPROXIMATE_COLUMNS = {}
+for _side in ('src', 'dst'):
+    APPROXIMATE_COLUMNS[f'active_minute_count_{_side}'] = hll_error()
+    APPROXIMATE_COLUMNS[f'peer_count_{_side}'] = hll_error()
+    APPROXIMATE_COLUMNS[f'response_delay_{_side}'] = log_bucket_error(GAP_GAMMA)
+APPROXIMATE_COLUMNS['session_volatility_dst'] = hll_error()
+
+
+def _relative_error(exact, approximate):
+    exact, approximate = (np.asarray(v, dtype='float64') for v in (exact, approximate))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        error = np.abs(approximate - exact) / np.abs(exact)
+    error[exact == approximate] = 0
+    error[np.isnan(exact) & np.isnan(approximate)] = 0
+    return error
+
+
+def approximation_report(spill, sample_rows=100_000, memory_budget_mb=None, seed=42):
+    # Exact vs approximate mode on a uniform sample of the spilled packets:
+    # every threshold, and per feature column the largest relative error and
+    # the share of sampled packets whose value differs. bound is the sketch's
+    # own error (HyperLogLog standard error, log-bucket relative error);
+    # thresholds over estimated counts can be off by both.
+    spill.close()
+    con = connect_duckdb(memory_budget_mb, temp_dir=os.path.join(spill.dir, 'duckdb'))
+    try:
+        con.execute(f"""CREATE TABLE packets AS SELECT * FROM read_parquet('{spill.path}', file_row_number = true)
+                        USING SAMPLE reservoir({int(sample_rows)} ROWS) REPEATABLE ({int(seed)})""")
+        df = con.execute("SELECT * EXCLUDE (file_row_number) FROM packets ORDER BY file_row_number").arrow()
+        df = df.read_all().to_pandas()
+        create_aggregate_tables(con)
+        exact = fetch_aggregates(con)
+        for name in exact:
+            con.execute(f"DROP TABLE {name}")
+        for name, (_, _, sql) in state_tables(approximate=True).items():
+            con.execute(f"CREATE TABLE state_{name} AS {sql}")
+        for name, sql in aggregates_sql(approximate=True).items():
+            con.execute(f"CREATE TABLE {name} AS {sql}")
+        sketched = fetch_aggregates(con)
+    finally:
+        con.close()
+
+    rows = []
+    th_exact, th_sketched = compute_thresholds(exact), compute_thresholds(sketched, approximate=True)
+    for name, value in th_exact.items():
+        rows.append({'name': name, 'kind': 'threshold', 'bound': bucket_edge_error(),
+                     'exact': value, 'approximate': th_sketched[name],
+                     'rel_error': _relative_error([value], [th_sketched[name]])[0]})
+    a = apply_workload_features(df.copy(), exact, th_exact)
+    b = apply_workload_features(df.copy(), sketched, th_sketched)
+    for name in FEATURE_COLUMNS:
+        if name == 'artifact_type_ranked':
+            differs = a[name].map(tuple) != b[name].map(tuple)
+            error = np.nan
+        elif pd.api.types.is_numeric_dtype(a[name]) and not pd.api.types.is_bool_dtype(a[name]):
+            errors = _relative_error(a[name], b[name])
+            differs = errors > 1e-9  # exact and sketch state sum in a different order
+            error = errors.max() if len(errors) else np.nan
+        else:
+            differs = ~((a[name] == b[name]) | (a[name].isna() & b[name].isna()))
+            error = np.nan
+        rows.append({'name': name, 'kind': 'feature', 'bound': APPROXIMATE_COLUMNS.get(name, np.nan),
+                     'rel_error': error, 'rows_differing': float(np.mean(differs)) if len(df) else np.nan})
+    return pd.DataFrame(rows, columns=['name', 'kind', 'bound', 'exact', 'approximate', 'rel_error',
+                                       'rows_differing'])